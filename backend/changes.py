@@ -0,0 +1,478 @@
+import bz2
+import geopandas as gpd
+import gzip
+import io
+import logging
+import os
+import shapely
+import xml.etree.ElementTree as ET
+
+from ploles import PloleStore
+from utils import *
+
+
+logger = logging.getLogger('process_all')
+
+# columns of exported GeoJSON files (see end of process_one.process())
+export_columns = {
+    'stops': ['index', 'lon', 'lat', 'warnings', 'mods', 'maybe_mods', 'render',
+              'ptv2', 'member_comments', 'member_warnings', 'plafo_id', 'pole_id',
+              'stopo_id', 'plole_id', 'type', 'region'],
+    'nstops': ['index', 'lon', 'lat', 'warnings', 'mods', 'maybe_mods', 'render',
+               'ptv2', 'member_comments', 'member_warnings', 'plafo_id', 'pole_id',
+               'stopo_id', 'plole_id', 'type', 'region'],
+    'plafos': ['id', 'lon', 'lat', 'comments', 'warnings', 'mods', 'maybe_mods', 'type'],
+    'poles': ['id', 'lon', 'lat', 'comments', 'warnings', 'mods', 'maybe_mods', 'type'],
+    'stopos': ['id', 'lon', 'lat', 'comments', 'warnings', 'mods', 'type'],
+    'dubobs': ['index', 'lon', 'lat', 'osm_type', 'osm_id', 'warnings', 'comments', 'type']
+}
+
+
+def iter_change_xml(f):
+    '''
+    Yield (action, type, id, tags, locations, refs) for all object versions in
+    an osmChange or augmented diff file object. Locations is a list of
+    (lon, lat) tuples (node location, way node locations in augmented diffs),
+    refs is the list of node IDs of ways and member IDs of relations.
+    Augmented diffs yield old and new version of modified objects.
+    '''
+
+    context = ET.iterparse(f, events=('start', 'end'))
+    _, root = next(context)
+    action = None
+    for event, elem in context:
+        if event == 'start':
+            if elem.tag in ('create', 'modify', 'delete'):  # osmChange
+                action = elem.tag
+            elif elem.tag == 'action':  # augmented diff
+                action = elem.get('type')
+            continue
+        if elem.tag in ('node', 'way', 'relation') and action is not None:
+            tags = {t.get('k'): t.get('v') for t in elem.iter('tag')}
+            locations = [(float(e.get('lon')), float(e.get('lat')))
+                         for e in elem.iter() if e.get('lon') is not None]
+            if elem.tag == 'way':
+                refs = [int(nd.get('ref')) for nd in elem.iter('nd')]
+            elif elem.tag == 'relation':
+                refs = [int(m.get('ref')) for m in elem.iter('member')]
+            else:
+                refs = []
+            yield action, elem.tag, int(elem.get('id')), tags, locations, refs
+            elem.clear()
+        elif elem.tag in ('create', 'modify', 'delete', 'action'):
+            action = None
+            root.clear()
+
+
+def iter_change_file(path):
+
+    if path.endswith('.gz'):
+        f = gzip.open(path, 'rb')
+    elif path.endswith('.bz2'):
+        f = bz2.open(path, 'rb')
+    else:
+        f = open(path, 'rb')
+    with f:
+        yield from iter_change_xml(f)
+
+
+def get_adiff(id_, config):
+    '''
+    Download augmented diff from Overpass API.
+    '''
+
+    session, _ = get_overpass_session(config)
+    r = session.get(
+        config['overpass_adiff_url'],
+        params={'id': id_},
+        timeout=(60, config['overpass_timeout'] + 60)
+    )
+    r.raise_for_status()
+    return r.content
+
+
+def is_relevant(type_, tags):
+
+    if is_pt_object(tags):
+        return True
+    return type_ == 'way' and any(key in tags for key in track_keys)
+
+
+class Changes:
+    '''
+    Changed OSM objects from osmChange files and augmented diffs.
+
+    For each changed object we collect known locations (old and new) and
+    whether some version of the object is related to public transport (or is
+    a track way). Locations of ways without geometry (osmChange) are taken
+    from changed nodes. Deleted objects in osmChange files come without
+    location, they are looked up in the exported GeoJSON files.
+    '''
+
+    def __init__(self):
+
+        self.objects = {}  # (type, ID) -> dict with relevant, locations, refs
+        self.extra_locations = []  # locations not belonging to some object
+
+    def add(self, records):
+
+        for action, type_, id_, tags, locations, refs in records:
+            obj = self.objects.setdefault(
+                (type_, id_),
+                {'relevant': False, 'locations': [], 'refs': []}
+            )
+            obj['relevant'] = obj['relevant'] or is_relevant(type_, tags)
+            obj['locations'].extend(locations)
+            obj['refs'].extend(refs)
+
+    def add_file(self, path):
+
+        logger.info(f'reading changes from {path}...')
+        self.add(iter_change_file(path))
+
+    def add_adiff(self, id_, config):
+
+        logger.info(f'downloading augmented diff {id_}...')
+        self.add(iter_change_xml(io.BytesIO(get_adiff(id_, config))))
+
+    def complete_locations(self, config, extract=None):
+        '''
+        Set locations of ways and relations from changed nodes or, if
+        still missing, from the local extract (if given) or Overpass API
+        (current geometry).
+        '''
+
+        missing = []
+        for (type_, id_), obj in self.objects.items():
+            if type_ == 'node' or len(obj['locations']) > 0:
+                continue
+            for ref in obj['refs']:
+                node = self.objects.get(('node', ref))
+                if node is not None:
+                    obj['locations'].extend(node['locations'])
+                    node['referenced'] = obj['relevant'] or node.get('referenced', False)
+            if len(obj['locations']) == 0 and obj['relevant']:
+                missing.append((type_, id_))
+
+        if len(missing) == 0:
+            return
+        if extract is not None:
+            logger.info(f'getting locations of {len(missing)} ways/relations from extract...')
+            for type_, id_ in missing:
+                self.objects[(type_, id_)]['locations'].extend(extract.object_locations(type_, id_))
+            unlocated = sum(len(self.objects[key]['locations']) == 0 for key in missing)
+            if unlocated > 0:
+                logger.warning(f'no locations for {unlocated} changed ways/relations')
+            return
+        logger.info(f'getting locations of {len(missing)} ways/relations from Overpass...')
+        way_ids = [id_ for type_, id_ in missing if type_ == 'way']
+        rel_ids = [id_ for type_, id_ in missing if type_ == 'relation']
+        query = '''
+        (
+            {ways}
+            {rels}
+        );
+        >;
+        out skel qt;
+        '''.format(
+            ways=f'way(id:{",".join(map(str, way_ids))});' if way_ids else '',
+            rels=f'rel(id:{",".join(map(str, rel_ids))});' if rel_ids else ''
+        )
+        nodes, _, _ = overpass(query, config, verbose=0)
+        # note: we don't know which node belongs to which way, but we only need
+        #       the set of changed locations
+        self.extra_locations.extend((n.lon, n.lat) for n in nodes)
+
+    def locations(self):
+        '''
+        Return two lists of (lon, lat) tuples: locations of relevant objects
+        (including nodes of relevant ways) and locations of other nodes.
+        '''
+
+        relevant = list(self.extra_locations)
+        other = []
+        for (type_, _), obj in self.objects.items():
+            if obj['relevant'] or obj.get('referenced'):
+                relevant.extend(obj['locations'])
+            elif type_ == 'node':
+                other.extend(obj['locations'])
+        return relevant, other
+
+    def unlocated(self):
+        '''
+        True if there are changed objects without location (deletions in
+        osmChange files).
+        '''
+
+        return any(len(obj['locations']) == 0 for obj in self.objects.values())
+
+    def export_mask(self, layer, df):
+        '''
+        Mask for rows of an exported layer corresponding to changed objects.
+        '''
+
+        if layer in ('stopos', 'poles'):
+            ids = {id_ for type_, id_ in self.objects if type_ == 'node'}
+            return df['id'].isin(ids)
+        if layer == 'plafos':
+            ids = {id_ for type_, id_ in self.objects if type_ == 'way'} \
+                  | {-id_ for type_, id_ in self.objects if type_ == 'relation'}
+            return df['id'].isin(ids)
+        if layer == 'dubobs':
+            ids = {(type_, id_) for type_, id_ in self.objects}
+            osm_types = df['osm_type'].map({'node': 'node', 'way_area': 'way', 'mupo_area': 'relation'})
+            osm_ids = df['osm_id'].where(df['osm_type'] != 'mupo_area', -df['osm_id'])
+            return gpd.pd.Series(
+                [(t, i) in ids for t, i in zip(osm_types, osm_ids)],
+                index=df.index,
+                dtype=bool
+            )
+        return gpd.pd.Series(False, index=df.index)
+
+
+def empty_export(config):
+
+    return {
+        layer: gpd.GeoDataFrame(columns=cols + ['geometry'], geometry='geometry',
+                                crs=config['meters_crs'])
+        for layer, cols in export_columns.items()
+    }
+
+
+def read_export(config):
+    '''
+    Read region's exported GeoJSON files (in meters CRS). Returns None if some
+    file is missing.
+    '''
+
+    export = empty_export(config)
+    for layer in export_columns.keys():
+        file_name = config['export_path'] + config['region_code'] + '_' + layer + '.geojson'
+        if not os.path.exists(file_name):
+            return None
+        df = gpd.read_file(file_name)
+        if len(df) > 0:
+            export[layer] = df.to_crs(config['meters_crs'])
+    return export
+
+
+def write_export(config, export):
+    '''
+    Write region's export to GeoJSON files. Returns dict mapping layers to
+    lists of GeoJSON features (for make_tiles()).
+    '''
+
+    features = {}
+    for layer, cols in export_columns.items():
+        file_name = config['export_path'] + config['region_code'] + '_' + layer + '.geojson'
+        features[layer] = geojson_features(
+            export[layer][cols + ['geometry']].to_crs(config['lon_lat_crs'])
+        )
+        write_geojson(file_name, features[layer])
+    return features
+
+
+parquet_layers = ['stops', 'ploles', 'stopos', 'poles', 'plafos', 'dubobs']
+
+
+def read_parquet_export(config, layer, columns=None):
+    '''
+    Read one layer of region's GeoParquet export (see export_parquet setting).
+    Only given columns are read (all if None), files are memory-mapped. Ploles
+    have no geometry, thus a DataFrame is returned for layer 'ploles'.
+    '''
+
+    file_name = config['export_path'] + config['region_code'] + '_' + layer + '.parquet'
+    if layer == 'ploles':
+        return gpd.pd.read_parquet(file_name, columns=columns, memory_map=True)
+    return gpd.read_parquet(file_name, columns=columns, memory_map=True)
+
+
+def concat_rows(dfs, ignore_index=True):
+
+    # note: concatenating with empty data frames (object dtype) would convert
+    #       all columns to object dtype
+    non_empty = [df for df in dfs if len(df) > 0]
+    if len(non_empty) == 0:
+        return dfs[0].reset_index(drop=True)
+    return gpd.pd.concat(non_empty, ignore_index=ignore_index)
+
+
+def affected_area(area, old_stops, new_stops):
+    '''
+    Grow area until no (old or new) stop intersects the area's boundary. Then
+    all stops intersecting the area can be replaced without touching stops
+    outside the area (stop outlines contain all their members).
+    '''
+
+    n_old = -1
+    n_new = -1
+    while True:
+        old_mask = old_stops.intersects(area)
+        new_mask = new_stops.intersects(area)
+        if old_mask.sum() == n_old and new_mask.sum() == n_new:
+            break
+        n_old = old_mask.sum()
+        n_new = new_mask.sum()
+        area = shapely.unary_union(
+            [area]
+            + old_stops.geometry[old_mask].to_list()
+            + new_stops.geometry[new_mask].to_list()
+        )
+    return area, old_mask, new_mask
+
+
+def merge_export(config, old, new, area, new_config):
+    '''
+    Replace stops (and their members) intersecting the area in the old export
+    by the stops intersecting the area from the new (partial) export. Plole
+    JSON files in config['ploles_path'] are updated from the new plole files
+    in new_config['ploles_tmp_path'], GeoParquet files (if any) from the new
+    GeoParquet files in new_config['export_path']. Stop and plole IDs of new
+    stops are shifted behind the old IDs. Returns number of removed and added
+    stops and the merged export's GeoJSON features (see write_export()).
+    '''
+
+    area, old_mask, new_mask = affected_area(area, old['stops'], new['stops'])
+    removed = old['stops'][old_mask]
+    added = new['stops'][new_mask]
+
+    # shift IDs of new stops
+    stop_offset = int(old['stops']['index'].max()) + 1 if len(old['stops']) > 0 else 0
+    plole_offset = int(old['stops']['plole_id'].max()) + 1 if len(old['stops']) > 0 else 0
+    plole_offset = max(plole_offset, 0)
+    added_plole_ids = set(added.loc[added['plole_id'] > -1, 'plole_id'].to_list())
+    for layer in ['stops', 'nstops']:
+        df = new[layer]
+        df['plole_id'] = df['plole_id'].where(df['plole_id'] < 0, df['plole_id'] + plole_offset)
+        # note: virtual poles have ID -stop_id (thus 0 for stop 0)
+        df['pole_id'] = df['pole_id'].where(df['pole_id'] > 0, df['pole_id'] - stop_offset)
+        df['index'] = df['index'] + stop_offset
+    new['poles']['id'] = new['poles']['id'].where(new['poles']['id'] > 0,
+                                                  new['poles']['id'] - stop_offset)
+
+    # members of removed and added stops
+    merged = {}
+    kept_ids = {}  # layer -> (IDs of kept old rows, IDs of new rows)
+    for layer, col in [('stopos', 'stopo_id'), ('poles', 'pole_id'), ('plafos', 'plafo_id')]:
+        old_df = old[layer]
+        new_df = new[layer]
+        old_remove = old_df['id'].isin(removed[col]) | old_df.intersects(area)
+        new_keep = new_df['id'].isin(new['stops'].loc[new_mask, col])
+        old_remove = old_remove | old_df['id'].isin(new_df.loc[new_keep, 'id'])
+        merged[layer] = concat_rows((old_df[~old_remove], new_df[new_keep]), ignore_index=True)
+        kept_ids[layer] = (old_df.loc[~old_remove, 'id'], new_df.loc[new_keep, 'id'])
+    for layer in ['stops', 'nstops']:
+        old_df = old[layer]
+        new_df = new[layer]
+        merged[layer] = concat_rows(
+            (old_df[~old_df['index'].isin(removed['index'])],
+             new_df[new_df['index'].isin(new['stops'].loc[new_mask, 'index'])]),
+            ignore_index=True
+        )
+    old_df = old['dubobs']
+    new_df = new['dubobs']
+    merged['dubobs'] = concat_rows((old_df[~old_df.intersects(area)], new_df[new_df.intersects(area)]),
+                                     ignore_index=True)
+    merged['dubobs']['index'] = merged['dubobs'].index
+    features = write_export(config, merged)
+
+    # GeoParquet files
+    # note: GeoParquet files cannot be updated from GeoJSON files (modalities
+    #       and messages are strings there), so they are merged from the new
+    #       GeoParquet files (same rows as in the GeoJSON files), outdated
+    #       files are removed
+    file_names = [config['export_path'] + config['region_code'] + '_' + layer + '.parquet'
+                  for layer in parquet_layers]
+    if config.get('export_parquet') and all(os.path.exists(f) for f in file_names):
+        merge_parquet_export(
+            config, new_config, area, kept_ids,
+            removed_stop_ids=removed['index'], added_stop_ids=new['stops'].loc[new_mask, 'index'],
+            removed_plole_ids=removed['plole_id'], added_plole_ids=list(added_plole_ids),
+            stop_offset=stop_offset, plole_offset=plole_offset
+        )
+    else:
+        for file_name in file_names:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+                logger.warning(f'removed outdated GeoParquet file {file_name}, run process_all.py to regenerate')
+
+    # plole files
+    mode = config.get('ploles_mode', 'files')
+    old_ploles = PloleStore(config['ploles_path'], config['region_code'], mode)
+    new_ploles = PloleStore(new_config['ploles_tmp_path'], config['region_code'], mode)
+    for plole_id in set(removed.loc[removed['plole_id'] > -1, 'plole_id'].to_list()):
+        old_ploles.remove(plole_id)
+    for plole_id in added_plole_ids:
+        data = new_ploles.read(plole_id)
+        data['plole_id'] += plole_offset
+        for stopo_info in data['plole_stopos'].values():
+            if stopo_info['stop_id'] > 0:
+                stopo_info['stop_id'] += stop_offset
+        # note: stopo infos of plafos and poles may contain stop IDs, too
+        for key in ['plafo_stopos', 'pole_stopos']:
+            for stopo_info in data.get(key, {}).values():
+                if 'stop_id' in stopo_info:
+                    stopo_info['stop_id'] += stop_offset
+        old_ploles.write(data['plole_id'], data)
+    old_ploles.close()
+    new_ploles.close()
+
+    return len(removed), len(added), features
+
+
+def merge_parquet_export(config, new_config, area, kept_ids, removed_stop_ids, added_stop_ids,
+                         removed_plole_ids, added_plole_ids, stop_offset, plole_offset):
+    '''
+    Merge the new (partial) GeoParquet export in new_config['export_path']
+    into the region's GeoParquet files like merge_export() merges the GeoJSON
+    files. Kept_ids maps layers 'stopos', 'poles' and 'plafos' to IDs of kept
+    old rows and of new rows, stop IDs of new stops are already shifted by
+    stop_offset, plole IDs of new ploles are not shifted yet.
+    '''
+
+    # note: the partial run writes no files if there are no objects in the
+    #       bounding boxes, then there are no new rows
+    def read(layer):
+        df = read_parquet_export(config, layer)
+        new_file = new_config['export_path'] + config['region_code'] + '_' + layer + '.parquet'
+        new_df = read_parquet_export(new_config, layer) if os.path.exists(new_file) else df.iloc[:0].copy()
+        return df, new_df
+
+    def concat(old_df, new_df):
+        merged = concat_rows((old_df, new_df), ignore_index=True)
+        # note: concatenating categoricals with different categories yields
+        #       object dtype, encode again
+        for col in old_df.columns:
+            if isinstance(old_df[col].dtype, gpd.pd.CategoricalDtype):
+                merged[col] = merged[col].astype('category')
+        return merged
+
+    merged = {}
+    for layer in ['stopos', 'poles', 'plafos']:
+        old_df, new_df = read(layer)
+        if layer == 'poles':
+            new_df['id'] = new_df['id'].where(new_df['id'] > 0, new_df['id'] - stop_offset)
+        old_ids, new_ids = kept_ids[layer]
+        merged[layer] = concat(old_df[old_df['id'].isin(old_ids)], new_df[new_df['id'].isin(new_ids)])
+
+    old_df, new_df = read('stops')
+    new_df['plole_id'] = new_df['plole_id'].where(new_df['plole_id'] < 0, new_df['plole_id'] + plole_offset)
+    new_df['pole_id'] = new_df['pole_id'].where(new_df['pole_id'] > 0, new_df['pole_id'] - stop_offset)
+    new_df['index'] = new_df['index'] + stop_offset
+    merged['stops'] = concat(old_df[~old_df['index'].isin(removed_stop_ids)],
+                             new_df[new_df['index'].isin(added_stop_ids)])
+
+    old_df, new_df = read('dubobs')
+    old_mask = old_df.to_crs(config['meters_crs']).intersects(area)
+    new_mask = new_df.to_crs(config['meters_crs']).intersects(area)
+    merged['dubobs'] = concat(old_df[~old_mask.to_numpy()], new_df[new_mask.to_numpy()])
+    merged['dubobs']['index'] = merged['dubobs'].index
+
+    old_df, new_df = read('ploles')
+    new_df = new_df[new_df['plole_id'].isin(added_plole_ids)].copy()
+    new_df['plole_id'] = new_df['plole_id'] + plole_offset
+    merged['ploles'] = concat(old_df[~old_df['plole_id'].isin(removed_plole_ids)], new_df)
+
+    for layer, df in merged.items():
+        df.to_parquet(config['export_path'] + config['region_code'] + '_' + layer + '.parquet')
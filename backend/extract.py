@@ -0,0 +1,337 @@
+import bz2
+import gzip
+import logging
+import numpy as np
+import shapely
+import xml.etree.ElementTree as ET
+
+from utils import *
+
+try:
+    import osmium
+except ImportError:
+    osmium = None
+
+
+logger = logging.getLogger('process_all')
+
+
+def iter_osm_file(path, types):
+    '''
+    Yield (type, id, tags, data) for all objects of given types ('node', 'way',
+    'relation') in an OSM file. Data is (lon, lat) for nodes, a list of node IDs
+    for ways and a list of (type, ref, role) tuples for relations.
+    '''
+
+    if path.endswith('.pbf'):
+        yield from _iter_pbf(path, types)
+    else:
+        yield from _iter_xml(path, types)
+
+
+def _iter_pbf(path, types):
+
+    if osmium is None:
+        raise Exception('reading PBF files requires the osmium package (pyosmium)')
+
+    entities = osmium.osm.osm_entity_bits.NOTHING
+    if 'node' in types:
+        entities |= osmium.osm.NODE
+    if 'way' in types:
+        entities |= osmium.osm.WAY
+    if 'relation' in types:
+        entities |= osmium.osm.RELATION
+    member_types = {'n': 'node', 'w': 'way', 'r': 'relation'}
+
+    for o in osmium.FileProcessor(path, entities):
+        tags = {t.k: t.v for t in o.tags}
+        if o.is_node():
+            if not o.location.valid():
+                continue
+            yield 'node', o.id, tags, (o.location.lon, o.location.lat)
+        elif o.is_way():
+            yield 'way', o.id, tags, [n.ref for n in o.nodes]
+        elif o.is_relation():
+            yield 'relation', o.id, tags, \
+                [(member_types[m.type], m.ref, m.role) for m in o.members]
+
+
+def _iter_xml(path, types):
+
+    if path.endswith('.gz'):
+        f = gzip.open(path, 'rb')
+    elif path.endswith('.bz2'):
+        f = bz2.open(path, 'rb')
+    else:
+        f = open(path, 'rb')
+
+    with f:
+        context = ET.iterparse(f, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event != 'end' or elem.tag not in ('node', 'way', 'relation'):
+                continue
+            if elem.tag in types:
+                tags = {t.get('k'): t.get('v') for t in elem.iter('tag')}
+                id_ = int(elem.get('id'))
+                if elem.tag == 'node':
+                    if elem.get('lon') is not None:
+                        yield 'node', id_, tags, (float(elem.get('lon')), float(elem.get('lat')))
+                elif elem.tag == 'way':
+                    yield 'way', id_, tags, [int(nd.get('ref')) for nd in elem.iter('nd')]
+                else:
+                    yield 'relation', id_, tags, \
+                        [(m.get('type'), int(m.get('ref')), m.get('role', ''))
+                         for m in elem.iter('member')]
+            root.clear()
+
+
+class Extract:
+    '''
+    Public transport related objects read from a local OSM extract.
+
+    The extract is read once (three sequential passes: relations, nodes and
+    ways, node locations) for all regions of a run. Afterwards region() yields
+    the same objects as the Overpass query in process_one.process() and
+    track_ways() yields the same ways as the track query. The extract has to be
+    sorted (nodes, ways, relations) like planet files and Geofabrik extracts.
+    '''
+
+    def __init__(self, path, osm_ids):
+
+        self.path = path
+
+        # relations: region boundaries and multipolygons
+        logger.info(f'reading relations from {path}...')
+        osm_ids = set(osm_ids)
+        self.boundaries = {}  # osm_id -> list of (way ID, role)
+        self.rels = {}  # ID -> Overpass-like JSON element
+        member_way_ids = set()
+        member_node_ids = set()
+        for _, id_, tags, members in iter_osm_file(path, ('relation', )):
+            if id_ in osm_ids:
+                self.boundaries[id_] = [(ref, role) for type_, ref, role in members
+                                        if type_ == 'way']
+                member_way_ids.update(ref for ref, _ in self.boundaries[id_])
+            if tags.get('type') == 'multipolygon' and is_pt_object(tags):
+                self.rels[id_] = {
+                    'id': id_,
+                    'tags': tags,
+                    'members': [{'type': type_, 'ref': ref, 'role': role}
+                                for type_, ref, role in members]
+                }
+                for type_, ref, _ in members:
+                    if type_ == 'way':
+                        member_way_ids.add(ref)
+                    elif type_ == 'node':
+                        member_node_ids.add(ref)
+        logger.info(f'...{len(self.rels)} multipolygons, {len(self.boundaries)} region boundaries')
+        missing = osm_ids - set(self.boundaries)
+        if len(missing) > 0:
+            logger.warning(f'no boundary relations for regions {sorted(missing)}')
+
+        # public transport nodes and ways, member ways, track ways
+        logger.info('reading nodes and ways...')
+        # note: objects are stored as Overpass-like JSON elements and converted
+        #       to Node/Way/Relation objects on request, because processing a
+        #       region modifies objects (comments, warnings, tags)
+        self.nodes = {}  # ID -> element
+        self.ways = {}  # ID -> element (public transport ways)
+        self.member_ways = {}  # ID -> list of node IDs
+        self.track_ways_by_node = {}  # node ID -> list of track ways
+        track_ways = {}
+        for type_, id_, tags, data in iter_osm_file(path, ('node', 'way')):
+            if type_ == 'node':
+                if tags.get('access') != 'private' and is_pt_object(tags):
+                    self.nodes[id_] = {'id': id_, 'lon': data[0], 'lat': data[1], 'tags': tags}
+                continue
+            if tags.get('access') != 'private' and is_pt_object(tags):
+                self.ways[id_] = {'id': id_, 'nodes': data, 'tags': tags}
+            if id_ in member_way_ids:
+                self.member_ways[id_] = data
+            if any(key in tags for key in track_keys):
+                for n_id in data:
+                    if n_id in self.nodes:
+                        if id_ not in track_ways:
+                            track_ways[id_] = {'id': id_, 'nodes': data, 'tags': tags}
+                        self.track_ways_by_node.setdefault(n_id, []).append(track_ways[id_])
+        del track_ways
+        logger.info(f'...{len(self.nodes)} nodes, {len(self.ways)} ways')
+
+        # locations of all nodes of public transport ways and member ways
+        logger.info('reading node locations...')
+        skel_node_ids = member_node_ids
+        for w in self.ways.values():
+            skel_node_ids.update(w['nodes'])
+        for node_ids in self.member_ways.values():
+            skel_node_ids.update(node_ids)
+        ids = []
+        lons = []
+        lats = []
+        for _, id_, _, (lon, lat) in iter_osm_file(path, ('node', )):
+            if id_ in skel_node_ids:
+                ids.append(id_)
+                lons.append(lon)
+                lats.append(lat)
+        del skel_node_ids
+        order = np.argsort(ids)
+        self.skel_ids = np.array(ids, dtype=np.int64)[order]
+        self.skel_lons = np.array(lons)[order]
+        self.skel_lats = np.array(lats)[order]
+        del ids, lons, lats, order
+        logger.info(f'...{len(self.skel_ids)} locations')
+
+        # drop ways with missing nodes (at the extract's boundary)
+        for ways in [self.ways, self.member_ways]:
+            for id_ in list(ways):
+                node_ids = ways[id_]['nodes'] if ways is self.ways else ways[id_]
+                if not self._has_locations(node_ids):
+                    logger.warning(f'dropping way {id_} with missing node locations')
+                    del ways[id_]
+
+        # drop multipolygons with missing member ways (no valid area)
+        for id_ in list(self.rels):
+            if any(m['type'] == 'way' and m['ref'] not in self.member_ways
+                   for m in self.rels[id_]['members']):
+                logger.warning(f'dropping multipolygon {id_} with missing member ways')
+                del self.rels[id_]
+
+        # spatial indices for selecting objects in regions
+        self.node_list = list(self.nodes.values())
+        self.node_tree = shapely.STRtree(shapely.points(
+            [n['lon'] for n in self.node_list],
+            [n['lat'] for n in self.node_list]
+        ))
+        self.way_list = list(self.ways.values())
+        self.way_tree = shapely.STRtree([self._line(w['nodes']) for w in self.way_list])
+        self.rel_list = list(self.rels.values())
+        self.rel_tree = shapely.STRtree([
+            shapely.multilinestrings([self._line(self.member_ways[m['ref']])
+                                      for m in r['members']
+                                      if m['type'] == 'way' and m['ref'] in self.member_ways])
+            for r in self.rel_list
+        ])
+
+    def object_locations(self, type_, osm_id):
+        '''
+        Locations (list of (lon, lat)) of the nodes of a way or multipolygon
+        relation. Empty if the object is not in the extract.
+        '''
+
+        if type_ == 'way':
+            node_ids = self.ways[osm_id]['nodes'] if osm_id in self.ways \
+                       else self.member_ways.get(osm_id, [])
+        elif osm_id in self.rels:
+            node_ids = []
+            for m in self.rels[osm_id]['members']:
+                if m['type'] == 'way':
+                    node_ids.extend(self.member_ways.get(m['ref'], []))
+                elif m['type'] == 'node':
+                    node_ids.append(m['ref'])
+        else:
+            node_ids = []
+        node_ids = np.unique(np.array(node_ids, dtype=np.int64))
+        node_ids = node_ids[np.isin(node_ids, self.skel_ids)]
+        lons, lats = self._locations(node_ids)
+        return list(zip(lons.tolist(), lats.tolist()))
+
+    def _has_locations(self, node_ids):
+
+        pos = np.searchsorted(self.skel_ids, node_ids)
+        pos[pos == len(self.skel_ids)] = 0
+        return len(self.skel_ids) > 0 and (self.skel_ids[pos] == node_ids).all()
+
+    def _locations(self, node_ids):
+
+        pos = np.searchsorted(self.skel_ids, node_ids)
+        return self.skel_lons[pos], self.skel_lats[pos]
+
+    def _line(self, node_ids):
+
+        lons, lats = self._locations(node_ids)
+        if len(node_ids) < 2:
+            lons = np.repeat(lons, 2)
+            lats = np.repeat(lats, 2)
+        return shapely.linestrings(lons, lats)
+
+    def _area(self, osm_id):
+
+        outer = []
+        inner = []
+        for way_id, role in self.boundaries.get(osm_id, []):
+            if way_id in self.member_ways:
+                line = self._line(self.member_ways[way_id])
+                (inner if role == 'inner' else outer).append(line)
+        return shapely.difference(
+            shapely.unary_union(shapely.polygonize(outer)),
+            shapely.unary_union(shapely.polygonize(inner))
+        )
+
+    def region(self, osm_id, bboxes=None, node_store=None):
+        '''
+        Public transport objects in a region like returned by overpass() for
+        the main query (including skeleton nodes and member ways). If bboxes
+        (list of (south, west, north, east)) is given, only objects inside the
+        boxes are returned. If a node store is given, node locations go to the
+        store and skeleton nodes are not returned as Node objects.
+        '''
+
+        area = self._area(osm_id)
+        if bboxes:
+            area = shapely.intersection(area, shapely.unary_union(
+                [shapely.box(w, s, e, n) for s, w, n, e in bboxes]
+            ))
+        if area.is_empty:
+            logger.error(f'no area for region {osm_id}')
+            return [], [], []
+
+        nodes = [Node(self.node_list[i]) for i in self.node_tree.query(area, predicate='intersects')]
+        ways = [Way(self.way_list[i]) for i in self.way_tree.query(area, predicate='intersects')]
+        rels = [Relation(self.rel_list[i]) for i in self.rel_tree.query(area, predicate='intersects')]
+        nodes.sort(key=lambda n: n.id)
+        ways.sort(key=lambda w: w.id)
+        rels.sort(key=lambda r: r.id)
+
+        # skeleton (recursion down to nodes)
+        skel_node_ids = set()
+        skel_way_ids = set()
+        for w in ways:
+            skel_node_ids.update(w.node_ids)
+        for r in rels:
+            for m in r.members:
+                if m.type == 'way' and m.id in self.member_ways:
+                    skel_way_ids.add(m.id)
+                    skel_node_ids.update(self.member_ways[m.id])
+                elif m.type == 'node':
+                    skel_node_ids.add(m.id)
+        skel_node_ids = np.array(sorted(skel_node_ids), dtype=np.int64)
+        skel_node_ids = skel_node_ids[np.isin(skel_node_ids, self.skel_ids)]
+        lons, lats = self._locations(skel_node_ids)
+        if node_store is not None:
+            node_store.add_arrays([n.id for n in nodes], [n.lon for n in nodes], [n.lat for n in nodes])
+            node_store.add_arrays(skel_node_ids, lons, lats)
+            skel_nodes = []
+        else:
+            skel_nodes = [Node({'id': id_, 'lon': lon, 'lat': lat})
+                          for id_, lon, lat in zip(skel_node_ids.tolist(), lons.tolist(), lats.tolist())]
+        skel_ways = [Way({'id': id_, 'nodes': self.member_ways[id_]})
+                     for id_ in sorted(skel_way_ids)]
+
+        region_logger = logging.getLogger('region')
+        region_logger.info(f'OSM nodes: {len(nodes)} (skeleton: {len(skel_node_ids)})')
+        region_logger.info(f'OSM ways: {len(ways)} (skeleton: {len(skel_ways)})')
+        region_logger.info(f'OSM relations: {len(rels)}')
+
+        return nodes + skel_nodes, ways + skel_ways, rels
+
+    def track_ways(self, node_ids):
+        '''
+        Ways with track tags containing at least one of the nodes like returned
+        by overpass() for the track query.
+        '''
+
+        ways = {}
+        for n_id in node_ids:
+            for w in self.track_ways_by_node.get(n_id, []):
+                ways[w['id']] = w
+        return [Way(ways[id_]) for id_ in sorted(ways)]
@@ -0,0 +1,242 @@
+import concurrent.futures
+import json
+import numpy as np
+import os
+import tempfile
+
+
+# archive layout (all numbers little endian):
+#   header: magic (8 bytes), number of index entries (uint32), reserved (uint32)
+#   index: one entry per plole ID (0, 1, 2,...) with offset (uint64) and length
+#          (uint32) of the plole's record, length 0 for missing ploles
+#   records: one JSON object per plole
+# note: the frontend computes the position of a plole's index entry from its
+#       ID, so one Range request yields the record's position (see details.js)
+archive_magic = b'PTSAPLOL'
+archive_header_size = 16
+archive_index_dtype = np.dtype([('offset', '<u8'), ('length', '<u4')])
+
+
+class PloleStore:
+    '''
+    Plole details (one JSON object per plole) of one region in directory path.
+
+    Mode 'files' stores one file per plole in path (region code and plole ID
+    as file name). Mode 'sharded' stores one file per plole in subdirectories
+    region_code/shard/ with at most shard_size files each. Mode 'archive'
+    stores all ploles of a region in one file region_code.ploles with an
+    index of record offsets.
+
+    In archive mode new records are collected in a temporary file and the
+    archive is rewritten by close(). Existing records are kept unless clear is
+    True.
+
+    With writers > 0 records are written in batches by a pool of background
+    threads (one thread in archive mode to keep records in order), so
+    serialization of further records overlaps with disk I/O. Call close() to
+    wait for all writes.
+    '''
+
+    modes = ('files', 'sharded', 'archive')
+    shard_size = 1000
+    batch_size = 256
+
+    def __init__(self, path, region_code, mode='files', clear=False, writers=0):
+
+        if mode not in PloleStore.modes:
+            raise ValueError(f'unknown plole mode {mode}')
+        self.path = path
+        self.region_code = region_code
+        self.mode = mode
+        self.clear = clear
+        self._dirs = set()  # created shard directories
+        self._index = None  # plole ID -> (in temporary file, offset, length)
+        self._tmp = None
+        self._archive = None
+        self._modified = False
+        self._tmp_size = 0
+        self._batch = []
+        self._futures = []
+        self._pool = None
+        if writers > 0:
+            self._writers = 1 if mode == 'archive' else writers
+            self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self._writers)
+
+    def file_name(self, plole_id=None):
+        '''
+        Name of the plole's file (files and sharded mode) or of the region's
+        archive (archive mode, plole_id ignored).
+        '''
+
+        if self.mode == 'files':
+            return self.path + self.region_code + str(plole_id) + '.json'
+        elif self.mode == 'sharded':
+            return f'{self.path}{self.region_code}/{plole_id // PloleStore.shard_size}/{plole_id}.json'
+        else:
+            return self.path + self.region_code + '.ploles'
+
+    def write(self, plole_id, data):
+
+        self.write_json(plole_id, json.dumps(data))
+
+    def write_json(self, plole_id, text):
+        '''
+        Write plole details already serialized to JSON.
+        '''
+
+        plole_id = int(plole_id)
+        record = text.encode()
+        if self.mode == 'archive':
+            self._load()
+            self._index[plole_id] = (True, self._tmp_size, len(record))
+            self._tmp_size += len(record)
+            self._modified = True
+            self._batch.append(record)
+        else:
+            file_name = self.file_name(plole_id)
+            if self.mode == 'sharded':
+                dir_name = os.path.dirname(file_name)
+                if dir_name not in self._dirs:
+                    os.makedirs(dir_name, exist_ok=True)
+                    self._dirs.add(dir_name)
+            self._batch.append((file_name, record))
+        if self._pool is None or len(self._batch) >= PloleStore.batch_size:
+            self._submit()
+
+    def flush(self):
+        '''
+        Wait until all records are written.
+        '''
+
+        self._submit()
+        while len(self._futures) > 0:
+            self._futures.pop(0).result()
+        if self._tmp is not None:
+            self._tmp.flush()
+
+    def read(self, plole_id):
+        '''
+        Plole details as dict. Raises KeyError for unknown plole IDs.
+        '''
+
+        plole_id = int(plole_id)
+        self.flush()
+        if self.mode != 'archive':
+            file_name = self.file_name(plole_id)
+            if not os.path.exists(file_name):
+                raise KeyError(f'no details for plole {plole_id}')
+            with open(file_name) as f:
+                return json.load(f)
+        self._load()
+        if plole_id not in self._index:
+            raise KeyError(f'no details for plole {plole_id}')
+        return json.loads(self._record(*self._index[plole_id]))
+
+    def remove(self, plole_id):
+
+        plole_id = int(plole_id)
+        self.flush()
+        if self.mode == 'archive':
+            self._load()
+            if self._index.pop(plole_id, None) is not None:
+                self._modified = True
+            return
+        file_name = self.file_name(plole_id)
+        if os.path.exists(file_name):
+            os.remove(file_name)
+
+    def close(self):
+        '''
+        Wait for pending writes and write archive (archive mode only, if
+        modified).
+        '''
+
+        self.flush()
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        if self._index is None:
+            return
+        if self._modified or self.clear:
+            self._write_archive()
+        if self._archive is not None:
+            self._archive.close()
+        self._tmp.close()
+        self._tmp = None
+        self._archive = None
+        self._index = None
+        self._modified = False
+        self._tmp_size = 0
+
+    def _write_archive(self):
+
+        ids = sorted(self._index.keys())
+        index = np.zeros(ids[-1] + 1 if len(ids) > 0 else 0, dtype=archive_index_dtype)
+        offset = archive_header_size + index.nbytes
+        for plole_id in ids:
+            length = self._index[plole_id][2]
+            index[plole_id] = (offset, length)
+            offset += length
+
+        file_name = self.file_name()
+        tmp_name = file_name + '.tmp'
+        with open(tmp_name, 'wb') as f:
+            f.write(archive_magic)
+            f.write(np.array([len(index), 0], dtype='<u4').tobytes())
+            f.write(index.tobytes())
+            for plole_id in ids:
+                f.write(self._record(*self._index[plole_id]))
+        os.replace(tmp_name, file_name)
+
+    def _load(self):
+
+        if self._index is not None:
+            return
+        self._index = {}
+        # note: append mode, because reading records moves the file position
+        self._tmp = tempfile.TemporaryFile(mode='a+b', dir=self.path)
+        self._archive = None
+        file_name = self.file_name()
+        if self.clear or not os.path.exists(file_name):
+            return
+        self._archive = open(file_name, 'rb')
+        header = self._archive.read(archive_header_size)
+        if header[:len(archive_magic)] != archive_magic:
+            raise ValueError(f'{file_name} is not a plole archive')
+        count = int(np.frombuffer(header, dtype='<u4', count=1, offset=len(archive_magic))[0])
+        index = np.frombuffer(self._archive.read(count * archive_index_dtype.itemsize),
+                              dtype=archive_index_dtype)
+        for plole_id in np.flatnonzero(index['length']):
+            self._index[int(plole_id)] = (False, int(index['offset'][plole_id]),
+                                          int(index['length'][plole_id]))
+
+    def _submit(self):
+
+        if len(self._batch) == 0:
+            return
+        batch = self._batch
+        self._batch = []
+        if self.mode == 'archive':
+            func = self._tmp.writelines
+        else:
+            func = _write_files
+        if self._pool is None:
+            func(batch)
+            return
+        self._futures.append(self._pool.submit(func, batch))
+        # note: limit number of pending batches (memory)
+        while len(self._futures) > 2 * self._writers:
+            self._futures.pop(0).result()
+
+    def _record(self, in_tmp, offset, length):
+
+        f = self._tmp if in_tmp else self._archive
+        f.seek(offset)
+        return f.read(length)
+
+
+def _write_files(batch):
+
+    for file_name, record in batch:
+        with open(file_name, 'wb') as f:
+            f.write(record)
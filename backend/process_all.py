@@ -5,6 +5,7 @@ import os
 import pandas as pd
 import time
 
+from extract import Extract
 from process_one import *
 
 
@@ -77,6 +78,14 @@ parent_mask = regions['is_parent']
 to_process = regions.loc[include_mask & ~parent_mask, :].index
 logger.info(f'regions to process: {len(to_process)}')
 
+# read local OSM extract (if configured)
+if config.get('extract_path'):
+    logger.info(f'reading OSM extract {config["extract_path"]}...')
+    extract = Extract(config['extract_path'], to_process)
+    logger.info('...done')
+else:
+    extract = None
+
 # process regions
 for i, osm_id in enumerate(to_process):
     code = regions.loc[osm_id, 'code'].lower()
@@ -94,7 +103,7 @@ for i, osm_id in enumerate(to_process):
     config['region_code'] = code
     config['osm_id'] = osm_id
     try:
-        success = process(config)
+        success = process(config, extract)
     except Exception as e:
         logger.exception(e)
         success = False
@@ -107,21 +116,14 @@ for i, osm_id in enumerate(to_process):
     region_logger.removeHandler(file_handler)
     del file_handler
 
-# join tiles from all regions
-logger.info('joining tiles...')
-os.system(f'mkdir {config["tiles_tmp_path"]}')
-cmd = f'tile-join --output-to-directory={config["tiles_tmp_path"]} --no-tile-compression {config["export_path"]}*.mbtiles'
-os.system(cmd)
-logger.info('...done')
+# join tiles from all regions and replace tiles
+join_tiles(config)
 
-# replace tiles and ploles
-logger.info('moving old tiles and ploles to temporary location...')
-os.system(f'mv {config["tiles_path"]} {config["tiles_old_path"]}')
+# replace ploles
+logger.info('moving old ploles to temporary location...')
 os.system(f'mv {config["ploles_path"]} {config["ploles_old_path"]}')
-logger.info('moving new tiles and ploles to destination path...')
-os.system(f'mv {config["tiles_tmp_path"]} {config["tiles_path"]}')
+logger.info('moving new ploles to destination path...')
 os.system(f'mv {config["ploles_tmp_path"]} {config["ploles_path"]}')
-logger.info('removing old tiles and ploles...')
-os.system(f'rm -r {config["tiles_old_path"]}')
+logger.info('removing old ploles...')
 os.system(f'rm -r {config["ploles_old_path"]}')
 logger.info('...done')
@@ -0,0 +1,227 @@
+import json
+import logging
+import numpy as np
+import os
+import pandas as pd
+import shapely
+import shutil
+import tempfile
+
+from changes import *
+from extract import Extract
+from process_one import *
+
+
+# load config file
+with open('config.json') as f:
+    config = json.load(f)
+
+# set up logging
+logger = logging.getLogger('process_all')
+logger.setLevel(logging.DEBUG if config.get('debug') else logging.INFO)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+handler = logging.FileHandler(config['logs_path'] + 'process_changes.log', mode='w')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+handler = logging.StreamHandler()
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+del handler, formatter
+if config.get('debug'):
+    logger.info('started logging in debug mode')
+else:
+    logger.info('started logging with debug mode turned off')
+
+# load regions
+regions = pd.read_csv(
+    config['regions_path'],
+    sep=',',
+    index_col=0,
+    header=0,
+    keep_default_na=False,
+    dtype={
+        'osm_id': np.int64,
+        'name': str,
+        'code': str,
+        'admin_level': np.uint8,
+        'parent_osm_id': np.int64,
+        'lon': np.float32,
+        'lat': np.float32,
+        'radius': np.float32
+    }
+)
+logger.info(f'found {len(regions)} regions')
+
+# prepare per-region logging
+region_logger = logging.getLogger('region')
+region_logger.setLevel(logging.DEBUG if config.get('debug') else logging.INFO)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+handler = logging.StreamHandler()
+handler.setFormatter(formatter)
+region_logger.addHandler(handler)
+del handler
+
+# mark parents/leaves
+regions['is_parent'] = False
+for i in regions.index:
+    parent_id = regions.loc[i, 'parent_osm_id']
+    if parent_id != 0:
+        regions.loc[parent_id, 'is_parent'] = True
+
+# get regions to process
+if config['regions_mode'] == 'include':
+    include_mask = regions['code'].isin(config['regions_codes'])
+else:  # exclude
+    include_mask = ~regions['code'].isin(config['regions_codes'])
+parent_mask = regions['is_parent']
+to_process = regions.loc[include_mask & ~parent_mask, :].index
+logger.info(f'regions to process: {len(to_process)}')
+
+# read changes
+changes = Changes()
+if config.get('changes_path'):
+    for file_name in sorted(os.listdir(config['changes_path'])):
+        changes.add_file(os.path.join(config['changes_path'], file_name))
+if config.get('changes_adiff_ids'):
+    first_id, last_id = config['changes_adiff_ids']
+    for id_ in range(first_id, last_id + 1):
+        changes.add_adiff(id_, config)
+
+# read local OSM extract (if configured)
+# note: the extract is needed for locations of changed ways/relations, thus
+#       it is read before we know which regions have changes
+if config.get('extract_path') and len(changes.objects) > 0:
+    logger.info(f'reading OSM extract {config["extract_path"]}...')
+    extract = Extract(config['extract_path'], to_process)
+    logger.info('...done')
+else:
+    extract = None
+
+changes.complete_locations(config, extract)
+relevant_locations, other_locations = changes.locations()
+logger.info(f'changed objects: {len(changes.objects)}')
+logger.info(f'changed locations: {len(relevant_locations)} relevant, {len(other_locations)} other')
+
+# note: changes influence stops within the largest matching distance, queries
+#       get an additional margin for stops extending beyond changed area
+radius = max(config['pole_stopo_dist'], config['plafo_stopo_dist'],
+             config['plafo_pole_dist'], config['station_radius'])
+margin = radius + config.get('changes_margin', 200)
+
+relevant_locations = gpd.GeoSeries(
+    [Point(lon, lat) for lon, lat in relevant_locations],
+    crs=config['lon_lat_crs']
+)
+other_locations = gpd.GeoSeries(
+    [Point(lon, lat) for lon, lat in other_locations],
+    crs=config['lon_lat_crs']
+)
+
+# find regions with changes
+# note: deleted objects in osmChange files have no location, then we have to
+#       look at all regions' exports
+unlocated = changes.unlocated()
+candidates = []
+for osm_id in to_process:
+    region = regions.loc[osm_id, :]
+    meters_crs = f'+proj=aeqd +lat_0={region["lat"]} +lon_0={region["lon"]}'
+    max_dist = region['radius'] + margin
+    if unlocated \
+    or (relevant_locations.to_crs(meters_crs).distance(Point(0, 0)) <= max_dist).any() \
+    or (other_locations.to_crs(meters_crs).distance(Point(0, 0)) <= max_dist).any():
+        candidates.append(osm_id)
+logger.info(f'regions with possible changes: {len(candidates)}')
+
+# update regions
+updated = 0
+for i, osm_id in enumerate(candidates):
+    code = regions.loc[osm_id, 'code'].lower()
+    region = regions.loc[osm_id, :]
+    config['region'] = region['name']
+    config['meters_crs'] = f'+proj=aeqd +lat_0={region["lat"]} +lon_0={region["lon"]}'
+    config['region_code'] = code
+    config['osm_id'] = osm_id
+
+    # read previous export
+    old = read_export(config)
+    if old is None:
+        logger.warning(f'no export for region {region["name"]} ({code}), run process_all.py first')
+        continue
+
+    # changed locations in region
+    geos = relevant_locations.to_crs(config['meters_crs']).to_list()
+    tree = shapely.STRtree(old['plafos'].geometry.to_list())
+    others = other_locations.to_crs(config['meters_crs'])
+    # note: other nodes (without public transport tags) are relevant only if they
+    #       may be part of some platform
+    if len(others) > 0:
+        geos.extend(others.iloc[np.unique(
+            tree.query(others.to_list(), predicate='dwithin', distance=radius)[0]
+        )].to_list())
+    for layer in ['stopos', 'poles', 'plafos', 'dubobs']:
+        mask = changes.export_mask(layer, old[layer])
+        geos.extend(old[layer].geometry[mask].to_list())
+    del tree, others
+    region_area = shapely.Point(0, 0).buffer(region['radius'] + margin)
+    geos = [geo for geo in geos if geo.intersects(region_area)]
+    if len(geos) == 0:
+        continue
+
+    # enable logging to region's log file
+    file_handler = logging.FileHandler(f'{config["logs_path"]}{code}.log', mode='a')
+    file_handler.setFormatter(formatter)
+    region_logger.addHandler(file_handler)
+
+    logger.info(f'updating region {i + 1}/{len(candidates)} ({region["name"]}, {code})...')
+    region_logger.info(f'updating region from {len(geos)} changed locations')
+
+    # clusters of changed locations and bounding boxes with margin
+    area = shapely.unary_union(shapely.buffer(geos, radius))
+    boxes = [shapely.box(*shapely.bounds(cluster)).buffer(margin, join_style=2)
+             for cluster in shapely.get_parts(area)]
+    boxes = shapely.get_parts(shapely.unary_union(boxes))  # join overlapping boxes
+    boxes = [shapely.box(*shapely.bounds(box)) for box in boxes]
+    region_logger.info(f'changed clusters: {len(shapely.get_parts(area))}, bounding boxes: {len(boxes)}')
+
+    # process bounding boxes
+    tmp_path = tempfile.mkdtemp() + '/'
+    os.mkdir(tmp_path + 'ploles/')
+    part_config = dict(config)
+    part_config['export_path'] = tmp_path
+    part_config['ploles_tmp_path'] = tmp_path + 'ploles/'
+    part_config['bboxes'] = [
+        (s, w, n, e) for w, s, e, n
+        in gpd.GeoSeries(boxes, crs=config['meters_crs']).to_crs(config['lon_lat_crs']).bounds.values
+    ]
+    # note: process() returns False if there are no objects in the boxes (for
+    #       instance, all stops removed) and raises an exception on errors
+    #       (failed Overpass requests), then we keep the previous export
+    try:
+        success = process(part_config, extract, tiles=False)
+        new = read_export(part_config) if success else empty_export(config)
+
+        # merge into previous export
+        area, _, _ = affected_area(area, old['stops'], new['stops'])
+        reliable = shapely.unary_union([box.buffer(-radius, join_style=2) for box in boxes])
+        if not area.within(reliable):
+            region_logger.warning('changed stops reach margin of bounding boxes, consider increasing changes_margin')
+        removed, added, features = merge_export(config, old, new, area, part_config)
+        region_logger.info(f'replaced {removed} stops by {added} stops')
+        if not make_tiles(config, features):
+            region_logger.error('making tiles failed, tiles of region are outdated')
+        updated += 1
+        logger.info('...done')
+    except Exception as e:
+        logger.exception(e)
+        logger.error('...failed')
+    shutil.rmtree(tmp_path)
+
+    # disable logging to region's log file
+    region_logger.removeHandler(file_handler)
+    del file_handler
+
+logger.info(f'updated regions: {updated}')
+
+# join tiles from all regions and replace tiles
+if updated > 0:
+    join_tiles(config)
@@ -1,127 +1,259 @@
+import concurrent.futures
+import glob
 import json
 import logging
+import numpy as np
 import geopandas as gpd
 import os
 import requests
 import shapely
+import subprocess
 from shapely.geometry import Point, LineString
 
+from ploles import PloleStore
 from utils import *
 
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+# note: tippecanoe layer names, base zoom, minimum zoom and maximum zoom
+tile_layers = {
+    'stops': ('a_stops', 18, 18, 19),
+    'plafos': ('b_plafos', 18, 18, 19),
+    'poles': ('c_poles', 18, 18, 19),
+    'stopos': ('d_stopos', 18, 18, 19),
+    'nstops': ('e_nstops', 11, 0, 17),
+    'dubobs': ('f_dubobs', 11, 0, 19)
+}
+
+
+def make_tiles(config, features):
+    '''
+    Make vector tiles from region's export. Features (dict mapping layers to
+    lists of GeoJSON features, see geojson_features()) are streamed to
+    tippecanoe as newline-delimited GeoJSON. Layers are processed
+    concurrently, using at most tiles_max_cpus CPUs in total. Tiles of empty
+    layers are removed. Returns False if tippecanoe failed for some layer.
+    '''
+
+    logger = logging.getLogger('region')
+    logger.info('making tiles...')
+    prefix = config['export_path'] + config['region_code'] + '_'
+    cpus = config.get('tiles_max_cpus') or os.cpu_count() or 1
+    parallel = min(len(tile_layers), cpus)
+    env = dict(os.environ, TIPPECANOE_MAX_THREADS=str(max(1, cpus // parallel)))
+
+    def run(layer):
+
+        name, base_zoom, min_zoom, max_zoom = tile_layers[layer]
+        output = f'{prefix}{layer}.mbtiles'
+        cmd = ['tippecanoe', f'--base-zoom={base_zoom}', f'--minimum-zoom={min_zoom}',
+               f'--maximum-zoom={max_zoom}', '--buffer=20', '--drop-densest-as-needed',
+               '--no-clipping', '--no-tile-compression', '--force', '-t', config['export_path'],
+               f'--layer={name}', f'--output={output}']
+        lines = features[layer]
+        if len(lines) == 0:  # tippecanoe fails without features
+            if os.path.exists(output):
+                os.remove(output)
+            return 0
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, env=env)
+        try:
+            for i in range(0, len(lines), 1000):
+                proc.stdin.write(('\n'.join(lines[i:(i + 1000)]) + '\n').encode())
+            proc.stdin.close()
+        except BrokenPipeError:  # tippecanoe failed, see exit code
+            pass
+        return proc.wait()
+
+    def run_safe(layer):
+
+        try:
+            return run(layer)
+        except OSError as e:
+            return str(e)
+
+    success = True
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as pool:
+        for layer, result in zip(tile_layers.keys(), pool.map(run_safe, tile_layers.keys())):
+            if result != 0:
+                logger.error(f'making tiles for layer {layer} failed ({result})')
+                success = False
+    logger.info('...done' if success else '...failed')
+    return success
+
+
+def join_tiles(config):
+    '''
+    Join tiles of all regions (MBTiles files in export path) and replace the
+    published tiles. With tiles_mode 'pmtiles' tiles are joined into one
+    PMTiles archive, which replaces tiles_path + 'tiles.pmtiles' by renaming
+    (atomic). Else tiles are written to a directory tree in tiles_tmp_path,
+    which replaces tiles_path. Returns False if joining failed (published
+    tiles are kept then).
+    '''
+
+    logger = logging.getLogger('process_all')
+    logger.info('joining tiles...')
+    inputs = sorted(glob.glob(config['export_path'] + '*.mbtiles'))
+    if config.get('tiles_mode', 'directory') == 'pmtiles':
+        archive = config['tiles_path'] + 'tiles.pmtiles'
+        tmp_archive = config['tiles_path'] + 'tiles.tmp.pmtiles'
+        result = subprocess.run(['tile-join', '--force', '--no-tile-compression',
+                                 f'--output={tmp_archive}'] + inputs).returncode
+        if result != 0:
+            logger.error(f'joining tiles failed (exit code {result}), keeping old tiles')
+            if os.path.exists(tmp_archive):
+                os.remove(tmp_archive)
+            return False
+        logger.info('...done')
+        logger.info('replacing tiles archive...')
+        os.replace(tmp_archive, archive)
+        logger.info('...done')
+        return True
+
+    os.system(f'mkdir {config["tiles_tmp_path"]}')
+    result = subprocess.run(['tile-join', f'--output-to-directory={config["tiles_tmp_path"]}',
+                             '--no-tile-compression'] + inputs).returncode
+    if result != 0:
+        logger.error(f'joining tiles failed (exit code {result}), keeping old tiles')
+        os.system(f'rm -r {config["tiles_tmp_path"]}')
+        return False
+    logger.info('...done')
+    logger.info('moving old tiles to temporary location...')
+    os.system(f'mv {config["tiles_path"]} {config["tiles_old_path"]}')
+    logger.info('moving new tiles to destination path...')
+    os.system(f'mv {config["tiles_tmp_path"]} {config["tiles_path"]}')
+    logger.info('removing old tiles...')
+    os.system(f'rm -r {config["tiles_old_path"]}')
+    logger.info('...done')
+    return True
 
-def process(config):
+
+def process(config, extract=None, tiles=True):
 
     logger = logging.getLogger('region') 
+    if config.get('export_parquet') and pyarrow is None:
+        raise Exception('writing GeoParquet files requires the pyarrow package')
+    overpass_cache_stats.update(hits=0, misses=0)
+    for memo in [mods_classifier.memo, track_mods_memo]:
+        memo.max_size = config.get('tag_memo_size', 100000)
+        memo.reset_stats()
 
     # -------------------------------------------------------------------------
     # get public transport related OSM objects
     
-    logger.info('sending query to overpass')
-    query = '''
-    area({osm_id})->.roi;
-    (
-        nwr["highway"~"^((bus_stop|platform);?)*$"](area.roi);
-        nwr["public_transport"~"^((stop_position|platform|station);?)*$"](area.roi);
-        nwr["amenity"~"^((bus_stop|bus_station|ferry_terminal);?)*$"](area.roi);
-        nwr["railway"~"^((platform|station|halt|stop|tram_stop);?)*$"](area.roi);
-        nwr["station"~"^((subway|light_rail|train|monorail|funicular|tram);?)*$"](area.roi);
-        nwr["aerialway"~"^((yes|station);?)*$"](area.roi);
-        nwr["share_taxi"="yes"](area.roi);
-        nwr["shared_taxi"="yes"](area.roi);
-    )->.all;
-    (
-        nw.all["access"!="private"];
-        rel.all["type"="multipolygon"];
-    );
-    out;
-
-    >;
-    out skel;
-    '''.format(osm_id=config['osm_id'] + 3600000000)
-
-    nodes, ways, rels = overpass(query, config)
-    del query
+    # note: if config contains bounding boxes (list of (south, west, north,
+    #       east) in lon/lat), only objects inside the boxes are considered
+    #       (used for incremental updates, see process_changes.py)
+    # note: locations of all nodes go to the node store, Node objects are
+    #       created for nodes with tags only
+    node_store = NodeStore()
+    if extract is None:
+        logger.info('sending query to overpass')
+        if config.get('bboxes'):
+            bboxes = ['({:.7f},{:.7f},{:.7f},{:.7f})'.format(*bbox) for bbox in config['bboxes']]
+        else:
+            bboxes = ['']
+        query = '''
+        area({osm_id})->.roi;
+        (
+            {filters}
+        )->.all;
+        (
+            nw.all["access"!="private"];
+            rel.all["type"="multipolygon"];
+        );
+        out;
+
+        >;
+        out skel;
+        '''.format(
+            osm_id=config['osm_id'] + 3600000000,
+            filters='\n            '.join([f'nwr["{key}"~"{regex}"](area.roi){bbox};'
+                                          for key, regex in pt_filters
+                                          for bbox in bboxes])
+        )
+        nodes, ways, rels = overpass(query, config, node_store=node_store)
+        del query, bboxes
+    else:
+        logger.info('reading objects from extract')
+        nodes, ways, rels = extract.region(config['osm_id'], config.get('bboxes'), node_store)
     if len(nodes) == 0 and len(ways) == 0 and len(rels) == 0:
-        logger.error('overpass did not return anything, aborting')
+        logger.error('no OSM objects found, aborting')
         return False
 
     # -------------------------------------------------------------------------
     # make areas from ways and multipolygons
 
-    nodes_dict = {n.id: n for n in nodes}
-    ways_dict = {w.id: w for w in ways}
-    areas = [Area(w, nodes_dict=nodes_dict) for w in ways] \
-            + [Area(r, nodes_dict=nodes_dict, ways_dict=ways_dict) for r in rels]
-    del nodes_dict, ways_dict
+    node_store.finalize()
+    areas = make_areas(ways, rels, node_store)
+    node_store.close()
+    del node_store
     logger.info(f'areas: {len(areas)}')
 
     # -------------------------------------------------------------------------
     # roughly classify nodes and areas by tags
 
-    stopos = []
-    poles = []
-    plafos = []
-    stations = []
+    # note: tags are converted to a table once, roles of all nodes and areas
+    #       are then determined by boolean masks over that table
+    tags = TagTable(nodes)
+    has = tags.has_tag
+    stopos_mask = has('public_transport', 'stop_position') \
+        | (has('highway', 'bus_stop') & ~has('public_transport', 'platform')) \
+        | has('amenity', 'bus_stop') \
+        | has('amenity', 'ferry_terminal') \
+        | has('railway', 'stop') \
+        | (has('railway', 'tram_stop')
+           & ~has('public_transport', 'platform')
+           & ~has('public_transport', 'station')) \
+        | has('aerialway', 'station')
+    poles_mask = has('public_transport', 'platform') \
+        | (has('highway', 'bus_stop') & ~has('public_transport', 'stop_position')) \
+        | has('amenity', 'bus_stop') \
+        | has('highway', 'platform') \
+        | has('railway', 'platform')
+    node_stations_mask = has('public_transport', 'station') \
+        | has('amenity', 'bus_station') \
+        | has('railway', 'station') \
+        | has('railway', 'halt')
+    node_dubobs_mask = (tags.tag_counts() > 0) \
+        & ~(stopos_mask | poles_mask | node_stations_mask) \
+        & ~tags.has_key_part('construction')
+
+    tags = TagTable(areas)
+    has = tags.has_tag
+    plafos_mask = has('public_transport', 'platform') \
+        | has('highway', 'bus_stop') \
+        | has('highway', 'platform') \
+        | has('amenity', 'bus_stop') \
+        | has('railway', 'platform') \
+        | has('amenity', 'ferry_terminal')
+    area_stations_mask = has('public_transport', 'station') \
+        | has('amenity', 'bus_station') \
+        | has('railway', 'station') \
+        | has('railway', 'halt') \
+        | has('aerialway', 'station')
+    area_dubobs_mask = (tags.tag_counts() > 0) \
+        & ~(plafos_mask | area_stations_mask) \
+        & ~tags.has_key_part('construction')
+
+    stopos = [nodes[i] for i in np.flatnonzero(stopos_mask)]
+    poles = [nodes[i] for i in np.flatnonzero(poles_mask)]
+    plafos = [areas[i] for i in np.flatnonzero(plafos_mask)]
+    stations = [nodes[i] for i in np.flatnonzero(node_stations_mask)] \
+        + [areas[i] for i in np.flatnonzero(area_stations_mask)]
     dubobs = []
-
-    for n in nodes:
-        if len(n.tags) == 0:
-            continue
-        dubious = True
-        if n.has_tag('public_transport', 'stop_position') \
-        or (n.has_tag('highway', 'bus_stop')
-            and not n.has_tag('public_transport', 'platform')) \
-        or n.has_tag('amenity', 'bus_stop') \
-        or n.has_tag('amenity', 'ferry_terminal') \
-        or n.has_tag('railway', 'stop') \
-        or (n.has_tag('railway', 'tram_stop') \
-            and not n.has_tag('public_transport', 'platform')
-            and not n.has_tag('public_transport', 'station')) \
-        or n.has_tag('aerialway', 'station'):
-            stopos.append(n)
-            dubious = False
-        if n.has_tag('public_transport', 'platform') \
-        or (n.has_tag('highway', 'bus_stop')
-            and not n.has_tag('public_transport', 'stop_position')) \
-        or n.has_tag('amenity', 'bus_stop') \
-        or n.has_tag('highway', 'platform') \
-        or n.has_tag('railway', 'platform'):
-            poles.append(n)
-            dubious = False
-        if n.has_tag('public_transport', 'station') \
-        or n.has_tag('amenity', 'bus_station') \
-        or n.has_tag('railway', 'station') \
-        or n.has_tag('railway', 'halt'):
-            stations.append(n)
-            dubious = False
-        if dubious and not any(['construction' in k for k in n.tags.keys()]):
-            n.warning('node somehow related to public transport, but how?')
-            dubobs.append(n)
-
-    for a in areas:
-        if len(a.tags) == 0:
-            continue
-        dubious = True
-        if a.has_tag('public_transport', 'platform') \
-        or a.has_tag('highway', 'bus_stop') \
-        or a.has_tag('highway', 'platform') \
-        or a.has_tag('amenity', 'bus_stop') \
-        or a.has_tag('railway', 'platform') \
-        or a.has_tag('amenity', 'ferry_terminal'):
-            plafos.append(a)
-            dubious = False
-        if a.has_tag('public_transport', 'station') \
-        or a.has_tag('amenity', 'bus_station') \
-        or a.has_tag('railway', 'station') \
-        or a.has_tag('railway', 'halt') \
-        or a.has_tag('aerialway', 'station'):
-            stations.append(a)
-            dubious = False
-        if dubious and not any(['construction' in k for k in a.tags.keys()]):
-            a.warning('area somehow related to public transport, but how?')
-            dubobs.append(a)
-
-    del dubious, nodes
+    for i in np.flatnonzero(node_dubobs_mask):
+        nodes[i].warning('node somehow related to public transport, but how?')
+        dubobs.append(nodes[i])
+    for i in np.flatnonzero(area_dubobs_mask):
+        areas[i].warning('area somehow related to public transport, but how?')
+        dubobs.append(areas[i])
+
+    del tags, has, nodes
     logger.info(f'stop positions: {len(stopos)}')
     logger.info(f'poles: {len(poles)}')
     logger.info(f'platforms: {len(plafos)}')
@@ -146,14 +278,8 @@ def process(config):
     ).set_index('id').to_crs(config['meters_crs'])
 
     plafos = gpd.GeoDataFrame(
-        # note: shapely.unary_union is optional
-        #       (joins adjacent polygons to one polygon)
-        data = [[
-            a.id,
-            a.geometry if a.from_line \
-                else shapely.unary_union(shapely.polygonize(a.geometry)),
-            a
-        ] for a in plafos],
+        # note: polygons of areas are precomputed (see make_areas())
+        data = [[a.id, a.geometry, a] for a in plafos],
         columns = ('id', 'geo', 'obj'),
         crs = config['lon_lat_crs'],
         geometry = 'geo'
@@ -191,12 +317,7 @@ def process(config):
         if station.type == 'node':
             geos.append(Point(station.lon, station.lat))
         else:
-            if station.from_line:
-                geos.append(station.geometry)
-            else:
-                # note: shapely.unary_union is optional
-                #       (joins adjacent polygons to one polygon)
-                geos.append(shapely.unary_union(shapely.polygonize(station.geometry)))
+            geos.append(station.geometry)
 
     stations = gpd.GeoDataFrame(
         data = [[geo, obj] for geo, obj in zip(geos, stations)],
@@ -220,125 +341,108 @@ def process(config):
     # -------------------------------------------------------------------------
     # add modalities
     for df in [stopos, poles, plafos, stations]:
-        df['tag_mods'] = [set() for _ in df.index]
-        df['tag_maybe_mods'] = [set() for _ in df.index]
-        for mod, mod_props in mods_props.items():
-            is_mod = df['obj'].apply(mod_props['is_func'])
-            df.loc[is_mod == 1, 'tag_mods'].apply(add_mods, args=({mod}, ))
-            df.loc[is_mod == 0, 'tag_maybe_mods'].apply(add_mods, args=({mod}, ))   
+        yes_bits, maybe_bits = mods_classifier.classify_all(df['obj'])
+        df['tag_mods'] = yes_bits
+        df['tag_maybe_mods'] = maybe_bits
             
     
     #-------------------------------------------------------------------------
     # get track types for stopos and poles
 
-    track_keys = {key for mod_props in mods_props.values()
-                    for key in mod_props['track_tags']}
+    # fetch ways for stopos and poles at once
+    node_ids = stopos.index.union(poles.index)
+    if len(node_ids) == 0:
+        ways = []
+    elif extract is not None:
+        ways = extract.track_ways(node_ids)
+    else:
+        ways = overpass_track_ways(node_ids, config)
+
+    # assign modalities to ways (as bit masks)
+    ways_bits = [track_mods_memo.get(w, way_track_mods) for w in ways]
+
+    # inverted index: node ID -> incident ways (in order of ways)
+    # note: one pass over all way-node references, ways containing a node
+    #       multiple times (closed ways) are listed only once
+    node_ids = set(node_ids)
+    node_ways = {}
+    for i, w in enumerate(ways):
+        for n_id in set(w.node_ids).intersection(node_ids):
+            node_ways.setdefault(n_id, []).append(i)
+    del node_ids
+
+    # assign ways to nodes
     for df in [stopos, poles]:
-
-        # fetch all ways
-        if len(df) > 0:
-            query = '''
-            node(id: {node_ids});
-            way(bn)->.all;
-            ({way_filters});
-            out;
-            '''.format(
-                node_ids=','.join([str(id_) for id_ in df.index]),
-                way_filters='\n'.join([f'way.all[{key}];' for key in track_keys])
-            )
-            _, ways, _ = overpass(query, config)
-        else:
-            ways = []
-
-        # assign modalities to ways
-        ways_mods = [set() for _ in range(len(ways))]
-        for mod, mod_props in mods_props.items():
-            for w, w_mods in zip(ways, ways_mods):
-                # note: We have to test for multi-modality tracks via modality flag
-                #       tags. But for ways with highway=platform (and some other)
-                #       flags might be set although it's not a way for such
-                #       vehicles. Thus, we avoid flag tag checking in such cases.
-                if w.has_tag(mod, 'yes') \
-                and not w.has_tag('highway', 'platform') \
-                and not w.has_tag('railway', 'platform') \
-                and not w.has_tag('public_transport', 'platform'):
-                    w_mods.add(mod)
-                    continue
-                if w.has_tag(mod, 'no'):
-                    continue
-                for key, values in mod_props['track_tags'].items():
-                    if any([w.has_tag(key, value) for value in values]):
-                        w_mods.add(mod)
-                        break
-                    if w.has_tag(key, 'construction') \
-                    and any([w.has_tag('construction', value) for value in values]):
-                        w_mods.add(mod)
-                        break
-            
-        # assign ways to nodes
-        df['track_mods'] = [set() for _ in df.index]
-        for w, w_mods in zip(ways, ways_mods):
-            for n_id in df.index.intersection(w.node_ids):
-                df.loc[n_id, 'track_mods'].update(w_mods)
-                if w.tags.get('layer'):
-                    if 'layer' not in df.loc[n_id, 'obj'].tags:
-                        df.loc[n_id, 'obj'].tags['layer'] = w.tags.get('layer')
-                    else: # belongs to multiple layers
-                        layers = df.loc[n_id, 'obj'].tags['layer'].split(';') + w.tags['layer'].split(';')
-                        layers = set(layers)
-                        if len(layers) > 0:
-                            df.loc[n_id, 'obj'].multiple_values = True
-                        df.loc[n_id, 'obj'].tags['layer'] = ';'.join(layers)
-                if w.tags.get('level'):
-                    if 'level' not in df.loc[n_id, 'obj'].tags:
-                        df.loc[n_id, 'obj'].tags['level'] = w.tags.get('level')
-                    else: # belongs to multiple levels
-                        levels = df.loc[n_id, 'obj'].tags['level'].split(';') + w.tags['level'].split(';')
-                        levels = set(levels)
-                        if len(levels) > 0:
-                            df.loc[n_id, 'obj'].multiple_values = True
-                        df.loc[n_id, 'obj'].tags['level'] = ';'.join(levels)
-
-    del ways, ways_mods
+        track_mods = []
+        for n_id, obj in zip(df.index, df['obj']):
+            bits = 0
+            for i in node_ways.get(n_id, []):
+                w = ways[i]
+                bits |= ways_bits[i]
+                for key in ('layer', 'level'):
+                    value = w.tags.get(key)
+                    if not value:
+                        continue
+                    if key not in obj.tags:
+                        obj.set_tag(key, value)
+                    else:  # belongs to multiple layers/levels
+                        values = set(obj.tags[key].split(';') + value.split(';'))
+                        obj.multiple_values = True
+                        obj.set_tag(key, ';'.join(values))
+            track_mods.append(bits)
+        df['track_mods'] = np.array(track_mods, dtype=np.int64)
+
+    del ways, ways_bits, node_ways
+
+    if config.get('overpass_cache_path'):
+        logger.info(f'overpass cache: {overpass_cache_stats["hits"]} hits, {overpass_cache_stats["misses"]} misses')
+        overpass_cache_evict(config)
+    logger.info(f'tag memo for stop modalities: {mods_classifier.memo.stats()}')
+    logger.info(f'tag memo for track modalities: {track_mods_memo.stats()}')
 
     # -------------------------------------------------------------------------
     # remove modalities from stopos if not on corresponding track
 
-    pole_ids = []  # dropped stopos that are in poles data frame
-    to_dubobs_ids = []  # dropped stopos that are not in poles data frame
-
-    stopos['mods'] = [set() for _ in stopos.index]
-
-    for id_ in stopos.index:
-        tag_mods = stopos.loc[id_, 'tag_mods']
-        tag_maybe_mods = stopos.loc[id_, 'tag_maybe_mods']
-        track_mods = stopos.loc[id_, 'track_mods']
-        mods = stopos.loc[id_, 'mods']
-        obj = stopos.loc[id_, 'obj']
-        if track_mods == set():
-            if id_ in poles.index:
-                obj.comment(f'looking at tags only, node could be a stop position for {mods2str(tag_mods | tag_maybe_mods)}, but is not on suitable track')
-                pole_ids.append(id_)
-            elif tag_mods == set():
-                if tag_maybe_mods == set():
-                    obj.warning(f'node tagged as stop position but neither has modality tags nor is on any relevant track')
-                    to_dubobs_ids.append(id_)
-                else:
-                    obj.warning(f'node tagged as stop position with ambiguous modalities {mods2str(tag_maybe_mods)}, but node is not on any relevant track')
-                    to_dubobs_ids.append(id_)
-            else:  # there are modality tags
-                obj.warning(f'node is tagged as stop position for {mods2str(tag_mods)}, but is not on any relevant track')
-                to_dubobs_ids.append(id_)
-        else:  # node is on some track
-            all_tag_mods = tag_mods | tag_maybe_mods
-            if all_tag_mods == set():
-                mods.update(track_mods - {'trolleybus', 'share_taxi'})
-                obj.warning(f'stop position without modality tags, assuming {mods2str(mods)} because node is on suitable track')
-            else:  # there are tagged mods
-                mods.update(all_tag_mods & track_mods)
-                if mods == set():
-                    obj.warning(f'stop position for which tagged modalities {mods2str(all_tag_mods)} do not match track modalities {mods2str(track_mods)}')
-                    to_dubobs_ids.append(id_)
+    tag_mods = stopos['tag_mods'].to_numpy()
+    tag_maybe_mods = stopos['tag_maybe_mods'].to_numpy()
+    track_mods = stopos['track_mods'].to_numpy()
+    all_tag_mods = tag_mods | tag_maybe_mods
+    on_track = track_mods != 0
+    # note: without modality tags stopos get all track modalities except for
+    #       modalities requiring explicit tagging
+    stopos['mods'] = np.where(
+        all_tag_mods == 0,
+        track_mods & ~(mod_bits['trolleybus'] | mod_bits['share_taxi']),
+        all_tag_mods & track_mods
+    )
+    mods = stopos['mods'].to_numpy()
+    objs = stopos['obj'].to_numpy()
+
+    # node is not on any track
+    pole_mask = ~on_track & stopos.index.isin(poles.index)
+    for obj, obj_mods in zip(objs[pole_mask], all_tag_mods[pole_mask]):
+        obj.comment(f'looking at tags only, node could be a stop position for {mods2str(obj_mods)}, but is not on suitable track')
+    mask = ~on_track & ~pole_mask & (all_tag_mods == 0)
+    for obj in objs[mask]:
+        obj.warning(f'node tagged as stop position but neither has modality tags nor is on any relevant track')
+    mask = ~on_track & ~pole_mask & (tag_mods == 0) & (tag_maybe_mods != 0)
+    for obj, obj_maybe_mods in zip(objs[mask], tag_maybe_mods[mask]):
+        obj.warning(f'node tagged as stop position with ambiguous modalities {mods2str(obj_maybe_mods)}, but node is not on any relevant track')
+    mask = ~on_track & ~pole_mask & (tag_mods != 0)
+    for obj, obj_mods in zip(objs[mask], tag_mods[mask]):
+        obj.warning(f'node is tagged as stop position for {mods2str(obj_mods)}, but is not on any relevant track')
+
+    # node is on some track
+    mask = on_track & (all_tag_mods == 0)
+    for obj, obj_mods in zip(objs[mask], mods[mask]):
+        obj.warning(f'stop position without modality tags, assuming {mods2str(obj_mods)} because node is on suitable track')
+    mismatch_mask = on_track & (all_tag_mods != 0) & (mods == 0)
+    for obj, obj_mods, obj_track_mods in zip(objs[mismatch_mask], all_tag_mods[mismatch_mask], track_mods[mismatch_mask]):
+        obj.warning(f'stop position for which tagged modalities {mods2str(obj_mods)} do not match track modalities {mods2str(obj_track_mods)}')
+
+    pole_ids = stopos.index[pole_mask].to_list()  # dropped stopos that are in poles data frame
+    to_dubobs_ids = stopos.index[(~on_track & ~pole_mask) | mismatch_mask].to_list()  # dropped stopos that are not in poles data frame
+    del tag_mods, tag_maybe_mods, track_mods, all_tag_mods, on_track, mods, objs, mask, pole_mask, mismatch_mask
 
     # remove invalid stopos
     dubobs.extend(stopos.loc[to_dubobs_ids, 'obj'].to_list())
@@ -350,40 +454,31 @@ def process(config):
     # -------------------------------------------------------------------------
     # remove modalities from poles if on corresponding track
 
-    to_dubobs_ids = []  # dropped poles
-
-    stopo_ids = []  # dropped poles that are in stopos data frame
-    poles['mods'] = [set() for _ in poles.index]
-    poles['maybe_mods'] = [set() for _ in poles.index]
-
-    for id_ in poles.index:
-        tag_mods = poles.loc[id_, 'tag_mods']
-        tag_maybe_mods = poles.loc[id_, 'tag_maybe_mods']
-        track_mods = poles.loc[id_, 'track_mods']
-        mods = poles.loc[id_, 'mods']
-        maybe_mods = poles.loc[id_, 'maybe_mods']
-        obj = poles.loc[id_, 'obj']
-
-        mods.update(tag_mods)
-        on_track_mods = tag_mods & track_mods
-        if len(on_track_mods) > 0:
-            obj.comment(f'from tags only node looks like a pole for {mods2str(on_track_mods)}, but node is on track, not beside')
-            mods.difference_update(on_track_mods)
-            
-        maybe_mods.update(tag_maybe_mods)
-        on_track_mods = tag_maybe_mods & track_mods
-        if len(on_track_mods) > 0:
-            obj.comment(f'from tags only node could be a pole for {mods2str(on_track_mods)}, but node is on track, not beside')
-            maybe_mods.difference_update(on_track_mods)
-
-        if len(mods) == 0 and len(maybe_mods) == 0:
-            if id_ in stopos.index:
-                stopo_ids.append(id_)
-            else:
-                obj.warning('pole without modalities')
-                to_dubobs_ids.append(id_)
-        elif len(mods) == 0:
-            obj.comment('pole with ambiguous modality tags')
+    tag_mods = poles['tag_mods'].to_numpy()
+    tag_maybe_mods = poles['tag_maybe_mods'].to_numpy()
+    track_mods = poles['track_mods'].to_numpy()
+    poles['mods'] = tag_mods & ~track_mods
+    poles['maybe_mods'] = tag_maybe_mods & ~track_mods
+    objs = poles['obj'].to_numpy()
+
+    on_track_mods = tag_mods & track_mods
+    mask = on_track_mods != 0
+    for obj, obj_mods in zip(objs[mask], on_track_mods[mask]):
+        obj.comment(f'from tags only node looks like a pole for {mods2str(obj_mods)}, but node is on track, not beside')
+    on_track_mods = tag_maybe_mods & track_mods
+    mask = on_track_mods != 0
+    for obj, obj_mods in zip(objs[mask], on_track_mods[mask]):
+        obj.comment(f'from tags only node could be a pole for {mods2str(obj_mods)}, but node is on track, not beside')
+
+    no_mods_mask = (poles['mods'] == 0) & (poles['maybe_mods'] == 0)
+    stopo_mask = no_mods_mask & poles.index.isin(stopos.index)
+    stopo_ids = poles.index[stopo_mask].to_list()  # dropped poles that are in stopos data frame
+    to_dubobs_ids = poles.index[no_mods_mask & ~stopo_mask].to_list()  # dropped poles
+    for obj in objs[no_mods_mask & ~stopo_mask]:
+        obj.warning('pole without modalities')
+    for obj in objs[(poles['mods'] == 0) & ~no_mods_mask]:
+        obj.comment('pole with ambiguous modality tags')
+    del tag_mods, tag_maybe_mods, track_mods, on_track_mods, objs, mask, no_mods_mask, stopo_mask
 
     # remove invalid poles
     dubobs.extend(poles.loc[to_dubobs_ids, 'obj'].to_list())
@@ -420,207 +515,161 @@ def process(config):
     # -------------------------------------------------------------------------
     # assign stopos to poles/plafos (=ploles)
 
-    def mods_stopos_to_ploles(plole_mods, plole_maybe_mods, stopo):
-        stopo_mods = stopo['mods']
-        if (plole_mods | plole_maybe_mods) & stopo_mods != set():
-            return True
-        else:
-            return False
-        
-    def score_stopos_to_ploles(plole, stopo):
-        matches = []
-        keys = plole.tags.keys() & stopo.tags.keys()
-        if 'ref:IFOPT' in keys:
-            if stopo.tags['ref:IFOPT'] in plole.tags['ref:IFOPT'] \
-            or plole.tags['ref:IFOPT'] in stopo.tags['ref:IFOPT']:
-                matches.append(1)
-            else:
-                matches.append(-1)
-        else:
-            matches.append(0)
-        if 'ref' in keys:
-            if stopo.has_tag('ref', plole.tags['ref']) \
-            or plole.has_tag('ref', stopo.tags['ref']):
-                matches.append(1)
-            else:
-                matches.append(-1)
-        else:
-            matches.append(0)
-        if 'local_ref' in keys:
-            if stopo.has_tag('local_ref', plole.tags['local_ref']) \
-            or plole.has_tag('local_ref', stopo.tags['local_ref']):
-                matches.append(1)
-            else:
-                matches.append(-1)
-        else:
-            matches.append(0)
-        if 'ref_name' in keys:
-            if stopo.tags['ref_name'] in plole.tags['ref_name'] \
-            or plole.tags['ref_name'] in stopo.tags['ref_name']:
-                matches.append(1)
-            else:
-                matches.append(-1)
-        else:
-            matches.append(0)
-        if 'name' in keys:
-            if stopo.tags['name'] in plole.tags['name'] \
-            or plole.tags['name'] in stopo.tags['name']:
-                matches.append(1)
-            else:
-                matches.append(-1)
-        else:
-            matches.append(0)
-        layers = set(stopo.tags.get('layer', '0').split(';')) & set(plole.tags.get('layer', '0').split(';'))
-        if 'layer' in keys:
+    # note: tags relevant for matching are extracted once per data frame and
+    #       shared by all matching passes
+    stopos_tags = MatchTags(stopos['obj'])
+    poles_tags = MatchTags(poles['obj'])
+    plafos_tags = MatchTags(plafos['obj'])
+
+    def mods_stopos_to_ploles(plole_mods, plole_maybe_mods, stopo_mods, stopo_maybe_mods):
+        # note: arguments are arrays of modality bit masks
+        return (plole_mods | plole_maybe_mods) & stopo_mods != 0
+
+    # tag matchers (-1 = mismatch, 0 = unknown, 1 = match) for each match key,
+    # arguments are tag values or None if tag is missing
+
+    def if_both(matcher):
+        return lambda a, b: 0 if a is None or b is None else matcher(a, b)
+
+    def match_layers(a, b):
+        layers = set(('0' if a is None else a).split(';')) & set(('0' if b is None else b).split(';'))
+        if a is not None and b is not None:
             if layers == set():
-                matches.append(0) # both have layer tag (then != 0), but layers differ
+                return 0 # both have layer tag (then != 0), but layers differ
             else:
-                matches.append(1) # both have layer tag (then != 0), common layer
+                return 1 # both have layer tag (then != 0), common layer
         else:
             if layers == set():
-                matches.append(-1) # only one has layer tag
+                return -1 # only one has layer tag
             else:
-                matches.append(0) # both without layer tag (only 0 in intersection)
-        levels = set(stopo.tags.get('level', '0').split(';')) & set(plole.tags.get('level', '0').split(';'))
+                return 0 # both without layer tag (only 0 in intersection)
+
+    def match_levels(a, b):
+        levels = set(('0' if a is None else a).split(';')) & set(('0' if b is None else b).split(';'))
         if levels != set():
             if '0' in levels:
-                matches.append(0)
+                return 0
             else:
-                matches.append(1)
+                return 1
         else:
-            matches.append(-1)
-        return matches
+            return -1
 
-    get_nearby_nodes(stopos, poles, 'stopo', config['pole_stopo_dist'],
-                    mods_stopos_to_ploles, score_stopos_to_ploles)
+    def match_substring(plole, stopo):
+        return 1 if stopo in plole or plole in stopo else -1
 
-    get_nearby_nodes(stopos, plafos, 'stopo', config['plafo_stopo_dist'],
-                    mods_stopos_to_ploles, score_stopos_to_ploles)
+    def match_value(plole, stopo):
+        return 1 if has_value(stopo, plole) or has_value(plole, stopo) else -1
+
+    stopos_to_ploles_matchers = [
+        if_both(match_substring),  # ref:IFOPT
+        if_both(match_value),  # ref
+        if_both(match_value),  # local_ref
+        if_both(match_substring),  # ref_name
+        if_both(match_substring),  # name
+        match_layers,
+        match_levels
+    ]
+
+    get_nearby_nodes(stopos, poles, 'stopo', config['pole_stopo_dist'], mods_stopos_to_ploles,
+                     lambda i_poles, i_stopos: poles_tags.match(stopos_tags, i_poles, i_stopos,
+                                                                stopos_to_ploles_matchers))
+
+    get_nearby_nodes(stopos, plafos, 'stopo', config['plafo_stopo_dist'], mods_stopos_to_ploles,
+                     lambda i_plafos, i_stopos: plafos_tags.match(stopos_tags, i_plafos, i_stopos,
+                                                                  stopos_to_ploles_matchers))
 
     # -------------------------------------------------------------------------
     # assign poles to plafos
 
-    def mods_poles_to_plafos(plafo_mods, plafo_maybe_mods, pole):
-        pole_mods = pole['mods']
-        pole_maybe_mods = pole['maybe_mods']
+    def mods_poles_to_plafos(plafo_mods, plafo_maybe_mods, pole_mods, pole_maybe_mods):
+        # note: arguments are arrays of modality bit masks
         plafo_all_mods = plafo_mods | plafo_maybe_mods
-        if (pole_mods != set() and pole_mods <= plafo_all_mods) \
-        or (pole_mods == set() and pole_maybe_mods & plafo_all_mods != set()):
-            return True
-        else:
-            return False
+        return ((pole_mods != 0) & (pole_mods & ~plafo_all_mods == 0)) \
+            | ((pole_mods == 0) & (pole_maybe_mods & plafo_all_mods != 0))
+
+    poles_to_plafos_matchers = [
+        # note: pole IFOPT may be longer than plafo IFOPT if plafo is used for
+        #       multiple poles
+        if_both(lambda plafo, pole: 1 if plafo in pole else -1),  # ref:IFOPT
+        # note: plafo may have multiple ref values if plafo is used for
+        #       multiple poles
+        if_both(lambda plafo, pole: 1 if has_value(plafo, pole) else -1),  # ref
+        if_both(lambda plafo, pole: 1 if has_value(plafo, pole) else -1),  # local_ref
+        if_both(lambda plafo, pole: 1 if plafo in pole else -1),  # ref_name
+        if_both(lambda plafo, pole: 1 if plafo in pole else -1),  # name
+        match_layers,
+        match_levels
+    ]
+
+    get_nearby_nodes(poles, plafos, 'pole', config['plafo_pole_dist'], mods_poles_to_plafos,
+                     lambda i_plafos, i_poles: plafos_tags.match(poles_tags, i_plafos, i_poles,
+                                                                 poles_to_plafos_matchers))
+    del stopos_tags, poles_tags, plafos_tags
 
-    def score_poles_to_plafos(plafo, pole):
-        matches = []
-        keys = plafo.tags.keys() & pole.tags.keys()
-        if 'ref:IFOPT' in keys:
-            # note: pole IFOPT may be longer than plafo IFOPT if plafo is used for
-            #       multiple poles
-            if plafo.tags['ref:IFOPT'] in pole.tags['ref:IFOPT']:
-                matches.append(1)
-            else:
-                matches.append(-1)
-        else:
-            matches.append(0)
-        if 'ref' in keys:
-            # note: plafo may have multiple ref values if plafo is used for
-            #       multiple poles
-            if plafo.has_tag('ref', pole.tags['ref']):
-                matches.append(1)
-            else:
-                matches.append(-1)
-        else:
-            matches.append(0)
-        if 'local_ref' in keys:
-            if plafo.has_tag('local_ref', pole.tags['local_ref']):
-                matches.append(1)
-            else:
-                matches.append(-1)
-        else:
-            matches.append(0)
-        if 'ref_name' in keys:
-            if plafo.tags['ref_name'] in pole.tags['ref_name']:
-                matches.append(1)
-            else:
-                matches.append(-1)
-        else:
-            matches.append(0)
-        if 'name' in keys:
-            if plafo.tags['name'] in pole.tags['name']:
-                matches.append(1)
-            else:
-                matches.append(-1)
-        else:
-            matches.append(0)
-        layers = set(plafo.tags.get('layer', '0').split(';')) & set(pole.tags.get('layer', '0').split(';'))
-        if 'layer' in keys:
-            if layers == set():
-                matches.append(0) # both have layer tag (then != 0), but layers differ
-            else:
-                matches.append(1) # both have layer tag (then != 0), common layer
-        else:
-            if layers == set():
-                matches.append(-1) # only one has layer tag
-            else:
-                matches.append(0) # both without layer tag (only 0 in intersection)
-        levels = set(plafo.tags.get('level', '0').split(';')) & set(pole.tags.get('level', '0').split(';'))
-        if levels != set():
-            if '0' in levels:
-                matches.append(0)
-            else:
-                matches.append(1)
-        else:
-            matches.append(-1)
-        return matches
-
-    get_nearby_nodes(poles, plafos, 'pole', config['plafo_pole_dist'],
-                    mods_poles_to_plafos, score_poles_to_plafos)    
-    
     # -------------------------------------------------------------------------
     # make ploles
 
-    poles['has_plafo'] = False  # True, if pole is in plole with plafo
-    plafos['has_poles'] = False  # True, if plafo is in plole with pole
-
-    ploles = {'plafo_id': [], 'pole_id': [], 'mods': [], 'maybe_mods': [],
-            'stopo_ids': [], 'stopo_infos': []}
-
     # ploles for plafo-pole combinations
-    for plafo_id in plafos.index:
-        plafo = plafos.loc[plafo_id, :]
-        weight = 1 if len(plafo['pole_ids']) == 1 else 0.5  # for averaging scores
-        for pole_id in plafo['pole_ids']:
-            pole = poles.loc[pole_id, :]
-            if pole['has_plafo']:
-                pole['obj'].warning(f'Pole is already assigned to a platform. Cannot assign pole to platform {plafo_id}.')
-                continue
-
-            # combine mods
-            mods = (plafo['mods'] & (pole['mods'] | pole['maybe_mods'])) \
-                | (pole['mods'] & (plafo['mods'] | plafo['maybe_mods']))
-            maybe_mods = plafo['maybe_mods'] & pole['maybe_mods']
-
-            # intersect stopo sets and average stopo scores
-            stopo_ids = []
-            stopo_infos = {}
-            for id_ in set(plafo['stopo_ids']) & set(pole['stopo_ids']):
-                stopo_ids.append(id_)
-                score = weight * plafo['stopo_infos'][id_]['score'] \
-                        + (1 - weight) * pole['stopo_infos'][id_]['score']
-                stopo_infos[id_] = {'score': score, 'mods_match': True}
-
-            # sort stopos by score
-            stopo_ids.sort(key=lambda id_: stopo_infos[id_]['score'], reverse=True)
-
-            # create plole
-            poles.loc[pole_id, 'has_plafo'] = True
-            plafos.loc[plafo_id, 'has_poles'] = True
-            ploles['plafo_id'].append(plafo_id)
-            ploles['pole_id'].append(pole_id)
-            ploles['mods'].append(mods)
-            ploles['maybe_mods'].append(maybe_mods)
-            ploles['stopo_ids'].append(stopo_ids)
-            ploles['stopo_infos'].append(stopo_infos)
+    # note: a pole belongs to the first plafo (in order of plafos) listing it
+    pairs = plafos['pole_ids'].explode().dropna()
+    pairs = gpd.pd.DataFrame({
+        'plafo_id': pairs.index.to_numpy(),
+        'pole_id': pairs.to_numpy(dtype=np.int64)
+    })
+    taken_mask = pairs['pole_id'].duplicated().to_numpy()
+    for plafo_id, pole_obj in zip(pairs.loc[taken_mask, 'plafo_id'],
+                                  poles.loc[pairs.loc[taken_mask, 'pole_id'], 'obj']):
+        pole_obj.warning(f'Pole is already assigned to a platform. Cannot assign pole to platform {plafo_id}.')
+    pairs = pairs.loc[~taken_mask, :].reset_index(drop=True)
+    del taken_mask
+    poles['has_plafo'] = poles.index.isin(pairs['pole_id'])  # True, if pole is in plole with plafo
+    plafos['has_poles'] = plafos.index.isin(pairs['plafo_id'])  # True, if plafo is in plole with pole
+    pair_plafos = plafos.loc[pairs['plafo_id'], :]
+    pair_poles = poles.loc[pairs['pole_id'], :]
+
+    # combine mods
+    plafo_mods = pair_plafos['mods'].to_numpy()
+    plafo_maybe_mods = pair_plafos['maybe_mods'].to_numpy()
+    pole_mods = pair_poles['mods'].to_numpy()
+    pole_maybe_mods = pair_poles['maybe_mods'].to_numpy()
+    pairs['mods'] = (plafo_mods & (pole_mods | pole_maybe_mods)) \
+                    | (pole_mods & (plafo_mods | plafo_maybe_mods))
+    pairs['maybe_mods'] = plafo_maybe_mods & pole_maybe_mods
+    del plafo_mods, plafo_maybe_mods, pole_mods, pole_maybe_mods
+
+    # intersect stopo sets and average stopo scores
+    # note: table of (pair, stopo) combinations, stopos of a pair in order of
+    #       set intersection (relevant for equal scores only)
+    pair_idx = []
+    stopo_ids = []
+    plafo_scores = []
+    pole_scores = []
+    for i, plafo_stopo_ids, plafo_infos, pole_stopo_ids, pole_infos in zip(
+        range(len(pairs)),
+        pair_plafos['stopo_ids'], pair_plafos['stopo_infos'],
+        pair_poles['stopo_ids'], pair_poles['stopo_infos']
+    ):
+        for id_ in set(plafo_stopo_ids) & set(pole_stopo_ids):
+            pair_idx.append(i)
+            stopo_ids.append(id_)
+            plafo_scores.append(plafo_infos[id_]['score'])
+            pole_scores.append(pole_infos[id_]['score'])
+    pair_idx = np.array(pair_idx, dtype=np.int64)
+    weights = np.where(pair_plafos['pole_ids'].apply(len).to_numpy() == 1, 1, 0.5)[pair_idx]  # for averaging scores
+    scores = (weights * np.array(plafo_scores, dtype=float)
+              + (1 - weights) * np.array(pole_scores, dtype=float)).tolist()
+    stopo_infos = [{} for _ in pairs.index]
+    for i, id_, score in zip(pair_idx.tolist(), stopo_ids, scores):
+        stopo_infos[i][id_] = {'score': score, 'mods_match': True}
+    pairs['stopo_infos'] = stopo_infos
+
+    # sort stopos by score
+    order = np.lexsort((-np.array(scores, dtype=float), pair_idx))
+    stopo_ids = np.array(stopo_ids, dtype=np.int64)[order].tolist()
+    bounds = np.cumsum(np.bincount(pair_idx, minlength=len(pairs))).tolist()
+    pairs['stopo_ids'] = [stopo_ids[start:end] for start, end in zip([0] + bounds[:-1], bounds)]
+    del pair_plafos, pair_poles, pair_idx, stopo_ids, stopo_infos, plafo_scores, pole_scores, \
+        weights, scores, order, bounds
 
     # make ploles data frame including pole-only and plafo-only ploles
     cols = ['mods', 'maybe_mods', 'stopo_ids', 'stopo_infos']
@@ -630,60 +679,59 @@ def process(config):
     plafo_ploles = plafos.loc[~plafos['has_poles'], cols]
     plafo_ploles = plafo_ploles.reset_index(names='plafo_id')
     plafo_ploles['pole_id'] = 0
-    # if ploles dict is empty, then ploles data frame will have float as default
-    # dtype (data frame created from empty lists) resulting in float pole and
-    # platform IDs; avoid creating empty data frames
-    if len(ploles['pole_id']) > 0:
-        dfs = (gpd.pd.DataFrame(ploles), pole_ploles, plafo_ploles)
+    # if there are no plafo-pole combinations, then the pairs data frame has
+    # float as default dtype resulting in float pole and platform IDs; avoid
+    # concatenating empty data frames
+    if len(pairs) > 0:
+        dfs = (pairs, pole_ploles, plafo_ploles)
     else:
         dfs = (pole_ploles, plafo_ploles)
     ploles = gpd.pd.concat(dfs, ignore_index=True)
+    del pairs
 
     # -------------------------------------------------------------------------
     # make stops
 
-    stopos['in_stop'] = False
-
-    stops = {'plole_id': [], 'plafo_id': [], 'pole_id': [], 'stopo_id': [], 'stopo_reason': []}
-
-    len_stopo_ids = ploles['stopo_ids'].apply(len)
+    # note: stopos are assigned to ploles by scanning the table of (plole,
+    #       stopo) candidates, stop IDs are positions in the stop lists
+    stops = {'plole_id': [], 'stopo_id': [], 'stopo_reason': []}
+    ploles_stopo_ids = ploles['stopo_ids'].to_list()
+    ploles_stopo_infos = ploles['stopo_infos'].to_list()
+    ploles_mods = ploles['mods'].to_list()
+    stopos_mods = dict(zip(stopos.index, stopos['mods']))
+    in_stop = set()  # stopos assigned to some stop
+    len_stopo_ids = np.array([len(ids) for ids in ploles_stopo_ids], dtype=np.int64)
 
     # ploles without stopo
-    for plole_id in ploles.index[len_stopo_ids == 0]:
-        stops['plole_id'].append(plole_id)
-        stops['plafo_id'].append(ploles.loc[plole_id, 'plafo_id'])
-        stops['pole_id'].append(ploles.loc[plole_id, 'pole_id'])
-        stops['stopo_id'].append(0)
-        stops['stopo_reason'].append('')
+    plole_ids = np.flatnonzero(len_stopo_ids == 0).tolist()
+    stops['plole_id'].extend(plole_ids)
+    stops['stopo_id'].extend([0] * len(plole_ids))
+    stops['stopo_reason'].extend([''] * len(plole_ids))
 
     # add one stopo to each plole
-    for plole_id in ploles.index[len_stopo_ids > 0]:
-        stopo_id = ploles.loc[plole_id, 'stopo_ids'][0]
-        stopos.loc[stopo_id, 'in_stop'] = True
-        ploles.loc[plole_id, 'stopo_infos'][stopo_id]['stop_id'] = len(stops['plole_id'])
+    for plole_id in np.flatnonzero(len_stopo_ids > 0).tolist():
+        stopo_id = ploles_stopo_ids[plole_id][0]
+        in_stop.add(stopo_id)
+        ploles_stopo_infos[plole_id][stopo_id]['stop_id'] = len(stops['plole_id'])
         stops['plole_id'].append(plole_id)
-        stops['plafo_id'].append(ploles.loc[plole_id, 'plafo_id'])
-        stops['pole_id'].append(ploles.loc[plole_id, 'pole_id'])
         stops['stopo_id'].append(stopo_id)
         stops['stopo_reason'].append('best match by score (and modalities match)')
 
     # add further stopos to ploles if stopos have new relevant mods or are unused
     pp_stopos = {}  # postponed stopos
-    for plole_id in ploles.index[len_stopo_ids > 1]:
-        mods = stopos.loc[ploles.loc[plole_id, 'stopo_ids'][0], 'mods'].copy()
-        for stopo_id in ploles.loc[plole_id, 'stopo_ids'][1:]:
-            score = ploles.loc[plole_id, 'stopo_infos'][stopo_id]['score']
-            if (stopos.loc[stopo_id, 'mods'] & mods == set() \
-            and stopos.loc[stopo_id, 'mods'] & ploles.loc[plole_id, 'mods'] != set()):
-                mods.update(stopos.loc[stopo_id, 'mods'])
-                stopos.loc[stopo_id, 'in_stop'] = True
-                ploles.loc[plole_id, 'stopo_infos'][stopo_id]['stop_id'] = len(stops['plole_id'])
+    for plole_id in np.flatnonzero(len_stopo_ids > 1).tolist():
+        mods = stopos_mods[ploles_stopo_ids[plole_id][0]]
+        for stopo_id in ploles_stopo_ids[plole_id][1:]:
+            score = ploles_stopo_infos[plole_id][stopo_id]['score']
+            if (stopos_mods[stopo_id] & mods == 0 \
+            and stopos_mods[stopo_id] & ploles_mods[plole_id] != 0):
+                mods |= stopos_mods[stopo_id]
+                in_stop.add(stopo_id)
+                ploles_stopo_infos[plole_id][stopo_id]['stop_id'] = len(stops['plole_id'])
                 stops['plole_id'].append(plole_id)
-                stops['plafo_id'].append(ploles.loc[plole_id, 'plafo_id'])
-                stops['pole_id'].append(ploles.loc[plole_id, 'pole_id'])
                 stops['stopo_id'].append(stopo_id)
                 stops['stopo_reason'].append('adds relevant modality to plole')
-            elif not stopos.loc[stopo_id, 'in_stop']:
+            elif stopo_id not in in_stop:
                 # unused stopo with same mods like some other stopo already assigned
                 # to current plole; if score is better than for other matching
                 # plole, remember stopo-plole combination for processing after all
@@ -691,25 +739,29 @@ def process(config):
                 if stopo_id not in pp_stopos or score > pp_stopos[stopo_id][1]:
                     pp_stopos[stopo_id] = (plole_id, score)
     for stopo_id, (plole_id, score) in pp_stopos.items():            
-        if stopos.loc[stopo_id, 'in_stop']:
+        if stopo_id in in_stop:
             continue
-        stopos.loc[stopo_id, 'in_stop'] = True
-        ploles.loc[plole_id, 'stopo_infos'][stopo_id]['stop_id'] = len(stops['plole_id'])
+        in_stop.add(stopo_id)
+        ploles_stopo_infos[plole_id][stopo_id]['stop_id'] = len(stops['plole_id'])
         stops['plole_id'].append(plole_id)
-        stops['plafo_id'].append(ploles.loc[plole_id, 'plafo_id'])
-        stops['pole_id'].append(ploles.loc[plole_id, 'pole_id'])
         stops['stopo_id'].append(stopo_id)
         stops['stopo_reason'].append('third choice for all nearby ploles; best score with this plole')
 
     # stopos without plole
-    for stopo_id in stopos.index[~stopos['in_stop']]:
-        stops['plole_id'].append(-1)
-        stops['plafo_id'].append(0)
-        stops['pole_id'].append(0)
-        stops['stopo_id'].append(stopo_id)
-        stops['stopo_reason'].append('')
+    stopo_ids = stopos.index[~stopos.index.isin(list(in_stop))].to_list()
+    stops['plole_id'].extend([-1] * len(stopo_ids))
+    stops['stopo_id'].extend(stopo_ids)
+    stops['stopo_reason'].extend([''] * len(stopo_ids))
+
+    # plafos and poles of stops
+    # note: appended 0 is for stops without plole (plole ID -1)
+    plole_ids = np.array(stops['plole_id'], dtype=np.int64)
+    stops['plafo_id'] = np.append(ploles['plafo_id'].to_numpy(dtype=np.int64), 0)[plole_ids].tolist()
+    stops['pole_id'] = np.append(ploles['pole_id'].to_numpy(dtype=np.int64), 0)[plole_ids].tolist()
+    stops = {key: stops[key] for key in ['plole_id', 'plafo_id', 'pole_id', 'stopo_id', 'stopo_reason']}
+    del ploles_stopo_ids, ploles_stopo_infos, ploles_mods, stopos_mods, in_stop, \
+        len_stopo_ids, pp_stopos, plole_ids, stopo_ids
 
-    stopos = stopos.drop(columns=['in_stop'])    
 
     # -------------------------------------------------------------------------
     # make data frame from stops dict
@@ -760,80 +812,79 @@ def process(config):
     vpoles = gpd.GeoDataFrame(data=vpoles, geometry='geo', crs=config['meters_crs']).set_index('id')
     vpoles['in_stop'] = True
     poles = gpd.pd.concat((poles, vpoles))
+    # note: virtual poles have no modalities (missing values), nullable integer
+    #       type keeps modality bit masks of other poles integers
+    poles['mods'] = poles['mods'].astype('Int64')
+    poles['maybe_mods'] = poles['maybe_mods'].astype('Int64')
 
     # -------------------------------------------------------------------------
     # make stop geometries (outline)
 
-    plafo_geos_web = plafos['geo'].to_crs(config['web_crs'])
-    pole_geos_web = poles['geo'].to_crs(config['web_crs'])
-    stopo_geos_web = stopos['geo'].to_crs(config['web_crs'])
-    stop_geos_web = gpd.GeoSeries(
-        index = stops.index,
-        data = len(stops) * [Point()],
-        crs = config['web_crs']
+    # note: each stop has a pole (maybe virtual), plafo and stopo are optional
+    plafo_geos = plafos['geo'].reindex(stops['plafo_id']).to_numpy()
+    plafo_geos[shapely.is_missing(plafo_geos)] = Point()
+    pole_geos = poles['geo'].reindex(stops['pole_id']).to_numpy()
+    pole_geos[shapely.is_missing(pole_geos)] = Point()
+    stopo_geos = stopos['geo'].reindex(stops['stopo_id']).to_numpy()
+    stopo_geos[shapely.is_missing(stopo_geos)] = Point()
+    nodes_hulls = shapely.convex_hull(shapely.union(pole_geos, stopo_geos))
+
+    # note: outlines used to be buffered in web_crs, where stop_buffer_size
+    #       corresponds to stop_buffer_size * cos(lat) meters (Mercator is
+    #       conformal); we buffer in meters_crs with that size instead of
+    #       reprojecting all geometries twice
+    lats = gpd.GeoSeries(
+        shapely.centroid(shapely.union(nodes_hulls, plafo_geos)),
+        crs=config['meters_crs']
+    ).to_crs(config['lon_lat_crs']).y.to_numpy()
+    sizes = config['stop_buffer_size'] * np.cos(np.radians(lats))
+    stops['geo'] = shapely.union(
+        shapely.buffer(plafo_geos, sizes, quad_segs=4),
+        shapely.buffer(nodes_hulls, sizes, quad_segs=4)
     )
-        
-    for stop_id in stops.index:
-        plafo_id = stops.loc[stop_id, 'plafo_id']
-        pole_id = stops.loc[stop_id, 'pole_id']
-        stopo_id = stops.loc[stop_id, 'stopo_id']
-        if plafo_id != 0:
-            plafo_geo = plafo_geos_web.loc[plafo_id]
-        else:
-            plafo_geo = Point()
-        if pole_id != 0:
-            pole_geo = pole_geos_web.loc[pole_id]
-        else:
-            pole_geo = Point()
-        if stopo_id != 0:
-            stopo_geo = stopo_geos_web.loc[stopo_id]
-        else:
-            stopo_geo = Point()
-        plafo_buffer = plafo_geo.buffer(config['stop_buffer_size'], cap_style=1, resolution=4)
-        nodes_buffer = shapely.unary_union([pole_geo, stopo_geo]).convex_hull.buffer(config['stop_buffer_size'], cap_style=1, resolution=4)
-        stop_geos_web.loc[stop_id] = shapely.unary_union([plafo_buffer, nodes_buffer])
-        
-    stops['geo'] = stop_geos_web.to_crs(config['meters_crs'])
+    del plafo_geos, pole_geos, stopo_geos, nodes_hulls, lats, sizes
 
     # -------------------------------------------------------------------------
     # get stop mods
 
-    stops['mods'] = [set() for _ in stops.index]
-    stops['maybe_mods'] = [set() for _ in stops.index]
-
-    for i in stops.index:
-        plole_id = stops.loc[i, 'plole_id']
-        stopo_id = stops.loc[i, 'stopo_id']
-        plole_mods = ploles.loc[plole_id, 'mods'] if plole_id > -1 else set()
-        plole_maybe_mods = ploles.loc[plole_id, 'maybe_mods'] if plole_id > -1 else set()
-        stopo_mods = stopos.loc[stopo_id, 'mods'] if stopo_id > 0 else set()
-        mods = stops.loc[i, 'mods']
-        maybe_mods = stops.loc[i, 'maybe_mods']
-        
-        if plole_id == -1:
-            mods.update(stopo_mods)
-        elif stopo_id == 0:
-            if plole_mods != set():
-                mods.update(plole_mods)
-                maybe_mods.update(plole_maybe_mods)
-            elif len(plole_maybe_mods) == 1:
-                mods.update(plole_maybe_mods)
-            else:
-                maybe_mods.update(plole_maybe_mods)
-        else:
-            if plole_mods & stopo_mods != set():
-                mods.update(plole_mods & stopo_mods)
-                maybe_mods.update(plole_maybe_mods & stopo_mods)
-            elif len(plole_maybe_mods & stopo_mods) == 1 \
-            or (stops['stopo_id'] == stopo_id).sum() == 1:
-                mods.update(plole_maybe_mods & stopo_mods)
-            else:
-                maybe_mods.update(plole_maybe_mods & stopo_mods)
-                
+    plole_ids = stops['plole_id'].to_numpy()
+    stopo_ids = stops['stopo_id'].to_numpy()
+    has_plole = plole_ids > -1
+    has_stopo = stopo_ids > 0
+    plole_mods = np.zeros(len(stops), dtype=np.int64)
+    plole_mods[has_plole] = ploles.loc[plole_ids[has_plole], 'mods'].to_numpy()
+    plole_maybe_mods = np.zeros(len(stops), dtype=np.int64)
+    plole_maybe_mods[has_plole] = ploles.loc[plole_ids[has_plole], 'maybe_mods'].to_numpy()
+    stopo_mods = np.zeros(len(stops), dtype=np.int64)
+    stopo_mods[has_stopo] = stopos.loc[stopo_ids[has_stopo], 'mods'].to_numpy()
+    stopo_counts = stops['stopo_id'].map(stops['stopo_id'].value_counts()).to_numpy()
+    common_mods = plole_mods & stopo_mods
+    common_maybe_mods = plole_maybe_mods & stopo_mods
+
+    # cases: stopo without plole, plole without stopo (with mods, with one or
+    # more maybe mods), plole and stopo (with common mods, with one common
+    # maybe mod or stopo not used by other stops, with common maybe mods)
+    cases = [
+        ~has_plole,
+        ~has_stopo & (plole_mods != 0),
+        ~has_stopo & single_mod(plole_maybe_mods),
+        ~has_stopo,
+        common_mods != 0,
+        single_mod(common_maybe_mods) | (stopo_counts == 1)
+    ]
+    stops['mods'] = np.select(cases, [
+        stopo_mods, plole_mods, plole_maybe_mods, 0, common_mods, common_maybe_mods
+    ], 0)
+    stops['maybe_mods'] = np.select(cases, [
+        0, plole_maybe_mods, 0, plole_maybe_mods, common_maybe_mods, 0
+    ], common_maybe_mods)
+    del plole_ids, stopo_ids, has_plole, has_stopo, plole_mods, plole_maybe_mods, stopo_mods, \
+        stopo_counts, common_mods, common_maybe_mods, cases
+
     # -------------------------------------------------------------------------
     # warnings about stops with no mods (maybe_mods only)
 
-    for i in stops.index[(stops['mods'] == set())]:
+    for i in stops.index[stops['mods'] == 0]:
         stop = stops.loc[i, :]
         if stop['pole_id'] == 0 and stop['stopo_id'] == 0:
             # platform-only stop
@@ -843,7 +894,7 @@ def process(config):
             pole = poles.loc[stop['pole_id'], :]
             if pole['obj'].has_tag('public_transport', 'platform') \
             and pole['obj'].has_tag('highway', 'bus_stop') \
-            and 'bus' not in pole['mods'] \
+            and not pole['mods'] & mod_bits['bus'] \
             and not pole['obj'].has_tag('bus', 'no'):
                 stop['warnings'].append(f'stop has a bus pole on a road (probably supposed to be a stop position)')
             elif stop['stopo_id'] == 0:
@@ -854,132 +905,92 @@ def process(config):
             stop['warnings'].append(f'stop with ambiguous modalities {mods2str(stop['maybe_mods'])} (check carefully, really weird)')
 
     # -------------------------------------------------------------------------
-    # add info about comments/warnings for plafo/pole/stop to stop
+    # add info about comments/warnings for plafo/pole/stop to stop, bus stop
+    # rendering quality and new PTv2 tagging
+
+    # note: stop attributes are derived from boolean feature columns of
+    #       plafos, poles and stopos joined to the stops table
+    def features(df):
+        objs = [obj if type(obj) != float else None for obj in df['obj']]  # no objects for virtual poles
+        return gpd.pd.DataFrame({
+            'has_comments': [obj is not None and obj.comments != [] for obj in objs],
+            'has_warnings': [obj is not None and obj.warnings != [] for obj in objs],
+            'has_hw_bus_stop': [obj is not None and obj.has_tag('highway', 'bus_stop') for obj in objs],
+            'has_public_transport': [obj is not None and 'public_transport' in obj.tags for obj in objs],
+            'is_area': [obj is not None and (obj.has_tag('area', 'yes') or 'building' in obj.tags) for obj in objs],
+            'has_platform': [obj is not None and (obj.has_tag('highway', 'platform') or obj.has_tag('railway', 'platform')) for obj in objs]
+        }, index=df.index, dtype=bool)
+
+    has_plafo = (stops['plafo_id'] != 0).to_numpy()
+    has_pole = (stops['pole_id'] > 0).to_numpy()
+    has_stopo = (stops['stopo_id'] > 0).to_numpy()
+    stop_plafos = features(plafos).reindex(stops['plafo_id'].to_numpy(), fill_value=False)
+    stop_poles = features(poles).reindex(stops['pole_id'].to_numpy(), fill_value=False)
+    stop_stopos = features(stopos).reindex(stops['stopo_id'].to_numpy(), fill_value=False)
+    stop_plafos['is_bus_symbol'] = stop_plafos['has_hw_bus_stop'] & stop_plafos['is_area']
+    stop_plafos['is_visible_platform'] = stop_plafos['has_platform'] | stop_plafos['is_bus_symbol']
+    stop_poles['is_bus_symbol'] = stop_poles['has_hw_bus_stop']
+    stop_stopos['is_bus_symbol'] = stop_stopos['has_hw_bus_stop']
+
+    def any_member(col):
+        return stop_plafos[col].to_numpy() | stop_poles[col].to_numpy() | stop_stopos[col].to_numpy()
+
+    def count_members(col):
+        return stop_plafos[col].to_numpy().astype(int) + stop_poles[col].to_numpy() + stop_stopos[col].to_numpy()
+
+    stops['member_comments'] = any_member('has_comments')
+    stops['member_warnings'] = any_member('has_warnings')
 
-    def has_comments(obj):
-        if type(obj) != float:
-            return not obj.comments == []
-        else:
-            return False
-
-    def has_warnings(obj):
-        if type(obj) != float:
-            return not obj.warnings == []
-        else:
-            return False
-
-    stops['member_comments'] = False
-    stops['member_warnings'] = False
-    for stop_id in stops.index:
-        plafo_id = stops.loc[stop_id, 'plafo_id']
-        pole_id = stops.loc[stop_id, 'pole_id']
-        stopo_id = stops.loc[stop_id, 'stopo_id']
-        if plafo_id != 0:
-            stops.loc[stop_id, 'member_comments'] = stops.loc[stop_id, 'member_comments'] or plafos.loc[plafo_id, 'obj'].comments != []
-            stops.loc[stop_id, 'member_warnings'] = stops.loc[stop_id, 'member_warnings'] or plafos.loc[plafo_id, 'obj'].warnings != []
-        if pole_id > 0:
-            stops.loc[stop_id, 'member_comments'] = stops.loc[stop_id, 'member_comments'] or poles.loc[pole_id, 'obj'].comments != []
-            stops.loc[stop_id, 'member_warnings'] = stops.loc[stop_id, 'member_warnings'] or poles.loc[pole_id, 'obj'].warnings != []
-        if stopo_id > 0:
-            stops.loc[stop_id, 'member_comments'] = stops.loc[stop_id, 'member_comments'] or stopos.loc[stopo_id, 'obj'].comments != []
-            stops.loc[stop_id, 'member_warnings'] = stops.loc[stop_id, 'member_warnings'] or stopos.loc[stopo_id, 'obj'].warnings != []
-            
-    # -------------------------------------------------------------------------
     # bus stop rendering quality
     # 0 = no info (no bus stop)
     # 1 = invisible
     # 2 = incorrect (multiple symbols, symbol at wrong location)
     # 3 = good
-    # 4 = plafo without bus symbol in bus station
-
-    stops['render'] = 0
-
-    for stop_id in stops.index:
-        if not 'bus' in stops.loc[stop_id, 'mods']:
-            continue
-        stopo_id = stops.loc[stop_id, 'stopo_id']
-        pole_id = stops.loc[stop_id, 'pole_id']
-        plafo_id = stops.loc[stop_id, 'plafo_id']
-        stopo_symbol = stopo_id > 0 \
-                    and stopos.loc[stopo_id, 'obj'].has_tag('highway', 'bus_stop')
-        pole_symbol = pole_id > 0 \
-                    and poles.loc[pole_id, 'obj'].has_tag('highway', 'bus_stop')
-        plafo_symbol = plafo_id != 0 \
-                    and plafos.loc[plafo_id, 'obj'].has_tag('highway', 'bus_stop') \
-                    and (plafos.loc[plafo_id, 'obj'].has_tag('area', 'yes') \
-                            or 'building' in plafos.loc[plafo_id, 'obj'].tags)
-        plafo_visible = plafo_id != 0 \
-                        and (plafos.loc[plafo_id, 'obj'].has_tag('highway', 'platform') \
-                            or plafos.loc[plafo_id, 'obj'].has_tag('railway', 'platform') \
-                            or (plafos.loc[plafo_id, 'obj'].has_tag('highway', 'bus_stop')
-                                and (plafos.loc[plafo_id, 'obj'].has_tag('area', 'yes') \
-                                    or 'building' in plafos.loc[plafo_id, 'obj'].tags)))
-
-        sum_symbol = [stopo_symbol, pole_symbol, plafo_symbol].count(True)
-        if sum_symbol == 0:
-            render = 1
-        elif sum_symbol > 1:
-            render = 2
-        else:  # exactly one bus symbol
-            if not plafo_visible and pole_id > 0 and not pole_symbol:
-                render = 2
-            elif not plafo_visible and pole_id <= 0:
-                render = 2
-            else:
-                render = 3
-
-        stops.loc[stop_id, 'render'] = render
-
-    # -------------------------------------------------------------------------
-    # set rendering quality for invisible bus stops in bus stations
-
-    mask = stations['mods'].apply(lambda mods: 'bus' in mods)
-
-    for stop_id in stops.index:
-        if stops.loc[stop_id, 'render'] != 1 or 'bus' not in stops.loc[stop_id, 'mods']:
-            continue
-        plafo_id = stops.loc[stop_id, 'plafo_id']
-        pole_id = stops.loc[stop_id, 'pole_id']
-        stopo_id = stops.loc[stop_id, 'stopo_id']
-        if (plafo_id != 0 and stations.loc[mask,'geo'].intersects(plafos.loc[plafo_id, 'geo']).any()) \
-        or (pole_id > 0 and stations.loc[mask,'geo'].contains(poles.loc[pole_id, 'geo']).any()) \
-        or (stopo_id > 0 and stations.loc[mask,'geo'].contains(stopos.loc[stopo_id, 'geo']).any()):
-            stops.loc[stop_id, 'render'] = 4
-            continue
-
-    del mask
+    # 4 = plafo without bus symbol in bus station (see below)
+    sum_symbol = count_members('is_bus_symbol')
+    plafo_visible = stop_plafos['is_visible_platform'].to_numpy()
+    pole_symbol = stop_poles['is_bus_symbol'].to_numpy()
+    stops['render'] = np.select([
+        (stops['mods'] & mod_bits['bus'] == 0).to_numpy(),
+        sum_symbol == 0,
+        sum_symbol > 1,
+        # exactly one bus symbol
+        ~plafo_visible & has_pole & ~pole_symbol,
+        ~plafo_visible & ~has_pole
+    ], [0, 1, 2, 2, 2], 3)
 
-    # -------------------------------------------------------------------------
     # new PTv2 tagging
     # 0 = no info (shouldn't happen)
     # 1 = no new PTv2 tags
     # 2 = some stop components use new tags, some do not
     # 3 = all components have new tags
+    sum_pt = count_members('has_public_transport')
+    sum_obj = has_plafo.astype(int) + has_pole + has_stopo
+    stops['ptv2'] = np.select([sum_pt == 0, sum_pt == sum_obj], [1, 3], 2)
 
-    stops['ptv2'] = 0
-
-    for stop_id in stops.index:
-        stopo_id = stops.loc[stop_id, 'stopo_id']
-        pole_id = stops.loc[stop_id, 'pole_id']
-        plafo_id = stops.loc[stop_id, 'plafo_id']
-        stopo_pt = stopo_id > 0 \
-                and 'public_transport' in stopos.loc[stopo_id, 'obj'].tags
-        pole_pt = pole_id > 0 \
-                and 'public_transport' in poles.loc[pole_id, 'obj'].tags
-        plafo_pt = plafo_id != 0 \
-                and 'public_transport' in plafos.loc[plafo_id, 'obj'].tags
-
-        sum_pt = [stopo_pt, pole_pt, plafo_pt].count(True)
-        sum_obj = [stopo_id > 0, pole_id > 0, plafo_id != 0].count(True)
-        if sum_pt == 0:
-            ptv2 = 1
-        elif sum_pt == sum_obj:
-            ptv2 = 3
-        else:
-            ptv2 = 2
+    del has_plafo, has_pole, has_stopo, stop_plafos, stop_poles, stop_stopos, \
+        sum_symbol, plafo_visible, pole_symbol, sum_pt, sum_obj
+
+    # -------------------------------------------------------------------------
+    # set rendering quality for invisible bus stops in bus stations
+
+    # note: one spatial query per object type for all candidate stops
+    bus_stations = stations.loc[stations['mods'] & mod_bits['bus'] != 0, 'geo']
+    candidates = ((stops['render'] == 1) & (stops['mods'] & mod_bits['bus'] != 0)).to_numpy()
+    in_station = np.zeros(len(stops), dtype=bool)
+    for df, col, predicate, mask in [
+        (plafos, 'plafo_id', 'intersects', stops['plafo_id'] != 0),
+        (poles, 'pole_id', 'within', stops['pole_id'] > 0),
+        (stopos, 'stopo_id', 'within', stops['stopo_id'] > 0)
+    ]:
+        stop_idx = np.flatnonzero(candidates & mask.to_numpy())
+        geos = df['geo'].reindex(stops[col].iloc[stop_idx]).to_numpy()
+        hits, _ = bus_stations.sindex.query(geos, predicate=predicate)
+        in_station[stop_idx[hits]] = True
+    stops.loc[in_station, 'render'] = 4
+
+    del bus_stations, candidates, in_station, stop_idx, geos, hits
 
-        stops.loc[stop_id, 'ptv2'] = ptv2
-    
     # -------------------------------------------------------------------------
     # dubobs data frame
 
@@ -992,8 +1003,7 @@ def process(config):
         if obj.type == 'node':
             geo = Point(obj.lon, obj.lat)
         elif obj.type in ['way_area', 'mupo_area']:
-            geo = obj.geometry if obj.from_line \
-                else shapely.unary_union(shapely.polygonize(obj.geometry))
+            geo = obj.geometry
         else:
             logger.error(f'ERROR: unhandled object type {obj.type}')
             geo = Point()
@@ -1023,83 +1033,132 @@ def process(config):
     # -------------------------------------------------------------------------
     # export plole-stopo matching details to JSON files
 
-    for plole_id in ploles.index:
-        plole = ploles.loc[plole_id, :]
-        plafo_id = plole['plafo_id']
-        plafo = plafos.loc[plafo_id, :] if plafo_id != 0 else None
-        pole_id = plole['pole_id']
-        pole = poles.loc[pole_id, :] if pole_id > 0 else None
-        data = {}
-
-        # general plole, plafo, pole data
-        data['plole_id'] = int(plole_id)
-        data['plafo_id'] = int(plafo_id)
-        data['pole_id'] = int(pole_id)
-        data['plole_mods'] = list(plole['mods'])
-        data['plole_maybe_mods'] = list(plole['maybe_mods'])
-        if plafo is not None:
-            data['plafo_mods'] = list(plafo['mods'])
-            data['plafo_maybe_mods'] = list(plafo['maybe_mods'])
-            data['plafo_lon'] = plafo['lon']
-            data['plafo_lat'] = plafo['lat']
-        if pole is not None:
-            data['pole_mods'] = list(pole['mods'])
-            data['pole_maybe_mods'] = list(pole['maybe_mods'])
-            data['pole_lon'] = pole['lon']
-            data['pole_lat'] = pole['lat']
-
-        # plafo and pole tags
-        if plafo is not None:
-            data['plafo_tags'] = {}
-            for key in ['ref:IFOPT', 'ref', 'local_ref', 'ref_name', 'name', 'layer', 'level']:
-                value = plafo['obj'].tags.get(key)
-                data['plafo_tags'][key] = value if value else ''
-        if pole is not None:
-            data['pole_tags'] = {}
-            for key in ['ref:IFOPT', 'ref', 'local_ref', 'ref_name', 'name', 'layer', 'level']:
-                value = pole['obj'].tags.get(key)
-                data['pole_tags'][key] = value if value else ''
-
-        # plafo and pole stopos
-        if plafo is not None:
-            data['plafo_stopos'] = {int(k): v for k, v in plafo['stopo_infos'].items()}
-            for stopo_id, stopo_info in data['plafo_stopos'].items():
-                for key in ['ref:IFOPT', 'ref', 'local_ref', 'ref_name', 'name', 'layer', 'level']:
-                    value = stopos.loc[stopo_id, 'obj'].tags.get(key)
-                    stopo_info[key] = value if value else ''
-                stopo_info['mods'] = list(stopos.loc[stopo_id, 'mods'])
-                stopo_info['lon'] = stopos.loc[stopo_id, 'lon']
-                stopo_info['lat'] = stopos.loc[stopo_id, 'lat']
-                
-        if pole is not None:
-            data['pole_stopos'] = {int(k): v for k, v in pole['stopo_infos'].items()}
-            for stopo_id, stopo_info in data['pole_stopos'].items():
-                for key in ['ref:IFOPT', 'ref', 'local_ref', 'ref_name', 'name', 'layer', 'level']:
-                    value = stopos.loc[stopo_id, 'obj'].tags.get(key)
-                    stopo_info[key] = value if value else ''
-                stopo_info['mods'] = list(stopos.loc[stopo_id, 'mods'])
-                stopo_info['lon'] = stopos.loc[stopo_id, 'lon']
-                stopo_info['lat'] = stopos.loc[stopo_id, 'lat']
+    # note: records are assembled from JSON fragments (same output as
+    #       json.dumps() for whole records); fragments of stopos, poles and
+    #       plafos are serialized once and reused for all ploles
+    def dumps_tags(tags):
+        return json.dumps({key: tags.get(key) or '' for key in match_keys})
+
+    stopo_frags = {}  # stopo ID -> (tags, mods and location)
+    for stopo_id, obj, mods, lon, lat in zip(stopos.index, stopos['obj'], stopos['mods'],
+                                              stopos['lon'], stopos['lat']):
+        stopo_frags[stopo_id] = (
+            dumps_tags(obj.tags)[1:-1],
+            f'"mods": {json.dumps(bits2mods(mods))}, "lon": {json.dumps(lon)}, "lat": {json.dumps(lat)}'
+        )
+
+    def dumps_stopos(infos):
+        return '{' + ', '.join(
+            f'"{int(stopo_id)}": {json.dumps(info)[:-1]}, {stopo_frags[stopo_id][0]}, {stopo_frags[stopo_id][1]}}}'
+            for stopo_id, info in infos.items()
+        ) + '}'
+
+    def member_frags(df, prefix):
+        frags = {}  # ID -> (mods and location, tags, stopos)
+        for id_, obj, mods, maybe_mods, lon, lat, infos in zip(
+            df.index, df['obj'], df['mods'], df['maybe_mods'], df['lon'], df['lat'], df['stopo_infos']
+        ):
+            if type(obj) == float:  # virtual pole
+                continue
+            frags[id_] = (
+                f'"{prefix}_mods": {json.dumps(bits2mods(mods))}, '
+                f'"{prefix}_maybe_mods": {json.dumps(bits2mods(maybe_mods))}, '
+                f'"{prefix}_lon": {json.dumps(lon)}, "{prefix}_lat": {json.dumps(lat)}',
+                f'"{prefix}_tags": {dumps_tags(obj.tags)}',
+                f'"{prefix}_stopos": {dumps_stopos(infos)}'
+            )
+        return frags
+
+    plafo_frags = member_frags(plafos, 'plafo')
+    pole_frags = member_frags(poles, 'pole')
+    stop_reasons = stops['stopo_reason'].to_dict()
+    no_stop = '"stop_id": -1, "reason": "not required by this plole and better score with other plole"'
+
+    plole_store = PloleStore(config['ploles_tmp_path'], config['region_code'],
+                             config.get('ploles_mode', 'files'), clear=True,
+                             writers=config.get('ploles_writers', 4))
+    for plole_id, plafo_id, pole_id, mods, maybe_mods, infos in zip(
+        ploles.index, ploles['plafo_id'], ploles['pole_id'],
+        ploles['mods'], ploles['maybe_mods'], ploles['stopo_infos']
+    ):
+        # general plole data
+        parts = [
+            f'"plole_id": {int(plole_id)}, "plafo_id": {int(plafo_id)}, "pole_id": {int(pole_id)}',
+            f'"plole_mods": {json.dumps(bits2mods(mods))}, "plole_maybe_mods": {json.dumps(bits2mods(maybe_mods))}'
+        ]
+
+        # plafo and pole data, tags and stopos
+        members = []
+        if plafo_id != 0:
+            members.append(plafo_frags[plafo_id])
+        if pole_id > 0:
+            members.append(pole_frags[pole_id])
+        for i in range(3):
+            parts.extend(frags[i] for frags in members)
 
         # plole stopos
-        data['plole_stopos'] = {int(k): {'score': v['score']} for k, v in plole['stopo_infos'].items() if v['mods_match'] and v['score'] > 0}
-        for stopo_id, stopo_info in data['plole_stopos'].items():
-            stop_id = plole['stopo_infos'][stopo_id].get('stop_id')
+        plole_stopos = []
+        for stopo_id, info in infos.items():
+            if not (info['mods_match'] and info['score'] > 0):
+                continue
+            stop_id = info.get('stop_id')
             if stop_id:
-                stopo_info['stop_id'] = stop_id
-                stopo_info['reason'] = stops.loc[stop_id, 'stopo_reason']
+                stop = f'"stop_id": {stop_id}, "reason": {json.dumps(stop_reasons[stop_id])}'
             else:
-                stopo_info['stop_id'] = -1
-                stopo_info['reason'] = 'not required by this plole and better score with other plole'
-            stopo_info['mods'] = list(stopos.loc[stopo_id, 'mods'])
-            stopo_info['lon'] = stopos.loc[stopo_id, 'lon']
-            stopo_info['lat'] = stopos.loc[stopo_id, 'lat']
-
-        # write file
-        file_name = config['ploles_tmp_path'] + config['region_code'] + str(plole_id) + '.json'
-        with open(file_name, 'w') as f:
-            json.dump(data, f)
-        
+                stop = no_stop
+            plole_stopos.append(
+                f'"{int(stopo_id)}": {{"score": {json.dumps(info['score'])}, {stop}, {stopo_frags[stopo_id][1]}}}'
+            )
+        parts.append('"plole_stopos": {' + ', '.join(plole_stopos) + '}')
+
+        plole_store.write_json(plole_id, '{' + ', '.join(parts) + '}')
+    plole_store.close()
+    del stopo_frags, plafo_frags, pole_frags, stop_reasons, plole_store
+
+    # -------------------------------------------------------------------------
+    # export to GeoParquet files
+    # note: written before lists and modalities are converted to strings, to
+    #       keep compact column types (integer IDs, modality bit masks,
+    #       dictionary encoded warnings and comments)
+
+    if config.get('export_parquet'):
+
+        def codes(values):
+            return gpd.pd.Categorical([';'.join(v) for v in values])
+
+        def obj_messages(df):
+            objs = [obj if type(obj) != float else None for obj in df['obj']]  # no objects for virtual poles
+            return (codes([obj.comments if obj else [] for obj in objs]),
+                    codes([obj.warnings if obj else [] for obj in objs]))
+
+        export = {}
+        for layer, df, cols in [
+            ('stopos', stopos, ['geo', 'lon', 'lat', 'mods']),
+            ('poles', poles, ['geo', 'lon', 'lat', 'mods', 'maybe_mods']),
+            ('plafos', plafos, ['geo', 'lon', 'lat', 'mods', 'maybe_mods']),
+            ('dubobs', dubobs, ['geo', 'lon', 'lat', 'osm_type', 'osm_id'])
+        ]:
+            export[layer] = df[cols].copy()
+            export[layer]['comments'], export[layer]['warnings'] = obj_messages(df)
+        export['dubobs']['osm_type'] = export['dubobs']['osm_type'].astype('category')
+        export['stops'] = stops[['geo', 'lon', 'lat', 'mods', 'maybe_mods', 'render', 'ptv2',
+                                 'member_comments', 'member_warnings', 'plafo_id', 'pole_id',
+                                 'stopo_id', 'plole_id']].astype({'render': np.int8, 'ptv2': np.int8})
+        export['stops']['warnings'] = codes(stops['warnings'])
+        ploles_export = ploles[['plafo_id', 'pole_id', 'mods', 'maybe_mods', 'stopo_ids']].astype(
+            {'plafo_id': np.int64, 'pole_id': np.int64, 'mods': np.int64, 'maybe_mods': np.int64}
+        )
+        ploles_export['stopo_scores'] = [
+            [infos[stopo_id]['score'] for stopo_id in ids]
+            for ids, infos in zip(ploles['stopo_ids'], ploles['stopo_infos'])
+        ]
+
+        prefix = config['export_path'] + config['region_code'] + '_'
+        for layer, df in export.items():
+            df.reset_index().to_crs(config['lon_lat_crs']).to_parquet(prefix + layer + '.parquet')
+        ploles_export.rename_axis('plole_id').reset_index().to_parquet(prefix + 'ploles.parquet')
+        del export, ploles_export
+
     # -------------------------------------------------------------------------
     # lists to strings for comments and warnings
 
@@ -1117,8 +1176,8 @@ def process(config):
 
     stopos['mods'] = stopos['mods'].apply(mods2str)
     for df in [poles, plafos, stops]:
-        df['mods'] = df['mods'].apply(lambda m: mods2str(m) if type(m) != float else '')
-        df['maybe_mods'] = df['maybe_mods'].apply(lambda m: mods2str(m) if type(m) != float else '')    
+        df['mods'] = df['mods'].apply(lambda m: mods2str(int(m)) if not gpd.pd.isna(m) else '')
+        df['maybe_mods'] = df['maybe_mods'].apply(lambda m: mods2str(int(m)) if not gpd.pd.isna(m) else '')    
     
     # -------------------------------------------------------------------------
     # object types (in JavaScript we cannot access an object's source)
@@ -1139,54 +1198,32 @@ def process(config):
     
     logger.info(f'exporting {len(stops)} stops with {len(plafos)} platforms, {len(poles)} poles, {len(stopos)} stop positions')
     
-    prefix = config['export_path'] + config['region_code'] + '_'
-    
-    stopos[['geo', 'lon', 'lat', 'comments', 'warnings', 'mods', 'type']] \
-        .reset_index().to_crs(config['lon_lat_crs']).to_file(prefix + 'stopos.geojson', driver='GeoJSON')    
-    poles[['geo', 'lon', 'lat', 'comments', 'warnings', 'mods', 'maybe_mods', 'type']] \
-        .reset_index().to_crs(config['lon_lat_crs']).to_file(prefix + 'poles.geojson', driver='GeoJSON')    
-    plafos[['geo', 'lon', 'lat', 'comments', 'warnings', 'mods', 'maybe_mods', 'type']] \
-        .reset_index().to_crs(config['lon_lat_crs']).to_file(prefix + 'plafos.geojson', driver='GeoJSON')
-
+    # note: features are serialized once for GeoJSON files and tiles
+    lon_lat_crs = config['lon_lat_crs']
+    export = {
+        'stopos': stopos[['geo', 'lon', 'lat', 'comments', 'warnings', 'mods', 'type']],
+        'poles': poles[['geo', 'lon', 'lat', 'comments', 'warnings', 'mods', 'maybe_mods', 'type']],
+        'plafos': plafos[['geo', 'lon', 'lat', 'comments', 'warnings', 'mods', 'maybe_mods', 'type']]
+    }
     cols = ['geo', 'lon', 'lat', 'warnings', 'mods', 'maybe_mods', 'render', 'ptv2',
             'member_comments', 'member_warnings', 'plafo_id', 'pole_id', 'stopo_id',
             'plole_id', 'type', 'region']
-    stops[cols].reset_index().to_crs(config['lon_lat_crs']).to_file(prefix + 'stops.geojson', driver='GeoJSON')
+    export['stops'] = stops[cols]
     stops['geo'] = stops['geo'].centroid
-    stops[cols].reset_index().to_crs(config['lon_lat_crs']).to_file(prefix + 'nstops.geojson', driver='GeoJSON')    
-        
-    dubobs[['geo', 'lon', 'lat', 'osm_type', 'osm_id', 'warnings', 'comments', 'type']] \
-        .reset_index().to_crs(config['lon_lat_crs']).to_file(prefix + 'dubobs.geojson', driver='GeoJSON')
+    export['nstops'] = stops[cols]
+    export['dubobs'] = dubobs[['geo', 'lon', 'lat', 'osm_type', 'osm_id', 'warnings', 'comments', 'type']]
+
+    prefix = config['export_path'] + config['region_code'] + '_'
+    features = {}
+    for layer, df in export.items():
+        features[layer] = geojson_features(df.reset_index().to_crs(lon_lat_crs))
+        write_geojson(prefix + layer + '.geojson', features[layer])
+    del export
 
     # -------------------------------------------------------------------------
     # make tiles
-    
-    logger.info('making tiles...')
-    prefix = config['export_path'] + config['region_code'] + '_'
-    os.system(f'tippecanoe --base-zoom=18 --minimum-zoom=18 --maximum-zoom=19 ' \
-              f'--buffer=20 --drop-densest-as-needed --no-clipping ' \
-              f'--no-tile-compression --force -t {config['export_path']} ' \
-              f'--layer=a_stops --output={prefix}stops.mbtiles {prefix}stops.geojson')
-    os.system(f'tippecanoe --base-zoom=18 --minimum-zoom=18 --maximum-zoom=19 ' \
-              f'--buffer=20 --drop-densest-as-needed --no-clipping ' \
-              f'--no-tile-compression --force -t {config['export_path']} ' \
-              f'--layer=b_plafos --output={prefix}plafos.mbtiles {prefix}plafos.geojson')
-    os.system(f'tippecanoe --base-zoom=18 --minimum-zoom=18 --maximum-zoom=19 ' \
-              f'--buffer=20 --drop-densest-as-needed --no-clipping ' \
-              f'--no-tile-compression --force -t {config['export_path']} ' \
-              f'--layer=c_poles --output={prefix}poles.mbtiles {prefix}poles.geojson')
-    os.system(f'tippecanoe --base-zoom=18 --minimum-zoom=18 --maximum-zoom=19 ' \
-              f'--buffer=20 --drop-densest-as-needed --no-clipping ' \
-              f'--no-tile-compression --force -t {config['export_path']} ' \
-              f'--layer=d_stopos --output={prefix}stopos.mbtiles {prefix}stopos.geojson')
-    os.system(f'tippecanoe --base-zoom=11 --minimum-zoom=0 --maximum-zoom=17 ' \
-              f'--buffer=20 --drop-densest-as-needed --no-clipping ' \
-              f'--no-tile-compression --force -t {config['export_path']} ' \
-              f'--layer=e_nstops --output={prefix}nstops.mbtiles {prefix}nstops.geojson')
-    os.system(f'tippecanoe --base-zoom=11 --minimum-zoom=0 --maximum-zoom=19 ' \
-              f'--buffer=20 --drop-densest-as-needed --no-clipping ' \
-              f'--no-tile-compression --force -t {config['export_path']} ' \
-              f'--layer=f_dubobs --output={prefix}dubobs.mbtiles {prefix}dubobs.geojson')
-    logger.info('...done')
+
+    if tiles and not make_tiles(config, features):
+        return False
 
     return True
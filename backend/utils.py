@@ -1,5 +1,21 @@
+import array
+import codecs
+import collections
+import concurrent.futures
+import email.utils
+import gzip
+import hashlib
+import json
 import logging
+import numpy as np
+import os
+import pandas as pd
+import re
 import requests
+import shapely
+import sys
+import threading
+import time
 from shapely.geometry import Point, LineString
 
 
@@ -8,23 +24,55 @@ logger = logging.getLogger('region')
 
 class OSMObject:
 
+    # note: there are millions of objects per region, so we use slots (no
+    #       per-instance dict), interned tag strings, and create lists for
+    #       comments and warnings only if required
+    __slots__ = ('type', 'id', 'tags', 'multiple_values', 'split_values',
+                 '_comments', '_warnings')
+
     def __init__(self, j, t):
 
         self.type = t
         self.id = j['id']
         if j.get('tags'):
-            self.tags = j['tags']
+            self.tags = {sys.intern(key): sys.intern(value) for key, value in j['tags'].items()}
         else:
             self.tags = dict()
-        self.comments = []
-        self.warnings = []
+        self._comments = None
+        self._warnings = None
 
         # check for multiple values
         self.multiple_values = False
+        self.split_values = None  # key -> frozenset of values (multiple values only)
         for key, value in self.tags.items():
             if ';' in value:
                 self.multiple_values = True
                 #self.comment(f'multiple values for key {key}')
+                self._split(key, value)
+
+    def _split(self, key, value):
+
+        if self.split_values is None:
+            self.split_values = {}
+        self.split_values[key] = frozenset(sys.intern(v) for v in value.split(';'))
+
+    def set_tag(self, key, value):
+
+        self.tags[sys.intern(key)] = sys.intern(value)
+        if ';' in value:
+            self._split(key, value)
+        elif self.split_values is not None:
+            self.split_values.pop(key, None)
+
+    @property
+    def comments(self):
+
+        return self._comments if self._comments is not None else []
+
+    @property
+    def warnings(self):
+
+        return self._warnings if self._warnings is not None else []
 
     def __str__(self):
 
@@ -36,13 +84,17 @@ class OSMObject:
 
     def comment(self, text):
 
-        self.comments.append(text)
+        if self._comments is None:
+            self._comments = []
+        self._comments.append(text)
         
         logger.info(f'comment for {self.type} {self.id}: {text}')
 
     def warning(self, text):
 
-        self.warnings.append(text)
+        if self._warnings is None:
+            self._warnings = []
+        self._warnings.append(text)
         
         logger.info(f'warning for {self.type} {self.id}: {text}')
     
@@ -58,10 +110,10 @@ class OSMObject:
             return True
 
         # value matches in case of multiple values?
-        if self.multiple_values:
-            for single_value in obj_value.split(';'):
-                if single_value == value:
-                    return True
+        if self.split_values is not None:
+            split_values = self.split_values.get(key)
+            if split_values is not None:
+                return value in split_values
 
         # no match
         return False
@@ -69,6 +121,8 @@ class OSMObject:
 
 class Node(OSMObject):
 
+    __slots__ = ('lon', 'lat')
+
     def __init__(self, j):
 
         super().__init__(j, 'node')
@@ -78,6 +132,8 @@ class Node(OSMObject):
 
 class Way(OSMObject):
 
+    __slots__ = ('node_ids', )
+
     def __init__(self, j):
 
         super().__init__(j, 'way')
@@ -86,15 +142,19 @@ class Way(OSMObject):
 
 class RelMember:
 
+    __slots__ = ('type', 'id', 'role')
+
     def __init__(self, type_, id_, role):
 
-        self.type = type_
+        self.type = sys.intern(type_)
         self.id = id_
-        self.role = role
+        self.role = sys.intern(role)
 
 
 class Relation(OSMObject):
 
+    __slots__ = ('members', )
+
     def __init__(self, j):
 
         super().__init__(j, 'rel')
@@ -103,7 +163,15 @@ class Relation(OSMObject):
 
 class Area(OSMObject):
 
-    def __init__(self, base_obj, nodes_dict={}, ways_dict={}):
+    __slots__ = ('from_line', 'geometry')
+
+    def __init__(self, base_obj, lines):
+        '''
+        Make area from way or multipolygon relation. Lines is a dict mapping
+        way IDs to LineStrings (see make_areas()). Geometry is a LineString
+        for unclosed ways (from_line) and a list of rings otherwise, which
+        make_areas() replaces by the area's polygon.
+        '''
 
         if isinstance(base_obj, Way):
             self.id = base_obj.id
@@ -117,12 +185,12 @@ class Area(OSMObject):
         
         self.tags = base_obj.tags
         self.multiple_values = base_obj.multiple_values
-        self.comments = base_obj.comments.copy()
-        self.warnings = base_obj.warnings.copy()
+        self.split_values = base_obj.split_values
+        self._comments = base_obj._comments.copy() if base_obj._comments else None
+        self._warnings = base_obj._warnings.copy() if base_obj._warnings else None
 
         if self.type == 'way_area':
-            line = LineString([(nodes_dict[n_id].lon, nodes_dict[n_id].lat) \
-                               for n_id in base_obj.node_ids])
+            line = lines[base_obj.id]
             if base_obj.node_ids[0] != base_obj.node_ids[-1]:
                 self.from_line = True
                 self.geometry = line
@@ -131,16 +199,262 @@ class Area(OSMObject):
                 self.geometry = [line]
         else:  # multipolgon
             self.from_line = False
-            ways = [ways_dict[m.id] for m in base_obj.members 
-                                    if m.type == 'way' and m.role == 'outer']
-            if ways == []:  # no outer rings, use all ways
-                ways = [ways_dict[m.id] for m in base_obj.members if m.type == 'way']
+            way_ids = [m.id for m in base_obj.members 
+                            if m.type == 'way' and m.role == 'outer']
+            if way_ids == []:  # no outer rings, use all ways
+                way_ids = [m.id for m in base_obj.members if m.type == 'way']
                 self.warning('invalid area')
-            self.geometry = [
-                LineString([(nodes_dict[n_id].lon, nodes_dict[n_id].lat)
-                            for n_id in w.node_ids])
-                for w in ways
-            ] 
+            self.geometry = [lines[way_id] for way_id in way_ids]
+
+
+class NodeStore:
+    '''
+    Node locations (IDs, lons, lats) in sorted numpy arrays.
+
+    Locations are collected with add() (for instance while parsing Overpass
+    responses, see overpass()) and become available after calling finalize().
+    '''
+
+    def __init__(self):
+
+        self._ids = array.array('q')
+        self._lons = array.array('d')
+        self._lats = array.array('d')
+        self.ids = None
+        self.lons = None
+        self.lats = None
+
+    def __len__(self):
+
+        return len(self._ids) if self.ids is None else len(self.ids)
+
+    def add(self, id_, lon, lat):
+
+        self._ids.append(id_)
+        self._lons.append(lon)
+        self._lats.append(lat)
+
+    def add_arrays(self, ids, lons, lats):
+
+        self._ids.extend(ids)
+        self._lons.extend(lons)
+        self._lats.extend(lats)
+
+    def finalize(self):
+
+        ids, pos = np.unique(np.frombuffer(self._ids, dtype=np.int64), return_index=True)
+        self.lons = np.frombuffer(self._lons, dtype=np.float64)[pos]
+        self.lats = np.frombuffer(self._lats, dtype=np.float64)[pos]
+        self.ids = ids
+        self._ids = self._lons = self._lats = None
+
+    def close(self):
+
+        self.ids = self.lons = self.lats = None
+
+    def locations(self, node_ids):
+        '''
+        Arrays of lons and lats for an array of node IDs. Raises KeyError for
+        unknown IDs.
+        '''
+
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        pos = np.searchsorted(self.ids, node_ids)
+        pos[pos == len(self.ids)] = 0
+        if len(node_ids) > 0 and (len(self.ids) == 0 or (self.ids[pos] != node_ids).any()):
+            raise KeyError('missing node locations')
+        return self.lons[pos], self.lats[pos]
+
+    def linestrings(self, node_id_lists):
+        '''
+        Array of LineStrings, one per list of node IDs (constructed in bulk).
+        '''
+
+        lengths = np.fromiter((len(node_ids) for node_ids in node_id_lists),
+                              dtype=np.int64, count=len(node_id_lists))
+        node_ids = np.fromiter((id_ for node_ids in node_id_lists for id_ in node_ids),
+                               dtype=np.int64, count=lengths.sum())
+        lons, lats = self.locations(node_ids)
+        return shapely.linestrings(
+            np.stack((lons, lats), axis=1),
+            indices=np.repeat(np.arange(len(lengths)), lengths)
+        )
+
+
+def _reduce_padded(func, geo_lists):
+    '''
+    Apply reducing shapely function (e.g. shapely.polygonize) to each list of
+    geometries. Lists are padded with None to similar lengths and reduced in
+    bulk, one call per bucket of lengths.
+    '''
+
+    result = np.empty(len(geo_lists), dtype=object)
+    lengths = np.fromiter((len(geos) for geos in geo_lists),
+                          dtype=np.int64, count=len(geo_lists))
+    buckets = np.ceil(np.log2(np.maximum(lengths, 1))).astype(np.int64)
+    for bucket in np.unique(buckets):
+        rows = np.flatnonzero(buckets == bucket)
+        padded = np.full((len(rows), 2 ** bucket), None, dtype=object)
+        for j, i in enumerate(rows):
+            padded[j, :lengths[i]] = geo_lists[i]
+        result[rows] = func(padded, axis=-1)
+    return result
+
+
+def polygonize_all(line_lists):
+    '''
+    Polygons from lists of LineStrings, computed in bulk. Adjacent polygons
+    are joined to one polygon.
+    '''
+
+    # note: shapely.union_all is optional
+    #       (joins adjacent polygons to one polygon)
+    collections_ = _reduce_padded(shapely.polygonize, line_lists)
+    parts, index = shapely.get_parts(collections_, return_index=True)
+    part_lists = [[] for _ in range(len(line_lists))]
+    for i, part in zip(index, parts):
+        part_lists[i].append(part)
+    return _reduce_padded(shapely.union_all, part_lists)
+
+
+def make_areas(ways, rels, node_store):
+    '''
+    Make areas from ways and multipolygon relations. Line geometries of all
+    ways are constructed in bulk from the node store, polygons of all closed
+    areas are computed in bulk and stored in the areas' geometry attribute.
+    '''
+
+    lines = dict(zip(
+        [w.id for w in ways],
+        node_store.linestrings([w.node_ids for w in ways]) if len(ways) > 0 else []
+    ))
+    areas = [Area(w, lines) for w in ways] + [Area(r, lines) for r in rels]
+    closed = [a for a in areas if not a.from_line]
+    if len(closed) > 0:
+        for a, polygon in zip(closed, polygonize_all([a.geometry for a in closed])):
+            a.geometry = polygon
+    return areas
+
+
+class TagMemo:
+    '''
+    Bounded cache for results depending on tags of OSM objects only.
+
+    Keys are tag signatures: an object's tags restricted to the keys the
+    cached computation looks at, so all objects with identical relevant tags
+    share one entry. If there are more than max_size entries, least recently
+    used entries are dropped. Memos are module-level objects, thus shared by
+    all regions processed in one run.
+    '''
+
+    def __init__(self, keys, max_size=100000):
+
+        self.keys = frozenset(keys)
+        self.max_size = max_size
+        self.data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def signature(self, obj):
+
+        keys = self.keys
+        return frozenset([tag for tag in obj.tags.items() if tag[0] in keys])
+
+    def get(self, obj, func):
+
+        signature = self.signature(obj)
+        if signature in self.data:
+            self.hits += 1
+            self.data.move_to_end(signature)
+            return self.data[signature]
+        self.misses += 1
+        result = func(obj)
+        self.data[signature] = result
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+        return result
+
+    def reset_stats(self):
+
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+
+        total = self.hits + self.misses
+        rate = self.hits / total if total > 0 else 0
+        return f'{self.hits} hits, {self.misses} misses ({rate:.1%}), {len(self.data)} entries'
+
+
+class TagTable:
+    '''
+    Tags of many OSM objects as dictionary-encoded columns.
+
+    Each distinct tag (key-value pair) gets a code and the table holds one row
+    (object index, tag code) per tag of each object. Tag queries like
+    has_tag() are answered for all objects at once as boolean masks (in order
+    of the objects the table was built from).
+    '''
+
+    def __init__(self, objs):
+
+        self.size = len(objs)
+        self.tag_codes = {}  # (key, value) -> code
+        self.value_codes = {}  # (key, single value) -> list of codes
+        obj_indices = array.array('q')
+        codes = array.array('q')
+        for i, obj in enumerate(objs):
+            for tag in obj.tags.items():
+                code = self.tag_codes.get(tag)
+                if code is None:
+                    code = self._add_tag(tag)
+                obj_indices.append(i)
+                codes.append(code)
+        self.obj_indices = np.frombuffer(obj_indices, dtype=np.int64)
+        self.codes = np.frombuffer(codes, dtype=np.int64)
+        self._masks = {}
+
+    def _add_tag(self, tag):
+
+        code = len(self.tag_codes)
+        self.tag_codes[tag] = code
+        key, value = tag
+        # note: same semantics as OSMObject.has_tag() (no match for empty
+        #       values, multiple values match each single value)
+        if value:
+            self.value_codes.setdefault((key, value), []).append(code)
+            if ';' in value:
+                for single_value in set(value.split(';')):
+                    if single_value != value:
+                        self.value_codes.setdefault((key, single_value), []).append(code)
+        return code
+
+    def _mask(self, tag_codes):
+
+        lookup = np.zeros(len(self.tag_codes), dtype=bool)
+        lookup[tag_codes] = True
+        mask = np.zeros(self.size, dtype=bool)
+        mask[self.obj_indices[lookup[self.codes]]] = True
+        return mask
+
+    def has_tag(self, key, value):
+
+        mask = self._masks.get((key, value))
+        if mask is None:
+            mask = self._mask(self.value_codes.get((key, value), []))
+            self._masks[(key, value)] = mask
+        return mask
+
+    def has_key_part(self, part):
+        '''
+        Mask of objects having some key containing part.
+        '''
+
+        return self._mask([code for (key, _), code in self.tag_codes.items() if part in key])
+
+    def tag_counts(self):
+
+        return np.bincount(self.obj_indices, minlength=self.size)
 
 
 def filesize2str(size):
@@ -155,248 +469,538 @@ def filesize2str(size):
         return f'{size / (1000 ** 3):.0f} GB'
     
 
-def overpass(query, config, ids_only=False, verbose=1):
+def iter_json_elements(chunks, meta):
+    '''
+    Yield items of the top-level 'elements' array of a JSON document given as
+    iterable of byte chunks, one item at a time. All other top-level values
+    (version, remarks, ...) are stored in dict meta.
+    '''
+
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf = ''
+    pos = 0
+    eof = False
+
+    def more():
+        # append next chunk to buffer, return False if there is no more data
+        nonlocal buf, pos, eof
+        if eof:
+            return False
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+            buf = buf[pos:] + text_decoder.decode(b'', final=True)
+        else:
+            buf = buf[pos:] + text_decoder.decode(chunk)
+        pos = 0
+        return True
+
+    def skip_ws():
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\n\r':
+                pos += 1
+            if pos < len(buf) or not more():
+                return
+
+    def expect(chars):
+        nonlocal pos
+        skip_ws()
+        if pos >= len(buf) or buf[pos] not in chars:
+            raise ValueError(f'invalid JSON at {buf[pos:pos + 50]!r}, expected one of {chars!r}')
+        pos += 1
+        return buf[pos - 1]
+
+    def value():
+        # decode next JSON value, read more data if value is incomplete
+        nonlocal pos
+        skip_ws()
+        while True:
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if more():
+                    continue
+                raise
+            # numbers may continue in next chunk (e.g. '0.' + '6')
+            if (end == len(buf) or isinstance(obj, (int, float)) \
+                and buf[end] not in ' \t\n\r,]}') and more():
+                continue
+            pos = end
+            return obj
+
+    expect('{')
+    skip_ws()
+    if pos < len(buf) and buf[pos] == '}':
+        return
+    while True:
+        key = value()
+        expect(':')
+        if key == 'elements':
+            expect('[')
+            skip_ws()
+            if pos < len(buf) and buf[pos] == ']':
+                pos += 1
+            else:
+                while True:
+                    yield value()
+                    if expect(',]') == ']':
+                        break
+        else:
+            meta[key] = value()
+        if expect(',}') == '}':
+            return
+
+
+def make_objects(elements, ids_only=False, node_store=None):
+    '''
+    Make lists of nodes, ways, relations from iterable of Overpass JSON elements.
+    If a node store is given, node locations go to the store and only nodes
+    with tags become Node objects.
+    '''
+
+    nodes = []
+    ways = []
+    rels = []
+    targets = {'node': (nodes, Node), 'way': (ways, Way), 'relation': (rels, Relation)}
+    for obj in elements:
+        target = targets.get(obj.get('type'))
+        if target is None:
+            continue
+        objects, cls = target
+        if node_store is not None and cls is Node:
+            node_store.add(obj['id'], obj['lon'], obj['lat'])
+            if not obj.get('tags'):
+                continue
+        objects.append(obj.get('id') if ids_only else cls(obj))
+
+    return nodes, ways, rels
+
+
+# statistics of Overpass response cache (reset per region)
+overpass_cache_stats = {'hits': 0, 'misses': 0}
+
+
+def overpass_cache_file(data, config):
+    '''
+    Path of cache file for Overpass query data (including preamble).
+    '''
+
+    key = hashlib.sha256((config['overpass_url'] + '\n' + data).encode()).hexdigest()
+    return os.path.join(config['overpass_cache_path'], key + '.json.gz')
+
+
+def overpass_cache_lookup(file_name, config):
+    '''
+    Return True if there is a cache file not older than overpass_cache_max_age
+    and mark it as recently used.
+    '''
+
+    try:
+        stat = os.stat(file_name)
+    except FileNotFoundError:
+        return False
+    max_age = config.get('overpass_cache_max_age', 0)
+    if max_age > 0 and time.time() - stat.st_mtime > max_age:
+        return False
+
+    # note: access time is used for LRU eviction, modification time for age
+    os.utime(file_name, (time.time(), stat.st_mtime))
+    return True
+
+
+def overpass_cache_evict(config):
+    '''
+    Remove expired cache files and least recently used cache files exceeding
+    overpass_cache_max_size. Lists the whole cache directory, so call it once
+    per region and not per query.
+    '''
+
+    path = config['overpass_cache_path']
+    max_age = config.get('overpass_cache_max_age', 0)
+    max_size = config.get('overpass_cache_max_size', 0)
+    now = time.time()
+    files = []
+    if not os.path.isdir(path):
+        return
+    for entry in os.scandir(path):
+        if not entry.name.endswith('.json.gz'):
+            continue
+        # note: other regions processed in parallel may remove files, too
+        try:
+            stat = entry.stat()
+            if max_age > 0 and now - stat.st_mtime > max_age:
+                os.remove(entry.path)
+            else:
+                files.append((stat.st_atime, stat.st_size, entry.path))
+        except FileNotFoundError:
+            pass
+    total_size = sum(size for _, size, _ in files)
+    if max_size > 0 and total_size > max_size:
+        files.sort()
+        for _, size, file_name in files:
+            if total_size <= max_size:
+                break
+            try:
+                os.remove(file_name)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+# HTTP session and concurrency limit for Overpass requests (shared by all
+# threads, created on first request)
+overpass_session = None
+overpass_slots = None
+overpass_lock = threading.Lock()
+
+# status codes worth a retry (rate limit, server overloaded, gateway timeout)
+overpass_retry_status = {429, 500, 502, 503, 504}
+
+
+def get_overpass_session(config):
+    '''
+    Return shared session (keep-alive, connection pool, compressed transfer)
+    and semaphore limiting the number of parallel Overpass requests.
+    '''
+
+    global overpass_session, overpass_slots
+
+    with overpass_lock:
+        if overpass_session is None:
+            max_parallel = max(1, config.get('overpass_max_parallel', 1))
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=max_parallel,
+                pool_block=True
+            )
+            overpass_session = requests.Session()
+            overpass_session.mount('http://', adapter)
+            overpass_session.mount('https://', adapter)
+            overpass_session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+            overpass_slots = threading.BoundedSemaphore(max_parallel)
+
+    return overpass_session, overpass_slots
+
+
+def retry_after(r):
+    '''
+    Seconds to wait according to response's Retry-After header (or None).
+    '''
+
+    value = r.headers.get('Retry-After') if r is not None else None
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0, date.timestamp() - time.time())
+
+
+def overpass_post(data, config, stream=False):
+    '''
+    Send query to Overpass server, retry with exponential backoff on
+    connection errors and on responses indicating overload. Returns last
+    response or None if there was no response at all.
+    '''
+
+    session, _ = get_overpass_session(config)
+    retries = config.get('overpass_retries', 0)
+    backoff = config.get('overpass_backoff', 10)
+
+    for attempt in range(retries + 1):
+        try:
+            r = session.post(
+                config['overpass_url'],
+                data={'data': data},
+                headers={'X-API-Key': config['overpass_key']},
+                stream=stream,
+                timeout=(60, config['overpass_timeout'] + 60)
+            )
+        except (requests.ConnectionError, requests.Timeout) as e:
+            r = None
+            reason = str(e)
+        else:
+            if r.status_code not in overpass_retry_status:
+                return r
+            reason = f'status {r.status_code}'
+        if attempt == retries:
+            break
+        wait = backoff * 2 ** attempt
+        server_wait = retry_after(r)
+        if server_wait is not None:
+            wait = max(wait, server_wait)
+        if r is not None:
+            r.close()
+        logger.warning(f'overpass request failed ({reason}), retry {attempt + 1}/{retries} in {wait:.0f} seconds')
+        time.sleep(wait)
+
+    if r is None:
+        logger.error(f'overpass request failed ({reason})')
+    return r
+
+
+def overpass(query, config, ids_only=False, verbose=1, node_store=None):
+    '''
+    Send query to Overpass server (or read response from cache) and return
+    lists of nodes, ways and relations. Raises an exception if there is no
+    valid response (request failed, error remarks), so an empty result means
+    that there are no matching objects.
+    '''
 
     preamble = '[output: json][timeout: {timeout}];\n'.format(
         timeout=str(config['overpass_timeout']),
     )
-    r = requests.post(
-        config['overpass_url'],
-        data={'data': preamble + query},
-        headers={'X-API-Key': config['overpass_key']}
-    )
-
-    if r.status_code != 200:
-        logger.error(f'overpass server returned {r.status_code} for query\n{query}')
-        return [], [], []
-    
-    j = r.json()
-    objects = j['elements']
+    data = preamble + query
+    stream = config.get('overpass_stream', False)
+    chunk_size = 2 ** 20
+
+    # get response from cache or from server
+    cache_file = overpass_cache_file(data, config) \
+                 if config.get('overpass_cache_path') else None
+    r = None
+    slots = None
+    cache_f = None
+    cache_tmp = None
+    size = 0
+    meta = {}
+    content = None
+    complete = False
+
+    # write response to cache while reading
+    def read_chunks():
+        nonlocal size
+        for chunk in chunks:
+            size += len(chunk)
+            if cache_tmp:
+                cache_f.write(chunk)
+            yield chunk
+
+    # note: slot is held until response has been read completely, and it must
+    #       be released on every path (otherwise later requests block forever)
+    try:
+        if cache_file and overpass_cache_lookup(cache_file, config):
+            overpass_cache_stats['hits'] += 1
+            cache_f = gzip.open(cache_file, 'rb')
+            chunks = iter(lambda: cache_f.read(chunk_size), b'')
+        else:
+            if cache_file:
+                overpass_cache_stats['misses'] += 1
+            _, semaphore = get_overpass_session(config)
+            semaphore.acquire()
+            slots = semaphore
+            r = overpass_post(data, config, stream)
+            if r is None:
+                raise Exception('overpass request failed')
+            if r.status_code != 200:
+                logger.error(f'overpass server returned {r.status_code} for query\n{query}')
+                raise Exception(f'overpass server returned {r.status_code}')
+            chunks = r.iter_content(chunk_size=chunk_size) if stream else [r.content]
+            if cache_file:
+                os.makedirs(config['overpass_cache_path'], exist_ok=True)
+                cache_tmp = f'{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+                cache_f = gzip.open(cache_tmp, 'wb', compresslevel=6)
+
+        if stream:
+            # parse response while downloading, keep only OSM objects in memory
+            nodes, ways, rels = make_objects(iter_json_elements(read_chunks(), meta), ids_only, node_store)
+        else:
+            content = b''.join(read_chunks())
+            meta = json.loads(content)
+            nodes, ways, rels = make_objects(meta.pop('elements'), ids_only, node_store)
+        complete = True
+    finally:
+        if r is not None:
+            r.close()
+        if slots is not None:
+            slots.release()
+        if cache_f is not None:
+            cache_f.close()
+        if cache_tmp:
+            # do not cache incomplete responses or responses with errors
+            if complete and 'error' not in str(meta.get('remarks', '')):
+                os.replace(cache_tmp, cache_file)
+            elif os.path.exists(cache_tmp):
+                os.remove(cache_tmp)
+    if 'error' in str(meta.get('remarks', '')):
+        raise Exception(f'overpass returned error: {meta["remarks"]}')
+    total = len(nodes) + len(ways) + len(rels)
+    if node_store is not None:
+        total += len(node_store)
 
     if verbose > 0:
-        logger.info(f'overpass download size: {filesize2str(len(r.content))}')
-        if j.get('remarks'):
-            logger.warning(f'overpass remarks: {j['remarks']}')
-        if len(objects) == 0:
-            logger.error(f'overpass returned: {r.content.decode()}')
-
-    if ids_only:
-        nodes = [obj.get('id') for obj in objects if obj.get('type') == 'node']
-        ways = [obj.get('id') for obj in objects if obj.get('type') == 'way']
-        rels = [obj.get('id') for obj in objects if obj.get('type') == 'relation']
-    else:
-        nodes = [Node(obj) for obj in objects if obj.get('type') == 'node']
-        ways = [Way(obj) for obj in objects if obj.get('type') == 'way']
-        rels = [Relation(obj) for obj in objects if obj.get('type') == 'relation']
+        if r is None:
+            logger.info(f'overpass response from cache: {filesize2str(size)}')
+        else:
+            logger.info(f'overpass download size: {filesize2str(size)}')
+        if meta.get('remarks'):
+            logger.warning(f'overpass remarks: {meta["remarks"]}')
+        if total == 0:
+            if content is not None:
+                logger.error(f'overpass returned: {content.decode()}')
+            else:
+                logger.error(f'overpass returned no elements: {meta}')
 
     if verbose > 0:
-        logger.info(f'total OSM objects: {len(objects)}')
+        logger.info(f'total OSM objects: {total}')
         logger.info(f'OSM nodes: {len(nodes)}')
+        if node_store is not None:
+            logger.info(f'OSM node locations: {len(node_store)}')
         logger.info(f'OSM ways: {len(ways)}')
         logger.info(f'OSM relations: {len(rels)}')
-    
+
     return nodes, ways, rels
 
 
-def add_mods(mods1, mods2):
-    mods1.update(mods2)
+# tag filters for public transport related objects (used for Overpass queries
+# and for reading local extracts)
+pt_filters = [
+    ('highway', '^((bus_stop|platform);?)*$'),
+    ('public_transport', '^((stop_position|platform|station);?)*$'),
+    ('amenity', '^((bus_stop|bus_station|ferry_terminal);?)*$'),
+    ('railway', '^((platform|station|halt|stop|tram_stop);?)*$'),
+    ('station', '^((subway|light_rail|train|monorail|funicular|tram);?)*$'),
+    ('aerialway', '^((yes|station);?)*$'),
+    ('share_taxi', '^yes$'),
+    ('shared_taxi', '^yes$')
+]
+pt_filters_re = [(key, re.compile(regex)) for key, regex in pt_filters]
+
+def is_pt_object(tags):
+    for key, regex in pt_filters_re:
+        value = tags.get(key)
+        if value is not None and regex.search(value):
+            return True
+    return False
+
 
 def mods2str(mods):
+    mods = bits2mods(mods)
     if len(mods) == 0:
         return 'NO_MODALITY'
     elif len(mods) == 1:
-        return list(mods)[0]
+        return mods[0]
     else:
         return ', '.join(mods)
     
 
-def is_bus(obj):
-    # -1 = no, 0 = maybe, 1 = yes
-    if obj.has_tag('bus', 'no'):
-        return -1
-    if obj.has_tag('bus', 'yes') or obj.has_tag('bus', 'school'):
-        return 1
-    if obj.has_tag('highway', 'bus_stop'):
-        return 1
-    if obj.has_tag('amenity', 'bus_stop'):
-        return 1
-    if obj.has_tag('amenity', 'bus_station'):
-        return 1
-    if obj.has_tag('highway', 'platform'):
-        return 0  # hw=pf is for bus and tram!
-    if obj.has_tag('public_transport', 'platform'):
-        return 0
-    return -1
-
-def is_trolleybus(obj):
-    if obj.has_tag('trolleybus', 'no'):
-        return -1
-    if obj.has_tag('trolleybus', 'yes'):
-        return 1
-    if obj.has_tag('public_transport', 'platform'):
-        return 0
-    return -1
-
-def is_share_taxi(obj):
-    if obj.has_tag('share_taxi', 'no'):
-        return -1
-    if obj.has_tag('shared_taxi', 'no'):
-        return -1
-    if obj.has_tag('share_taxi', 'yes'):
-        return 1
-    if obj.has_tag('shared_taxi', 'yes'):
-        return 1
-
-def is_tram(obj):
-    if obj.has_tag('tram', 'no'):
-        return -1
-    if obj.has_tag('tram', 'yes'):
-        return 1
-    if obj.has_tag('station', 'tram'):
-        return 1
-    if obj.has_tag('railway', 'tram_stop'):
-        return 0  # could also be light_rail (will be determined by rail type)
-    if obj.has_tag('railway', 'station'):
-        return 0  # could by any type of railway station
-    if obj.has_tag('railway', 'halt'):
-        return 0  # could by any type of railway station
-    if obj.has_tag('highway', 'platform'):
-        return 0  # hw=pf is for bus and tram!
-    if obj.has_tag('railway', 'platform'):
-        return 0
-    if obj.has_tag('public_transport', 'platform'):
-        return 0
-    return -1
-
-def is_light_rail(obj):
-    if obj.has_tag('light_rail', 'no'):
-        return -1
-    if obj.has_tag('light_rail', 'yes'):
-        return 1
-    if obj.has_tag('station', 'light_rail'):
-        return 1
-    if obj.has_tag('railway', 'tram_stop'):
-        return 0  # could also be tram (will be determined by rail type)
-    if obj.has_tag('railway', 'station'):
-        return 0  # could by any type of railway station
-    if obj.has_tag('railway', 'halt'):
-        return 0  # could by any type of railway station
-    if obj.has_tag('railway', 'platform'):
-        return 0
-    if obj.has_tag('public_transport', 'platform'):
-        return 0
-    return -1
-
-def is_train(obj):
-    if obj.has_tag('train', 'no'):
-        return -1
-    if obj.has_tag('train', 'yes'):
-        return 1
-    if obj.has_tag('station', 'train'):
-        return 1
-    if obj.has_tag('railway', 'stop'):
+# rules for tag based modalities
+# note: for each modality the first matching rule determines the result
+#       (1 = yes, 0 = maybe, -1 = no), without matching rule the result is no;
+#       a rule is given by tags the object has to have and (optionally) tags it
+#       must not have
+mods_rules = {
+    'bus': [
+        (-1, [('bus', 'no')]),
+        (1, [('bus', 'yes')]),
+        (1, [('bus', 'school')]),
+        (1, [('highway', 'bus_stop')]),
+        (1, [('amenity', 'bus_stop')]),
+        (1, [('amenity', 'bus_station')]),
+        (0, [('highway', 'platform')]),  # hw=pf is for bus and tram!
+        (0, [('public_transport', 'platform')])
+    ],
+    'trolleybus': [
+        (-1, [('trolleybus', 'no')]),
+        (1, [('trolleybus', 'yes')]),
+        (0, [('public_transport', 'platform')])
+    ],
+    'share_taxi': [
+        (-1, [('share_taxi', 'no')]),
+        (-1, [('shared_taxi', 'no')]),
+        (1, [('share_taxi', 'yes')]),
+        (1, [('shared_taxi', 'yes')])
+    ],
+    'tram': [
+        (-1, [('tram', 'no')]),
+        (1, [('tram', 'yes')]),
+        (1, [('station', 'tram')]),
+        (0, [('railway', 'tram_stop')]),  # could also be light_rail (will be determined by rail type)
+        (0, [('railway', 'station')]),  # could by any type of railway station
+        (0, [('railway', 'halt')]),  # could by any type of railway station
+        (0, [('highway', 'platform')]),  # hw=pf is for bus and tram!
+        (0, [('railway', 'platform')]),
+        (0, [('public_transport', 'platform')])
+    ],
+    'light_rail': [
+        (-1, [('light_rail', 'no')]),
+        (1, [('light_rail', 'yes')]),
+        (1, [('station', 'light_rail')]),
+        (0, [('railway', 'tram_stop')]),  # could also be tram (will be determined by rail type)
+        (0, [('railway', 'station')]),  # could by any type of railway station
+        (0, [('railway', 'halt')]),  # could by any type of railway station
+        (0, [('railway', 'platform')]),
+        (0, [('public_transport', 'platform')])
+    ],
+    'train': [
+        (-1, [('train', 'no')]),
+        (1, [('train', 'yes')]),
+        (1, [('station', 'train')]),
         # note: even if pt=stop_position is set without train=yes, rw=stop could
         #       refer to trains as default rail modality
-        return 0
-    if obj.has_tag('railway', 'station'):
-        return 0  # could by any type of railway station
-    if obj.has_tag('railway', 'halt'):
-        return 0  # could by any type of railway station
-    if obj.has_tag('railway', 'platform'):
-        return 0
-    if obj.has_tag('public_transport', 'platform'):
-        return 0
-    return -1
-
-def is_monorail(obj):
-    if obj.has_tag('monorail', 'no'):
-        return -1
-    if obj.has_tag('monorail', 'yes'):
-        return 1
-    if obj.has_tag('station', 'monorail'):
-        return 1
-    if obj.has_tag('railway', 'stop') \
-    and not obj.has_tag('public_transport', 'stop_position'):
+        (0, [('railway', 'stop')]),
+        (0, [('railway', 'station')]),  # could by any type of railway station
+        (0, [('railway', 'halt')]),  # could by any type of railway station
+        (0, [('railway', 'platform')]),
+        (0, [('public_transport', 'platform')])
+    ],
+    'monorail': [
+        (-1, [('monorail', 'no')]),
+        (1, [('monorail', 'yes')]),
+        (1, [('station', 'monorail')]),
         # note: without PTv2 stopo tag rw=stop may refer to any rail modality
-        return 0
-    if obj.has_tag('railway', 'station'):
-        return 0  # could by any type of railway station
-    if obj.has_tag('railway', 'halt'):
-        return 0  # could by any type of railway station
-    if obj.has_tag('railway', 'platform'):
-        return 0
-    if obj.has_tag('public_transport', 'platform'):
-        return 0
-    return -1
-
-def is_subway(obj):
-    if obj.has_tag('subway', 'no'):
-        return -1
-    if obj.has_tag('subway', 'yes'):
-        return 1
-    if obj.has_tag('station', 'subway'):
-        return 1
-    if obj.has_tag('railway', 'stop') \
-    and not obj.has_tag('public_transport', 'stop_position'):
+        (0, [('railway', 'stop')], [('public_transport', 'stop_position')]),
+        (0, [('railway', 'station')]),  # could by any type of railway station
+        (0, [('railway', 'halt')]),  # could by any type of railway station
+        (0, [('railway', 'platform')]),
+        (0, [('public_transport', 'platform')])
+    ],
+    'subway': [
+        (-1, [('subway', 'no')]),
+        (1, [('subway', 'yes')]),
+        (1, [('station', 'subway')]),
         # note: without PTv2 stopo tag rw=stop may refer to any rail modality
-        return 0
-    if obj.has_tag('railway', 'station'):
-        return 0  # could by any type of railway station
-    if obj.has_tag('railway', 'halt'):
-        return 0  # could by any type of railway station
-    if obj.has_tag('railway', 'platform'):
-        return 0
-    if obj.has_tag('public_transport', 'platform'):
-        return 0
-    return -1
-
-def is_funicular(obj):
-    if obj.has_tag('funicular', 'no'):
-        return -1
-    if obj.has_tag('funicular', 'yes'):
-        return 1
-    if obj.has_tag('station', 'funicular'):
-        return 1
-    if obj.has_tag('railway', 'stop') \
-    and not obj.has_tag('public_transport', 'stop_position'):
+        (0, [('railway', 'stop')], [('public_transport', 'stop_position')]),
+        (0, [('railway', 'station')]),  # could by any type of railway station
+        (0, [('railway', 'halt')]),  # could by any type of railway station
+        (0, [('railway', 'platform')]),
+        (0, [('public_transport', 'platform')])
+    ],
+    'funicular': [
+        (-1, [('funicular', 'no')]),
+        (1, [('funicular', 'yes')]),
+        (1, [('station', 'funicular')]),
         # note: without PTv2 stopo tag rw=stop may refer to any rail modality
-        return 0
-    if obj.has_tag('railway', 'station'):
-        return 0  # could by any type of railway station
-    if obj.has_tag('railway', 'halt'):
-        return 0  # could by any type of railway station
-    if obj.has_tag('railway', 'platform'):
-        return 0
-    if obj.has_tag('public_transport', 'platform'):
-        return 0
-    return -1
-
-def is_ferry(obj):
-    if obj.has_tag('ferry', 'no'):
-        return -1
-    if obj.has_tag('ferry', 'yes'):
-        return 1
-    if obj.has_tag('amenity', 'ferry_terminal'):
-        return 1
-    if obj.has_tag('public_transport', 'platform'):
-        return 0
-    return -1
-
-def is_aerialway(obj):
-    if obj.has_tag('aerialway', 'no'):
-        return -1
-    if obj.has_tag('aerialway', 'yes'):
-        return 1
-    if obj.has_tag('aerialway', 'station'):
-        return 1
-    if obj.has_tag('public_transport', 'platform'):
-        return 0
-    return -1
+        (0, [('railway', 'stop')], [('public_transport', 'stop_position')]),
+        (0, [('railway', 'station')]),  # could by any type of railway station
+        (0, [('railway', 'halt')]),  # could by any type of railway station
+        (0, [('railway', 'platform')]),
+        (0, [('public_transport', 'platform')])
+    ],
+    'ferry': [
+        (-1, [('ferry', 'no')]),
+        (1, [('ferry', 'yes')]),
+        (1, [('amenity', 'ferry_terminal')]),
+        (0, [('public_transport', 'platform')])
+    ],
+    'aerialway': [
+        (-1, [('aerialway', 'no')]),
+        (1, [('aerialway', 'yes')]),
+        (1, [('aerialway', 'station')]),
+        (0, [('public_transport', 'platform')])
+    ]
+}
 
 mods_props = {
     'bus': {
         'track': 'road',
-        'is_func': is_bus,
         'track_tags': {
             'highway': [
                 'motorway',
@@ -424,7 +1028,6 @@ mods_props = {
     },
     'trolleybus': {
         'track': 'road',
-        'is_func': is_trolleybus,
         'track_tags': {
             'highway': [
                 'motorway',
@@ -452,7 +1055,6 @@ mods_props = {
     },
     'share_taxi': {
         'track': 'road',
-        'is_func': is_share_taxi,
         'track_tags': {
             'highway': [
                 'motorway',
@@ -480,56 +1082,48 @@ mods_props = {
     },
     'tram': {
         'track': 'tram',
-        'is_func': is_tram,
         'track_tags': {
             'railway': ['tram'],
         }
     },
     'light_rail': {
         'track': 'light_rail',
-        'is_func': is_light_rail,
         'track_tags': {
             'railway': ['light_rail'],
         }
     },
     'train': {
         'track': 'rail',
-        'is_func': is_train,
         'track_tags': {
             'railway': ['miniature', 'narrow_gauge', 'rail', 'preserved']
         }
     },
     'monorail': {
         'track': 'monorail',
-        'is_func': is_monorail,
         'track_tags': {
             'railway': ['monorail'],
         }
     },
     'subway': {
         'track': 'subway',
-        'is_func': is_subway,
         'track_tags': {
             'railway': ['subway'],
         }
     },
     'funicular': {
         'track': 'funicular',
-        'is_func': is_funicular,
         'track_tags': {
             'railway': ['funicular'],
         }
     },
     'ferry': {
         'track': 'sea',
-        'is_func': is_ferry,
         'track_tags': {
             'route': ['ferry'],
         }
     },
     'aerialway': {
         'track': 'air',
-        'is_func': is_aerialway,
         'track_tags': {
             'aerialway': [
                 'cable_car',
@@ -548,66 +1142,359 @@ mods_props = {
         }
     }
 }
+
+# keys of tags relevant for track types
+track_keys = {key for mod_props in mods_props.values()
+                for key in mod_props['track_tags']}
+
+def overpass_track_ways(node_ids, config):
+    '''
+    Ways with track tags containing at least one of the nodes (sorted by ID).
+
+    Node IDs are split into chunks of at most `overpass_max_ids` IDs to keep
+    request bodies and server side run times small. Chunks are fetched in
+    parallel, the number of concurrent requests is limited by overpass().
+    '''
+
+    chunk_size = config.get('overpass_max_ids', 5000)
+    chunks = [node_ids[i:i + chunk_size] for i in range(0, len(node_ids), chunk_size)]
+
+    def fetch(chunk):
+        query = '''
+        node(id: {node_ids});
+        way(bn)->.all;
+        ({way_filters});
+        out;
+        '''.format(
+            node_ids=','.join([str(id_) for id_ in chunk]),
+            way_filters='\n'.join([f'way.all[{key}];' for key in sorted(track_keys)])
+        )
+        _, ways, _ = overpass(query, config)
+        return ways
+
+    # note: ways containing nodes from different chunks are returned multiple
+    #       times
+    ways = {}
+    max_workers = max(1, min(len(chunks), config.get('overpass_max_parallel', 2)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for chunk_ways in executor.map(fetch, chunks):
+            for w in chunk_ways:
+                ways[w.id] = w
+    return [ways[id_] for id_ in sorted(ways)]
+
+# modalities are stored as bit masks (integers), see mod_bits
+# note: sets of modalities in data frames are slow to combine and take
+#       hundreds of bytes each
+mod_bits = {mod: 1 << i for i, mod in enumerate(mods_props)}
+
+def bits2mods(bits):
+    return [mod for mod, bit in mod_bits.items() if bits & bit]
+
+def single_mod(bits):
+    # note: works for integers and arrays
+    return (bits != 0) & (bits & (bits - 1) == 0)
+
+def way_track_mods(w):
+    '''
+    Bit mask of modalities for which a way is a suitable track.
+    '''
+
+    bits = 0
+    for mod, mod_props in mods_props.items():
+        # note: We have to test for multi-modality tracks via modality flag
+        #       tags. But for ways with highway=platform (and some other)
+        #       flags might be set although it's not a way for such
+        #       vehicles. Thus, we avoid flag tag checking in such cases.
+        if w.has_tag(mod, 'yes') \
+        and not w.has_tag('highway', 'platform') \
+        and not w.has_tag('railway', 'platform') \
+        and not w.has_tag('public_transport', 'platform'):
+            bits |= mod_bits[mod]
+            continue
+        if w.has_tag(mod, 'no'):
+            continue
+        for key, values in mod_props['track_tags'].items():
+            if any([w.has_tag(key, value) for value in values]):
+                bits |= mod_bits[mod]
+                break
+            if w.has_tag(key, 'construction') \
+            and any([w.has_tag('construction', value) for value in values]):
+                bits |= mod_bits[mod]
+                break
+    return bits
+
+# note: there are lots of ways with identical relevant tags (residential
+#       roads, for instance)
+track_mods_memo = TagMemo(set(mods_props) | track_keys
+                          | {'highway', 'railway', 'public_transport', 'construction'})
+
+
+class ModsClassifier:
+    '''
+    Tag based modalities of OSM objects from compiled `mods_rules`.
+
+    Each tag tested by some rule gets one bit. Tags of an object are scanned
+    once to get the bit mask of satisfied tests, from which the results for
+    all modalities follow. Results are memoized per tag signature (see
+    TagMemo), so rules are evaluated only once per distinct combination of
+    relevant tags.
+    '''
+
+    def __init__(self, rules):
+
+        self.tests = {}
+        self.rules = []
+        for mod, mod_rules in rules.items():
+            self.rules.append((mod_bits[mod], [
+                (self._mask(rule[1]), self._mask(rule[2] if len(rule) > 2 else []), rule[0])
+                for rule in mod_rules
+            ]))
+        self.memo = TagMemo({key for key, _ in self.tests})
+
+    def _mask(self, tags):
+
+        mask = 0
+        for tag in tags:
+            if tag not in self.tests:
+                self.tests[tag] = 1 << len(self.tests)
+            mask |= self.tests[tag]
+        return mask
+
+    def tests_mask(self, obj):
+
+        tests = self.tests
+        mask = 0
+        for key, value in obj.tags.items():
+            if not value:
+                continue
+            mask |= tests.get((key, value), 0)
+            if obj.split_values is not None and key in obj.split_values:
+                for split_value in obj.split_values[key]:
+                    mask |= tests.get((key, split_value), 0)
+        return mask
+
+    def evaluate(self, mask):
+
+        yes_bits, maybe_bits = 0, 0
+        for bit, mod_rules in self.rules:
+            for required, forbidden, value in mod_rules:
+                if mask & required == required and not mask & forbidden:
+                    if value == 1:
+                        yes_bits |= bit
+                    elif value == 0:
+                        maybe_bits |= bit
+                    break
+        return yes_bits, maybe_bits
+
+    def classify(self, obj):
+        '''
+        Returns bit masks of yes and maybe modalities of an OSM object.
+        '''
+
+        return self.memo.get(obj, lambda obj: self.evaluate(self.tests_mask(obj)))
+
+    def classify_all(self, objs):
+        '''
+        Returns arrays of bit masks of yes and maybe modalities of OSM objects.
+        '''
+
+        results = np.array([self.classify(obj) for obj in objs], dtype=np.int64).reshape(-1, 2)
+        return results[:, 0], results[:, 1]
+
+    def is_mod(self, obj, mod):
+        '''
+        Returns 1 (yes), 0 (maybe) or -1 (no) for one modality of an OSM object.
+        '''
+
+        yes_bits, maybe_bits = self.classify(obj)
+        if yes_bits & mod_bits[mod]:
+            return 1
+        if maybe_bits & mod_bits[mod]:
+            return 0
+        return -1
+
+mods_classifier = ModsClassifier(mods_rules)
             
 
 # function for assigning nodes to nodes or areas via neighborhood relations
 
+# keys of tags compared when matching stopos, poles and plafos, and weights of
+# tag matches for scores
+match_keys = ['ref:IFOPT', 'ref', 'local_ref', 'ref_name', 'name', 'layer', 'level']
+match_names = [key + '_match' for key in match_keys]
+match_weights = np.array([10, 2, 2, 1, 1, 1, 2], dtype=np.int64)
+
+def has_value(value, query):
+    '''
+    Same as OSMObject.has_tag() for a tag value (None if tag is missing).
+    '''
+
+    if not value:
+        return False
+    if value == query:
+        return True
+    return ';' in value and query in value.split(';')
+
+
+class MatchTags:
+    '''
+    Tags relevant for matching (match_keys) of many OSM objects as
+    dictionary-encoded columns.
+
+    match() compares two such tables for arrays of (object, object) pairs.
+    Matcher functions are called once per distinct pair of values, not once
+    per pair of objects.
+    '''
+
+    def __init__(self, objs):
+
+        self.size = len(objs)
+        self.values = {}  # key -> list of distinct values
+        self.codes = {}  # key -> array of value codes (-1 if tag is missing)
+        for key in match_keys:
+            value_codes = {}
+            codes = np.full(self.size, -1, dtype=np.int64)
+            for i, obj in enumerate(objs):
+                value = obj.tags.get(key)
+                if value is not None:
+                    codes[i] = value_codes.setdefault(value, len(value_codes))
+            self.values[key] = list(value_codes)
+            self.codes[key] = codes
+
+    def match(self, other, i_self, i_other, matchers):
+        '''
+        Returns matrix of tag matches (one column per match key) for pairs of
+        objects given by index arrays. Matchers get a tag value from each
+        table (or None if tag is missing) and return -1, 0 or 1.
+        '''
+
+        result = np.zeros((len(i_self), len(match_keys)), dtype=np.int64)
+        for j, (key, matcher) in enumerate(zip(match_keys, matchers)):
+            values = [None] + self.values[key]
+            other_values = [None] + other.values[key]
+            pairs = (self.codes[key][i_self] + 1) * len(other_values) \
+                    + other.codes[key][i_other] + 1
+            pairs, inverse = np.unique(pairs, return_inverse=True)
+            pairs_result = np.array([
+                matcher(values[pair // len(other_values)], other_values[pair % len(other_values)])
+                for pair in pairs.tolist()
+            ], dtype=np.int64)
+            result[:, j] = pairs_result[inverse]
+        return result
+
 def get_nearby_nodes(nodes, objects, col_prefix, radius, mods_func, score_func):
+    '''
+    For each object find all nodes within a square buffer of size radius,
+    check their modalities and score them by tags and distance.
+
+    All (object, node) pairs are processed at once: mods_func gets arrays of
+    modality bit masks (object mods, object maybe mods, node mods, node maybe
+    mods) and returns a boolean array, score_func gets index arrays of objects
+    and nodes and returns the matrix of tag matches (see MatchTags.match()).
+    '''
 
     infos_col = col_prefix + '_infos'
     ids_col = col_prefix + '_ids'
     objects[ids_col] = [[] for _ in objects.index]
     objects[infos_col] = [{} for _ in objects.index]
-
-    # for each object get all nodes in neighborhood
-    if len(objects) > 0:
-        buffers = objects['geo'].buffer(radius, cap_style=3)
-        result = nodes.sindex.query(buffers)
-        for i_obj, i_node in zip(result[0], result[1]):
-            obj_id = objects.index[i_obj]
-            node_id = nodes.index[i_node]
-            if buffers.loc[obj_id].contains(nodes.loc[node_id, 'geo']):
-                objects.loc[obj_id, infos_col][node_id] = {}
-
-    # for each object find all matching nearby nodes
-    for obj_id in objects.index:
-    
-        # choose all nodes that match object's modalities
-        obj_mods = objects.loc[obj_id, 'mods']
-        obj_maybe_mods = objects.loc[obj_id, 'maybe_mods']
-        node_ids = []  # nodes with matching mods
-        for node_id, node_info in objects.loc[obj_id, infos_col].items():
-            node_info['mods_match'] = mods_func(obj_mods, obj_maybe_mods, nodes.loc[node_id, :])
-            if node_info['mods_match']:
-                node_ids.append(node_id)
-        
-        # make scores
-        osm_obj = objects.loc[obj_id, 'obj']
-        for node_id in node_ids:
-            node_info = objects.loc[obj_id, infos_col][node_id]
-            node_info['ref:IFOPT_match'], node_info['ref_match'], \
-            node_info['local_ref_match'], node_info['ref_name_match'], \
-            node_info['name_match'], node_info['layer_match'], node_info['level_match'] \
-                = score_func(osm_obj, nodes.loc[node_id, 'obj'])
-            node_info['score'] = 10 * node_info['ref:IFOPT_match'] \
-                                 + 2 * node_info['ref_match'] \
-                                 + 2 * node_info['local_ref_match'] \
-                                 + 1 * node_info['ref_name_match'] \
-                                 + 1 * node_info['name_match'] \
-                                 + 1 * node_info['layer_match'] \
-                                 + 2 * node_info['level_match']
-
-        # adjust scores by distance (add 0...1/2 for distance max...0)
-        # note: this adjustment by distance only influences the ordering of
-        #       scores for equal scores (because scores from tags differ at
-        #       least by 1)
-        dists = nodes.loc[node_ids, 'geo'].distance(objects.loc[obj_id, 'geo'])
-        for node_id, dist in zip(node_ids, dists):
-            node_info = objects.loc[obj_id, infos_col][node_id]
-            node_info['score'] += (radius - dist) / (2 * radius)
-
-        # sort nodes by score and remove nodes with negative score
-        node_ids = [n_id for n_id in node_ids if objects.loc[obj_id, infos_col][n_id]['score'] > 0]
-        node_ids.sort(key=lambda n_id: objects.loc[obj_id, infos_col][n_id]['score'], reverse=True)
-
-        objects.loc[obj_id, ids_col].extend(node_ids)
\ No newline at end of file
+    if len(objects) == 0 or len(nodes) == 0:
+        return
+
+    # for each object get all nodes in neighborhood (pairs ordered by object)
+    buffers = objects['geo'].buffer(radius, cap_style=3)
+    i_objs, i_nodes = nodes.sindex.query(buffers, predicate='contains')
+
+    # modalities of all pairs
+    obj_mods = objects['mods'].to_numpy(dtype=np.int64)
+    obj_maybe_mods = objects['maybe_mods'].to_numpy(dtype=np.int64)
+    node_mods = nodes['mods'].to_numpy(dtype=np.int64)
+    if 'maybe_mods' in nodes.columns:
+        node_maybe_mods = nodes['maybe_mods'].to_numpy(dtype=np.int64)
+    else:
+        node_maybe_mods = np.zeros(len(nodes), dtype=np.int64)
+    mods_match = np.asarray(mods_func(
+        obj_mods[i_objs], obj_maybe_mods[i_objs],
+        node_mods[i_nodes], node_maybe_mods[i_nodes]
+    ), dtype=bool)
+
+    # make scores for pairs with matching modalities
+    m_objs = i_objs[mods_match]
+    m_nodes = i_nodes[mods_match]
+    matches = score_func(m_objs, m_nodes)
+    scores = matches @ match_weights
+
+    # adjust scores by distance (add 0...1/2 for distance max...0)
+    # note: this adjustment by distance only influences the ordering of
+    #       scores for equal scores (because scores from tags differ at
+    #       least by 1)
+    dists = shapely.distance(
+        nodes['geo'].to_numpy()[m_nodes],
+        objects['geo'].to_numpy()[m_objs]
+    )
+    scores = scores + (radius - dists) / (2 * radius)
+
+    # write infos (in order of neighborhood query)
+    node_ids = nodes.index.to_numpy()
+    obj_infos = objects[infos_col].to_list()
+    pair_infos = []
+    for i_obj, node_id, match in zip(i_objs.tolist(), node_ids[i_nodes].tolist(), mods_match.tolist()):
+        node_info = {'mods_match': match}
+        obj_infos[i_obj][node_id] = node_info
+        if match:
+            pair_infos.append(node_info)
+    for node_info, pair_matches, score in zip(pair_infos, matches.tolist(), scores.tolist()):
+        node_info.update(zip(match_names, pair_matches))
+        node_info['score'] = score
+
+    # sort nodes by score (per object) and remove nodes with non-positive score
+    # note: stable sort keeps order of neighborhood query for equal scores
+    positive = scores > 0
+    m_objs = m_objs[positive]
+    order = np.lexsort((-scores[positive], m_objs))
+    sorted_ids = node_ids[m_nodes[positive][order]].tolist()
+    start = 0
+    for ids, count in zip(objects[ids_col], np.bincount(m_objs, minlength=len(objects)).tolist()):
+        ids.extend(sorted_ids[start:start + count])
+        start += count
+
+
+def geojson_features(df):
+    '''
+    GeoJSON features (one string per feature) for rows of a GeoDataFrame in
+    lon-lat CRS.
+    '''
+
+    # note: floats with 15 significant digits (like GDAL's GeoJSON driver)
+    def encode(v):
+        if type(v) is float:
+            return repr(float(f'{v:.15g}')) if v == v else 'null'
+        if v is None or v is pd.NA:
+            return 'null'
+        return json.dumps(v)
+
+    props = [
+        [f'"{col}": {encode(v)}' for v in df[col].tolist()]
+        for col in df.columns if col != df.geometry.name
+    ]
+    geos = shapely.to_geojson(df.geometry.to_numpy())
+    return [
+        '{"type": "Feature", "properties": {' + ', '.join(row) + '}, "geometry": ' \
+            + (geo if geo is not None else 'null') + '}'
+        for row, geo in zip(zip(*props) if len(props) > 0 else [()] * len(df), geos)
+    ]
+
+
+def write_geojson(file_name, features):
+    '''
+    Write GeoJSON features (see geojson_features()) to a GeoJSON file (one
+    feature per line).
+    '''
+
+    name = os.path.splitext(os.path.basename(file_name))[0]
+    with open(file_name, 'w') as f:
+        f.write('{\n"type": "FeatureCollection",\n')
+        f.write(f'"name": {json.dumps(name)},\n')
+        f.write('"crs": { "type": "name", "properties": { "name": "urn:ogc:def:crs:OGC:1.3:CRS84" } },\n')
+        f.write('"features": [\n')
+        f.write(',\n'.join(features))
+        f.write('\n]\n}\n')
@@ -27,6 +27,12 @@ L.Canvas.Tile.include({
 //----------------------------------------------------------------------------
 
 const ptsaTilesUrl = "http://localhost/ptsa/tiles/{z}/{x}/{y}.pbf";
+// note: for tiles_mode "pmtiles" use the archive's URL, e.g.
+//       "http://localhost/ptsa/tiles/tiles.pmtiles"
+
+// storage of plole details, same as ploles_mode in backend's config.json
+// ('files', 'sharded' or 'archive')
+const ploleMode = "files";
 
 //----------------------------------------------------------------------------
 
@@ -66,14 +72,56 @@ if (region == null) {
     document.body.innerHTML = 'invalid region code';
 }
 
-if (okay == true) {
-    fetch('ploles/' + region + plole_id + '.json')
+// fetch length bytes starting at start via HTTP Range request
+function fetchRange(url, start, length) {
+    return fetch(url, {headers: {'Range': 'bytes=' + start + '-' + (start + length - 1)}})
         .then((response) => {
             if (!response.ok) {
                 throw new Error(`HTTP error: ${response.status}`);
             }
-            return response.json();
+            if (response.status == 206) {
+                return response.arrayBuffer();
+            }
+            // server ignored Range header and sent whole file
+            return response.arrayBuffer().then((buffer) => buffer.slice(start, start + length));
+        });
+}
+
+// fetch plole details from region's archive (see backend/ploles.py for layout)
+function fetchFromArchive(url, plole_id) {
+    const headerSize = 16;
+    const entrySize = 12;
+    return fetchRange(url, headerSize + entrySize * plole_id, entrySize)
+        .then((buffer) => {
+            const view = new DataView(buffer);
+            const length = (buffer.byteLength == entrySize) ? view.getUint32(8, true) : 0;
+            if (length == 0) {
+                throw new Error('no details for plole ' + plole_id);
+            }
+            return fetchRange(url, Number(view.getBigUint64(0, true)), length);
         })
+        .then((buffer) => JSON.parse(new TextDecoder().decode(buffer)));
+}
+
+function fetchPlole(region, plole_id) {
+    if (ploleMode == 'archive') {
+        return fetchFromArchive('ploles/' + region + '.ploles', plole_id);
+    }
+    var url = 'ploles/' + region + plole_id + '.json';
+    if (ploleMode == 'sharded') {
+        url = 'ploles/' + region + '/' + Math.floor(plole_id / 1000) + '/' + plole_id + '.json';
+    }
+    return fetch(url)
+        .then((response) => {
+            if (!response.ok) {
+                throw new Error(`HTTP error: ${response.status}`);
+            }
+            return response.json();
+        });
+}
+
+if (okay == true) {
+    fetchPlole(region, plole_id)
         .then((json) => show_data(json))
         .catch((err) => document.body.innerHTML = ('error: ' + err.message));
 }
@@ -296,7 +344,7 @@ function show_data(data) {
 
 //----------------------------------------------------------------------------
 var ptsaLayer = new L.VectorGrid.Protobuf(
-    ptsaTilesUrl,
+    ptsaTilesLayerUrl(ptsaTilesUrl),
     {
         rendererFactory: L.canvas.tile,
         interactive: false,
@@ -27,6 +27,8 @@ L.Canvas.Tile.include({
 //----------------------------------------------------------------------------
 
 const ptsaTilesUrl = "http://localhost/ptsa/tiles/{z}/{x}/{y}.pbf";
+// note: for tiles_mode "pmtiles" use the archive's URL, e.g.
+//       "http://localhost/ptsa/tiles/tiles.pmtiles"
 
 
 //----------------------------------------------------------------------------
@@ -59,7 +61,7 @@ var blackLayer = L.imageOverlay(
 ).addTo(map);
 
 var ptsaLayer = new L.VectorGrid.Protobuf(
-    ptsaTilesUrl,
+    ptsaTilesLayerUrl(ptsaTilesUrl),
     {
         rendererFactory: L.canvas.tile,
         interactive: true,
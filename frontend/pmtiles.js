@@ -0,0 +1,197 @@
+// Reading PTSA tiles from a single PMTiles archive (version 3) via HTTP Range
+// requests, see tiles_mode in backend's config.json.
+//
+// If the tile URL ends with '.pmtiles', ptsaTilesLayerUrl() returns the URL
+// template 'pmtiles://{z}/{x}/{y}' for Leaflet.VectorGrid. VectorGrid loads
+// tiles with fetch(), so fetch() is wrapped to answer such URLs from the
+// archive.
+
+class PMTilesArchive {
+
+    constructor(url) {
+        this.url = url;
+        this.header = null;
+        this.root = null;
+        this.leaves = new Map();  // offset of leaf directory -> promise of directory
+    }
+
+    fetchRange(offset, length) {
+        return ptsaFetch(this.url, {headers: {'Range': 'bytes=' + offset + '-' + (offset + length - 1)}})
+            .then((response) => {
+                if (!response.ok) {
+                    throw new Error(`HTTP error: ${response.status}`);
+                }
+                if (response.status == 206) {
+                    return response.arrayBuffer();
+                }
+                // server ignored Range header and sent whole file
+                return response.arrayBuffer().then((buffer) => buffer.slice(offset, offset + length));
+            });
+    }
+
+    decompress(buffer, compression) {
+        if (compression == 0 || compression == 1) {  // unknown or none
+            return Promise.resolve(buffer);
+        }
+        if (compression == 2) {  // gzip
+            const stream = new Blob([buffer]).stream().pipeThrough(new DecompressionStream('gzip'));
+            return new Response(stream).arrayBuffer();
+        }
+        return Promise.reject(new Error('unsupported PMTiles compression ' + compression));
+    }
+
+    // header and root directory (both within the archive's first 16 kB)
+    init() {
+        if (this.root == null) {
+            this.root = this.fetchRange(0, 16384).then((buffer) => {
+                const view = new DataView(buffer);
+                const magic = new TextDecoder().decode(buffer.slice(0, 7));
+                if (magic != 'PMTiles' || view.getUint8(7) != 3) {
+                    throw new Error('no PMTiles archive (version 3)');
+                }
+                const u64 = (pos) => Number(view.getBigUint64(pos, true));
+                this.header = {
+                    rootOffset: u64(8),
+                    rootLength: u64(16),
+                    leavesOffset: u64(40),
+                    tilesOffset: u64(56),
+                    internalCompression: view.getUint8(97),
+                    tileCompression: view.getUint8(98)
+                };
+                const root = buffer.slice(this.header.rootOffset, this.header.rootOffset + this.header.rootLength);
+                return this.decompress(root, this.header.internalCompression);
+            }).then((buffer) => parseDirectory(buffer));
+        }
+        return this.root;
+    }
+
+    leaf(offset, length) {
+        if (!this.leaves.has(offset)) {
+            this.leaves.set(offset, this.fetchRange(this.header.leavesOffset + offset, length)
+                .then((buffer) => this.decompress(buffer, this.header.internalCompression))
+                .then((buffer) => parseDirectory(buffer)));
+        }
+        return this.leaves.get(offset);
+    }
+
+    // tile data as ArrayBuffer (null for missing tiles)
+    getTile(z, x, y) {
+        const tileId = zxyToTileId(z, x, y);
+        const lookup = (directory, depth) => {
+            const entry = findEntry(directory, tileId);
+            if (entry == null || depth > 3) {
+                return null;
+            }
+            if (entry.runLength > 0) {
+                return this.fetchRange(this.header.tilesOffset + entry.offset, entry.length)
+                    .then((buffer) => this.decompress(buffer, this.header.tileCompression));
+            }
+            return this.leaf(entry.offset, entry.length).then((leaf) => lookup(leaf, depth + 1));
+        };
+        return this.init().then((root) => lookup(root, 0));
+    }
+}
+
+// Hilbert curve based tile ID (as in PMTiles specification)
+function zxyToTileId(z, x, y) {
+    var tileId = (Math.pow(4, z) - 1) / 3;  // number of tiles on lower zoom levels
+    for (var s = Math.pow(2, z - 1); s >= 1; s /= 2) {
+        const rx = (x & s) > 0 ? 1 : 0;
+        const ry = (y & s) > 0 ? 1 : 0;
+        tileId += s * s * ((3 * rx) ^ ry);
+        if (ry == 0) {
+            if (rx == 1) {
+                x = s - 1 - x;
+                y = s - 1 - y;
+            }
+            [x, y] = [y, x];
+        }
+    }
+    return tileId;
+}
+
+// directory entries from (decompressed) directory data
+function parseDirectory(buffer) {
+    const bytes = new Uint8Array(buffer);
+    var pos = 0;
+    const readVarint = () => {
+        var value = 0;
+        var factor = 1;
+        while (true) {
+            const b = bytes[pos++];
+            value += (b & 0x7f) * factor;
+            if (b < 0x80) {
+                return value;
+            }
+            factor *= 128;
+        }
+    };
+    const n = readVarint();
+    const entries = [];
+    var tileId = 0;
+    for (var i = 0; i < n; i++) {
+        tileId += readVarint();
+        entries.push({tileId: tileId, runLength: 0, length: 0, offset: 0});
+    }
+    for (var i = 0; i < n; i++) {
+        entries[i].runLength = readVarint();
+    }
+    for (var i = 0; i < n; i++) {
+        entries[i].length = readVarint();
+    }
+    for (var i = 0; i < n; i++) {
+        const value = readVarint();
+        if (value == 0 && i > 0) {  // directly behind previous entry
+            entries[i].offset = entries[i - 1].offset + entries[i - 1].length;
+        } else {
+            entries[i].offset = value - 1;
+        }
+    }
+    return entries;
+}
+
+// entry containing the tile (last entry with smaller or equal tile ID)
+function findEntry(entries, tileId) {
+    var low = 0;
+    var high = entries.length - 1;
+    while (low <= high) {
+        const mid = (low + high) >> 1;
+        if (entries[mid].tileId <= tileId) {
+            low = mid + 1;
+        } else {
+            high = mid - 1;
+        }
+    }
+    if (high < 0) {
+        return null;
+    }
+    const entry = entries[high];
+    if (entry.runLength == 0 || tileId - entry.tileId < entry.runLength) {
+        return entry;
+    }
+    return null;
+}
+
+const ptsaFetch = window.fetch.bind(window);
+var ptsaArchive = null;
+
+window.fetch = function (resource, options) {
+    if (ptsaArchive != null && typeof resource === 'string' && resource.startsWith('pmtiles://')) {
+        const [z, x, y] = resource.substring(10).split('/').map((s) => parseInt(s));
+        return ptsaArchive.getTile(z, x, y).then((data) => {
+            if (data == null) {
+                return new Response(null, {status: 404});
+            }
+            return new Response(data, {status: 200, headers: {'Content-Type': 'application/x-protobuf'}});
+        });
+    }
+    return ptsaFetch(resource, options);
+};
+
+function ptsaTilesLayerUrl(url) {
+    if (!url.endsWith('.pmtiles')) {
+        return url;
+    }
+    ptsaArchive = new PMTilesArchive(url);
+    return 'pmtiles://{z}/{x}/{y}';
+}